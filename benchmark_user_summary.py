@@ -0,0 +1,101 @@
+"""
+benchmark_user_summary.py
+
+Measures get_user_data_summary() latency (the "View My Data" button) against
+the previous five-query implementation, for a single user holding 10k, 100k
+and 1M messages.
+
+Each size gets its own temporary database built through init_db(), so the
+numbers include the current indexes and pragmas.
+
+Usage:
+    python benchmark_user_summary.py
+    python benchmark_user_summary.py --sizes 10000 100000 --repeat 50
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCHMARK")
+
+import bot_modules.database as db
+
+USER_ID = 1
+ACTION_TYPES = ("text", "button_click", "photo", "data_entry")
+
+
+def legacy_user_data_summary(user_id):
+    """The five round-trip version get_user_data_summary() replaced, kept for comparison."""
+    with db.db_connection() as conn:
+        cursor = conn.cursor()
+        summary = {}
+        cursor.execute("""
+        SELECT u.*, p.language, p.notifications, p.theme FROM users u
+        LEFT JOIN user_preferences p ON u.user_id = p.user_id WHERE u.user_id = ?
+        """, (user_id,))
+        user = cursor.fetchone()
+        if user:
+            summary['profile'] = dict(user)
+            cursor.execute("SELECT COUNT(*) as count FROM user_messages WHERE user_id = ?", (user_id,))
+            summary['message_count'] = cursor.fetchone()['count']
+            cursor.execute("SELECT COUNT(*) as count FROM user_interactions WHERE user_id = ?", (user_id,))
+            summary['interaction_count'] = cursor.fetchone()['count']
+            cursor.execute("SELECT action_type, COUNT(*) as count FROM user_interactions WHERE user_id = ? GROUP BY action_type ORDER BY count DESC", (user_id,))
+            summary['interaction_types'] = [dict(row) for row in cursor.fetchall()]
+            cursor.execute("SELECT message_text, timestamp FROM user_messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT 20", (user_id,))
+            summary['recent_messages'] = [dict(row) for row in cursor.fetchall()]
+    return summary
+
+
+def populate(message_count):
+    """Insert one user with message_count messages and as many interactions."""
+    with db.db_connection() as conn:
+        conn.execute("INSERT INTO users (user_id, username, first_name, chat_id) VALUES (?, 'bench', 'Bench', 1)", (USER_ID,))
+        conn.execute("INSERT INTO user_preferences (user_id) VALUES (?)", (USER_ID,))
+        conn.executemany(
+            "INSERT INTO user_messages (user_id, chat_id, message_id, message_text, message_type, timestamp) "
+            "VALUES (?, 1, ?, ?, 'text', datetime('2025-01-01', '+' || ? || ' seconds'))",
+            ((USER_ID, i, f"benchmark message {i}", i) for i in range(message_count)))
+        conn.executemany(
+            "INSERT INTO user_interactions (user_id, action_type, timestamp) "
+            "VALUES (?, ?, datetime('2025-01-01', '+' || ? || ' seconds'))",
+            ((USER_ID, ACTION_TYPES[i % len(ACTION_TYPES)], i) for i in range(message_count)))
+    db.get_connection().execute("ANALYZE")
+
+
+def time_calls(func, repeat):
+    func(USER_ID) # Warm the page cache
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(USER_ID)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), max(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="Messages per user to benchmark")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed calls per implementation and size")
+    args = parser.parse_args()
+
+    print(f"{'messages':>10} | {'summary p50 ms':>14} | {'summary max ms':>14} | {'legacy p50 ms':>13} | {'legacy max ms':>13}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db.DB_PATH = os.path.join(tmp_dir, "benchmark.db")
+            db.init_db()
+            populate(size)
+            assert db.get_user_data_summary(USER_ID)['message_count'] == size
+            new_p50, new_max = time_calls(db.get_user_data_summary, args.repeat)
+            old_p50, old_max = time_calls(legacy_user_data_summary, args.repeat)
+            db.close_all_connections()
+        print(f"{size:>10} | {new_p50:>14.2f} | {new_max:>14.2f} | {old_p50:>13.2f} | {old_max:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
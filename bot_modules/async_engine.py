@@ -0,0 +1,191 @@
+import asyncio
+import functools
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from . import config
+from . import database as db
+from . import dispatcher
+from . import google_apis
+from .telegram_bot import analysis_prompts, generate_main_menu
+from . import strings_en
+from . import strings_es
+
+try:
+    import aiohttp # Optional: needed only for BOT_ENGINE=async (AsyncTeleBot uses it too)
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:
+    aiohttp = AsyncTeleBot = None
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+# Optional asyncio engine (BOT_ENGINE=async). Conversations spend most of their time
+# waiting on Gemini; here that wait is an awaited aiohttp request, so thousands of
+# them cost no threads. Plain text messages (the Gemini analysis path) are handled
+# natively. Every other update (commands, menus, photos, Web App data) goes through
+# the per-chat dispatcher lanes to the existing synchronous handlers, which return
+# quickly or hand long work to their own queues. SQLite calls run on a small
+# dedicated thread pool. Only this text path is asynchronous: Google Forms/Sheets,
+# image analysis and the database keep their synchronous clients, off the loop.
+DATA_ENTRY_PATTERN = re.compile(r"^(dato|datos)(:)?\s*", re.IGNORECASE) # Same keywords handle_text recognises
+
+_db_executor = ThreadPoolExecutor(max_workers=config.ASYNC_DB_THREADS, thread_name_prefix="async-db")
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database call on the DB thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def is_async_text(update):
+    """True for updates the async engine handles itself: non-command text that is not a data entry."""
+    message = update.message
+    if message is None or message.content_type != s.DB_MESSAGE_TYPE_TEXT or not message.text:
+        return False
+    return not message.text.startswith('/') and not DATA_ENTRY_PATTERN.match(message.text)
+
+async def forward_to_lanes(update):
+    """
+    Hand an update to the sync handlers' dispatcher lanes. A full lane is waited on
+    (off the loop) rather than shed: the polling offset already acknowledged the
+    update, so Telegram would never redeliver it. Returns False only once the lanes stopped.
+    """
+    loop = asyncio.get_running_loop()
+    queued = await loop.run_in_executor(None, functools.partial(dispatcher.dispatch_update, update, block=True))
+    if not queued:
+        logger.warning(s.WARN_ASYNC_UPDATE_SHED.format(update_id=update.update_id))
+    return queued
+
+class AsyncBotEngine:
+    """
+    Owns the AsyncTeleBot, the aiohttp session for Gemini and the per-user text
+    bursts. A burst is one asyncio task per user: each new message cancels it
+    (aborting an in-flight Gemini request) and starts a new one over all texts
+    received since the last answered analysis, after the quiet period.
+    """
+
+    def __init__(self):
+        if AsyncTeleBot is None:
+            raise RuntimeError(s.ERROR_ASYNC_ENGINE_UNAVAILABLE)
+        engine = self
+
+        class _Bot(AsyncTeleBot):
+            async def process_new_updates(self, updates):
+                for update in updates:
+                    await engine.dispatch(update) # Waits while a lane is full, pausing polling
+
+        self.bot = _Bot(config.TOKEN)
+        self.session = None
+        self._texts = {} # user_id -> (chat_id, message_id, text) not yet covered by an answered analysis
+        self._status = {} # user_id -> task resolving to the "Analyzing..." message
+        self._tasks = {} # user_id -> current burst task
+        self._handlers = set() # Running handle_text tasks (the loop itself only keeps weak references)
+        self._chat_locks = {} # chat_id -> [asyncio.Lock, handlers holding or waiting for it]
+
+    async def dispatch(self, update):
+        if is_async_text(update):
+            task = asyncio.create_task(self.handle_text(update.message))
+            self._handlers.add(task)
+            task.add_done_callback(self._handler_done)
+        else:
+            await forward_to_lanes(update)
+
+    def _handler_done(self, task):
+        self._handlers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(s.ERROR_ASYNC_TEXT_FAILED.format(error=task.exception()), exc_info=task.exception())
+
+    async def handle_text(self, message):
+        """Handle one text message; a chat's messages are handled one at a time, in arrival order (like the sync lanes)."""
+        chat_id = message.chat.id
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._save_text(message)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat_id]
+
+    async def _save_text(self, message):
+        user_id, chat_id = message.from_user.id, message.chat.id
+        await run_db(db.save_user, message.from_user, chat_id)
+        await run_db(db.save_message, message)
+        await run_db(db.log_interaction, user_id, s.DB_MESSAGE_TYPE_TEXT)
+        logger.info(s.LOG_TRIGGER_GEMINI_TEXT_MSG.format(user_id=user_id))
+
+        self._texts.setdefault(user_id, []).append((chat_id, message.message_id, message.text))
+        if user_id not in self._status:
+            self._status[user_id] = asyncio.create_task(self.bot.send_message(chat_id, s.CALLBACK_ANALYZING_MESSAGES))
+        previous = self._tasks.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel() # Superseded; the new task covers its texts too
+        self._tasks[user_id] = asyncio.create_task(self._analyse_burst(user_id, chat_id))
+
+    async def _analyse_burst(self, user_id, chat_id):
+        try:
+            await asyncio.sleep(config.TEXT_ANALYSIS_DEBOUNCE_SECONDS)
+            texts = list(self._texts[user_id])
+            status_message = await asyncio.shield(self._status[user_id]) # Shielded: a later burst still needs it
+            prompt, item_count = await run_db(analysis_prompts.build, user_id, texts)
+            if not item_count:
+                text, error_text = s.CALLBACK_NO_MESSAGES_TO_ANALYZE, None
+            else:
+                logger.info(s.LOG_SENDING_PROMPT_TO_GEMINI.format(user_id=user_id, prompt_preview=prompt[:500]))
+                analysis_result, error_text = await google_apis.analyze_text_with_gemini_async(prompt, user_id, self.session)
+                error_text = error_text or (None if analysis_result else s.ERROR_AI_NO_RESPONSE)
+                if error_text:
+                    text = s.CALLBACK_ANALYSIS_ERROR_USER_MSG.format(error_text=error_text)
+                else:
+                    text = s.CALLBACK_ANALYSIS_RESULT_USER_MSG.format(analysis_result=analysis_result)
+                    if len(text) > 4096:
+                        text = text[:4093] + "..."
+                        logger.warning(s.LOG_GEMINI_ANALYSIS_TRUNCATED.format(user_id=user_id))
+            # Answered: the next message starts a new burst with a new status message
+            self._texts.pop(user_id, None)
+            self._status.pop(user_id, None)
+            self._tasks.pop(user_id, None)
+            await self.bot.edit_message_text(text, chat_id, status_message.message_id, reply_markup=generate_main_menu())
+        except asyncio.CancelledError:
+            logger.info(s.LOG_ANALYSIS_SUPERSEDED.format(user_id=user_id))
+            raise
+        except Exception as e:
+            logger.error(s.LOG_TRIGGER_GEMINI_ERROR.format(user_id=user_id, error=e), exc_info=True)
+            if self._tasks.get(user_id) is asyncio.current_task():
+                self._texts.pop(user_id, None)
+                status = self._status.pop(user_id, None)
+                self._tasks.pop(user_id, None)
+                try:
+                    if status is not None and status.done() and not status.exception():
+                        await self.bot.edit_message_text(s.ERROR_PROCESSING_REQUEST, chat_id, status.result().message_id,
+                                                         reply_markup=generate_main_menu())
+                    else:
+                        await self.bot.send_message(chat_id, s.ERROR_PROCESSING_REQUEST, reply_markup=generate_main_menu())
+                except Exception as nested_e:
+                    logger.error(s.LOG_TRIGGER_GEMINI_RECOVERY_FAIL.format(nested_error=nested_e), exc_info=True)
+
+    async def run(self):
+        """Long-poll Telegram until cancelled; closes the Gemini session on the way out."""
+        timeout = aiohttp.ClientTimeout(total=None, connect=config.HTTP_CONNECT_TIMEOUT_SECONDS,
+                                        sock_read=config.GEMINI_TIMEOUT_SECONDS)
+        connector = aiohttp.TCPConnector(limit=config.ASYNC_GEMINI_MAX_CONNECTIONS)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            self.session = session
+            logger.info(s.LOG_ASYNC_ENGINE_STARTED.format(db_threads=config.ASYNC_DB_THREADS,
+                                                          connections=config.ASYNC_GEMINI_MAX_CONNECTIONS))
+            try:
+                await self.bot.infinity_polling(logger_level=logging.INFO)
+            finally:
+                for task in list(self._handlers) + list(self._tasks.values()):
+                    task.cancel()
+                await self.bot.close_session()
+                self.session = None
+
+def run():
+    """Entry point used by main.py for BOT_ENGINE=async."""
+    asyncio.run(AsyncBotEngine().run())
@@ -1,4 +1,5 @@
 import os
+import sys
 import logging
 from dotenv import load_dotenv
 from . import strings_en
@@ -20,11 +21,12 @@ logger.info(s.LOG_RAW_DEBUG_MODE.format(raw_value=DEBUG_MODE_STR_RAW))
 DEBUG_MODE_STR = DEBUG_MODE_STR_RAW.lower()
 DEBUG_MODE = DEBUG_MODE_STR == "true"
 
-print(s.LOG_DEBUG_MODE_EVALUATED.format(debug_mode=DEBUG_MODE)) # Use a slightly different print message
+# Printed to stderr so command line tools (e.g. the data export) keep a clean stdout
+print(s.LOG_DEBUG_MODE_EVALUATED.format(debug_mode=DEBUG_MODE), file=sys.stderr) # Use a slightly different print message
 if DEBUG_MODE:
-    print(s.DEBUG_MODE_ON)
+    print(s.DEBUG_MODE_ON, file=sys.stderr)
 else:
-    print(s.DEBUG_MODE_OFF)
+    print(s.DEBUG_MODE_OFF, file=sys.stderr)
 
 # --- Telegram Configuration ---
 TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
@@ -52,6 +54,29 @@ GEMINI_API_ENDPOINT = os.environ.get(
     "GEMINI_API_ENDPOINT",
     "https://LOCATION-aiplatform.googleapis.com/v1/projects/PROJECT_ID/locations/LOCATION/publishers/google/models/gemini-2.0-flash-lite:generateContent"
 )
+# Streaming: text analyses use streamGenerateContent (server-sent events) and the
+# "Analyzing..." message is edited as the answer arrives, at most once per interval
+# (Telegram rate-limits edits to roughly one per second per chat).
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "false").lower() == "true"
+GEMINI_STREAM_ENDPOINT = os.environ.get(
+    "GEMINI_STREAM_ENDPOINT",
+    GEMINI_API_ENDPOINT.replace(":generateContent", ":streamGenerateContent") + "?alt=sse"
+)
+GEMINI_STREAM_EDIT_INTERVAL_SECONDS = float(os.environ.get("GEMINI_STREAM_EDIT_INTERVAL_SECONDS", 1.5))
+# Text messages sent within this many seconds of each other are analysed together in
+# one Gemini call; a message arriving mid-analysis cancels it. 0 analyses every message.
+TEXT_ANALYSIS_DEBOUNCE_SECONDS = float(os.environ.get("TEXT_ANALYSIS_DEBOUNCE_SECONDS", 2))
+# Analysis prompts include as much recent history as fits in PROMPT_TOKEN_BUDGET
+# (estimated at PROMPT_CHARS_PER_TOKEN characters per token), newest first.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 6000))
+PROMPT_CHARS_PER_TOKEN = float(os.environ.get("PROMPT_CHARS_PER_TOKEN", 4))
+PROMPT_HISTORY_MAX_ROWS = int(os.environ.get("PROMPT_HISTORY_MAX_ROWS", 200)) # Rows read on a user's first analysis
+PROMPT_CONTEXT_MAX_USERS = int(os.environ.get("PROMPT_CONTEXT_MAX_USERS", 1000)) # Users whose rendered history is kept in memory
+
+# Service account credentials are cached per scope set; a background thread refreshes
+# a token this many seconds before it expires (Google access tokens last about an hour).
+GOOGLE_CREDENTIALS_REFRESH_MARGIN_SECONDS = int(os.environ.get("GOOGLE_CREDENTIALS_REFRESH_MARGIN_SECONDS", 300))
+GOOGLE_CREDENTIALS_CHECK_SECONDS = float(os.environ.get("GOOGLE_CREDENTIALS_CHECK_SECONDS", 60)) # How often the refresher looks at cached tokens
 
 # Google Form configuration
 GOOGLE_FORM_ID = os.environ.get("GOOGLE_FORM_ID")
@@ -60,6 +85,16 @@ if not GOOGLE_FORM_ID:
 else:
     logger.info(s.LOG_GOOGLE_FORM_ID_SUCCESS.format(form_id=GOOGLE_FORM_ID))
 
+# Form responses are mirrored into SQLite and looked up by these answer fields
+# (question titles, case-insensitive); patient_id is always indexed.
+FORM_INDEXED_FIELDS = sorted({f.strip().lower() for f in os.environ.get("FORM_INDEXED_FIELDS", "").split(",") if f.strip()} | {"patient_id"})
+FORM_SYNC_MIN_INTERVAL_SECONDS = float(os.environ.get("FORM_SYNC_MIN_INTERVAL_SECONDS", 30)) # A hit in the mirror younger than this skips the sync
+# Form structure (question id -> title) is cached; after the TTL only the form's
+# revisionId is fetched, and the full form again only if it changed.
+FORM_STRUCTURE_TTL_SECONDS = float(os.environ.get("FORM_STRUCTURE_TTL_SECONDS", 600))
+FORM_STRUCTURE_CACHE_MAX = int(os.environ.get("FORM_STRUCTURE_CACHE_MAX", 32)) # Forms kept (least recently used dropped first)
+FORM_STRUCTURE_CACHE_FILE = os.environ.get("FORM_STRUCTURE_CACHE_FILE") # Optional JSON file so restarts start warm
+
 # Apps Script configuration
 APPS_SCRIPT_ID = os.environ.get("APPS_SCRIPT_ID")
 if not APPS_SCRIPT_ID:
@@ -75,8 +110,76 @@ if not APPS_SCRIPT_WEB_APP_URL or not APPS_SCRIPT_API_KEY:
 else:
     logger.info(s.LOG_APPS_SCRIPT_WEB_APP_SUCCESS)
 
+# --- Outbound HTTP Configuration ---
+# Gemini and the Apps Script Web App are called through one pooled, keep-alive
+# session (bot_modules/http_client.py). Timeouts are (connect, read) per endpoint.
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("HTTP_CONNECT_TIMEOUT_SECONDS", 5))
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_TIMEOUT_SECONDS", 60))
+WEBAPP_TIMEOUT_SECONDS = float(os.environ.get("WEBAPP_TIMEOUT_SECONDS", 30))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 10)) # Kept-alive connections per host
+GEMINI_POOL_MAXSIZE = int(os.environ.get("GEMINI_POOL_MAXSIZE", 20)) # Gemini gets a bigger pool: every photo and analysis uses it
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3)) # Retries on connection errors, 429 and 5xx
+HTTP_RETRY_BACKOFF_SECONDS = float(os.environ.get("HTTP_RETRY_BACKOFF_SECONDS", 0.5)) # Exponential backoff base; Retry-After is honoured
+HTTP_USE_HTTP2 = os.environ.get("HTTP_USE_HTTP2", "false").lower() == "true" # Needs the optional httpx[http2] package (0.26+)
+
 # --- Database Configuration ---
 DB_PATH = 'bot_users.db'
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000)) # How long a connection waits on a locked database
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL").upper() # WAL lets readers run alongside the writer
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper() # NORMAL is durable across app crashes in WAL mode
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 16384)) # Page cache per connection, in KiB
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 128 * 1024 * 1024)) # Bytes of the DB file to memory-map (0 disables)
+# Durability of message/interaction logging:
+#   "sync"         - each insert commits before the handler continues (safest, slowest)
+#   "group_commit" - inserts are batched by the writer thread, callers wait for their batch to commit
+#   "write_behind" - inserts are batched by the writer thread, callers return immediately;
+#                    queued rows are lost if the process crashes or is killed (opt-in only)
+DB_WRITE_MODE = os.environ.get("DB_WRITE_MODE", "group_commit").lower()
+DB_WRITE_BATCH_MS = int(os.environ.get("DB_WRITE_BATCH_MS", 50)) # Max time a queued write waits for its batch
+DB_WRITE_BATCH_ROWS = int(os.environ.get("DB_WRITE_BATCH_ROWS", 200)) # Max rows committed in one batch
+DB_WRITE_QUEUE_SIZE = int(os.environ.get("DB_WRITE_QUEUE_SIZE", 10000)) # Callers block when this many writes are pending
+DB_USER_TOUCH_SECONDS = float(os.environ.get("DB_USER_TOUCH_SECONDS", 5)) # Skip re-saving an unchanged user profile seen this recently
+# Gemini image results are reused for identical images (same SHA-256 and prompt version).
+IMAGE_CACHE_ENABLED = os.environ.get("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", 5000)) # Newest entries kept
+IMAGE_CACHE_MAX_AGE_DAYS = int(os.environ.get("IMAGE_CACHE_MAX_AGE_DAYS", 30))
+IMAGE_CACHE_EVICT_EVERY = int(os.environ.get("IMAGE_CACHE_EVICT_EVERY", 100)) # Run eviction after this many new entries
+# Photos are processed by a worker pool; users take turns and each runs one photo at a time.
+PHOTO_WORKERS = int(os.environ.get("PHOTO_WORKERS", 4)) # Concurrent Gemini image calls
+PHOTO_QUEUE_MAX = int(os.environ.get("PHOTO_QUEUE_MAX", 100)) # Photos waiting beyond this are rejected
+PHOTO_QUEUE_MAX_PER_USER = int(os.environ.get("PHOTO_QUEUE_MAX_PER_USER", 5))
+PHOTO_QUEUE_DRAIN_SECONDS = float(os.environ.get("PHOTO_QUEUE_DRAIN_SECONDS", 30)) # Wait for queued photos on shutdown
+# "Delete my data" runs in a background reaper: short transactions of at most
+# DB_DELETE_BATCH_ROWS rows, with a pause between them so other writers get the lock.
+DB_DELETE_BATCH_ROWS = int(os.environ.get("DB_DELETE_BATCH_ROWS", 500))
+DB_DELETE_BATCH_PAUSE_MS = int(os.environ.get("DB_DELETE_BATCH_PAUSE_MS", 20))
+DB_DELETE_PROGRESS_SECONDS = float(os.environ.get("DB_DELETE_PROGRESS_SECONDS", 3)) # Min interval between progress reports to the chat
+DB_DELETE_RETRY_SECONDS = float(os.environ.get("DB_DELETE_RETRY_SECONDS", 30)) # Wait before retrying a deletion that failed
+
+# Updates (webhook or polling) are hashed by chat onto DISPATCH_LANES worker lanes:
+# parallel across chats, strictly ordered within a chat. The webhook returns at once;
+# when a lane is full it answers 503 and Telegram redelivers, while polling waits.
+# The earlier WEBHOOK_WORKERS / WEBHOOK_QUEUE_MAX (split across the lanes) / WEBHOOK_DRAIN_SECONDS
+# are still read when the DISPATCH_* names aren't set; WEBHOOK_QUEUE_MAX_PER_CHAT has no
+# equivalent, as a chat can't hold more than its lane.
+DISPATCH_LANES = int(os.environ.get("DISPATCH_LANES", os.environ.get("WEBHOOK_WORKERS", 8)))
+DISPATCH_LANE_QUEUE_MAX = int(os.environ.get("DISPATCH_LANE_QUEUE_MAX", # Updates waiting per lane
+                                             max(1, int(os.environ.get("WEBHOOK_QUEUE_MAX", 100 * DISPATCH_LANES)) // DISPATCH_LANES)))
+DISPATCH_DRAIN_SECONDS = float(os.environ.get("DISPATCH_DRAIN_SECONDS", os.environ.get("WEBHOOK_DRAIN_SECONDS", 10))) # Wait for queued updates on shutdown
+# Gemini text analyses started from a handler (Menu 1, undebounced text) run on their
+# own pool, so a slow answer doesn't hold up the other chats sharing the lane.
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", 4)) # Concurrent Gemini text calls
+ANALYSIS_QUEUE_MAX = int(os.environ.get("ANALYSIS_QUEUE_MAX", 100))
+ANALYSIS_QUEUE_MAX_PER_USER = int(os.environ.get("ANALYSIS_QUEUE_MAX_PER_USER", 2))
+ANALYSIS_QUEUE_DRAIN_SECONDS = float(os.environ.get("ANALYSIS_QUEUE_DRAIN_SECONDS", 15)) # Wait for queued analyses on shutdown
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN", "") # Sent to setWebhook; requests without it get 403
+# Conversation state (menu state and selections) per user:
+#   "memory" - in this process, least recently used sessions evicted beyond SESSION_MAX_IN_MEMORY
+#   "sqlite" - in the user_sessions table, shared by every worker process and kept across restarts
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory").lower()
+SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_SECONDS", 24 * 3600)) # Idle sessions expire after this
+SESSION_MAX_IN_MEMORY = int(os.environ.get("SESSION_MAX_IN_MEMORY", 10000))
+SESSION_PURGE_INTERVAL_SECONDS = float(os.environ.get("SESSION_PURGE_INTERVAL_SECONDS", 600)) # Min interval between deletes of expired sqlite sessions
 
 # --- SSL Configuration ---
 # Use relative paths assuming 'certs' is in the root alongside app.py/main.py
@@ -85,3 +188,24 @@ WEBHOOK_SSL_PRIV = "certs/privkey.pem"
 
 # --- Flask Configuration ---
 FLASK_PORT = int(os.environ.get("PORT", 443)) # Use PORT from env if set, else default 443
+
+# --- Bot engine ---
+# "sync": TeleBot handlers on threads (webhook or polling). "async": AsyncTeleBot long
+# polling (needs aiohttp); text analyses wait on Gemini without holding a thread and
+# other updates go to the sync handlers through the dispatcher lanes. Serve the Flask
+# routes separately (wsgi.py with WSGI_SET_WEBHOOK=false) in async mode.
+BOT_ENGINE = os.environ.get("BOT_ENGINE", "sync").lower()
+ASYNC_DB_THREADS = int(os.environ.get("ASYNC_DB_THREADS", 4)) # Threads for SQLite calls from the event loop
+ASYNC_GEMINI_MAX_CONNECTIONS = int(os.environ.get("ASYNC_GEMINI_MAX_CONNECTIONS", 100)) # Concurrent Gemini requests
+
+# --- Production server (gunicorn -c gunicorn.conf.py wsgi:app) ---
+# Update lanes and text debouncing live in each process, so per-chat ordering only
+# holds within one worker: scale with WSGI_THREADS first. With more than one worker,
+# set SESSION_BACKEND=sqlite so the workers share conversation state.
+WSGI_BIND = os.environ.get("WSGI_BIND", f"0.0.0.0:{FLASK_PORT}")
+WSGI_WORKERS = int(os.environ.get("WSGI_WORKERS", 1))
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", 8)) # Request threads per worker (webhook replies are immediate)
+WSGI_TIMEOUT_SECONDS = int(os.environ.get("WSGI_TIMEOUT_SECONDS", 60)) # Silent workers are restarted after this
+WSGI_GRACEFUL_TIMEOUT_SECONDS = int(os.environ.get("WSGI_GRACEFUL_TIMEOUT_SECONDS", 60)) # Covers DISPATCH_DRAIN_SECONDS + ANALYSIS_QUEUE_DRAIN_SECONDS + PHOTO_QUEUE_DRAIN_SECONDS
+WSGI_MAX_REQUESTS = int(os.environ.get("WSGI_MAX_REQUESTS", 0)) # Recycle workers after this many requests (0 = never)
+WSGI_SET_WEBHOOK = os.environ.get("WSGI_SET_WEBHOOK", "true").lower() == "true" # Register WEBHOOK_URL with Telegram at startup
@@ -1,8 +1,13 @@
 import sqlite3
 import json
+import base64
 import logging
 import re
 import os
+import threading
+import queue
+import time
+from contextlib import contextmanager
 from . import config
 from . import strings_en
 from . import strings_es
@@ -16,9 +21,229 @@ logger = logging.getLogger(__name__)
 # Database setup
 DB_PATH = config.DB_PATH
 
-def init_db():
-    """Initialize the SQLite database with required tables"""
-    conn = sqlite3.connect(DB_PATH)
+# --- Connection Pool ---
+# Each worker thread (telebot handler, Flask request thread) keeps one long-lived
+# connection instead of opening and closing a new one for every query.
+_local = threading.local()
+_pool = {} # thread ident -> (thread, connection), used to close connections of finished threads
+_pool_lock = threading.Lock()
+_pool_generation = 0 # Bumped by close_all_connections() so threads drop their closed connection
+
+def _connection_pragmas():
+    """PRAGMA statements applied to every pooled connection."""
+    return [
+        f"PRAGMA busy_timeout = {config.DB_BUSY_TIMEOUT_MS}",
+        f"PRAGMA synchronous = {config.DB_SYNCHRONOUS}",
+        f"PRAGMA cache_size = -{config.DB_CACHE_SIZE_KB}", # Negative value means KiB rather than pages
+        f"PRAGMA mmap_size = {config.DB_MMAP_SIZE}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+
+def _open_connection(path):
+    conn = sqlite3.connect(path, timeout=config.DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in _connection_pragmas():
+        conn.execute(pragma)
+    return conn
+
+def _prune_dead_connections():
+    """Close connections owned by threads that have exited. Caller holds _pool_lock."""
+    for ident, (thread, conn) in list(_pool.items()):
+        if not thread.is_alive():
+            del _pool[ident]
+            try:
+                conn.close()
+            except Exception as e:
+                logger.warning(f"Error closing pooled connection of finished thread {ident}: {e}")
+
+def get_connection():
+    """Return the calling thread's pooled connection, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.generation != _pool_generation: # Already closed by close_all_connections()
+        conn = _local.conn = None
+    if conn is not None and _local.path == DB_PATH:
+        return conn
+    if conn is not None: # DB_PATH changed since this thread connected
+        close_connection()
+    conn = _open_connection(DB_PATH)
+    _local.conn, _local.path, _local.depth, _local.generation = conn, DB_PATH, 0, _pool_generation
+    thread = threading.current_thread()
+    with _pool_lock:
+        _prune_dead_connections()
+        _pool[thread.ident] = (thread, conn)
+    logger.debug(f"Opened pooled SQLite connection for thread {thread.name}")
+    return conn
+
+@contextmanager
+def db_connection():
+    """
+    Context manager around the calling thread's pooled connection.
+    Commits when the outermost block exits cleanly and rolls back on error;
+    nested blocks share the outer transaction.
+    """
+    conn = get_connection()
+    depth = _local.depth
+    _local.depth = depth + 1
+    try:
+        yield conn
+        if depth == 0:
+            conn.commit()
+    except Exception:
+        if depth == 0:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth = depth
+
+def close_connection():
+    """Close the calling thread's pooled connection, if any."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _pool_lock:
+        _pool.pop(threading.get_ident(), None)
+    conn.close()
+
+def close_all_connections():
+    """Close every pooled connection (used on shutdown and in tests)."""
+    global _pool_generation
+    with _pool_lock:
+        entries = list(_pool.values())
+        _pool.clear()
+        _pool_generation += 1
+    for _, conn in entries:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled connection: {e}")
+    _local.conn = None
+
+def reset_connections_after_fork():
+    """
+    In a forked child (gunicorn worker): forget connections inherited from the parent
+    without closing them; an SQLite connection must not be used across fork().
+    """
+    global _pool_generation
+    _pool.clear()
+    _pool_generation += 1
+    _local.conn = None
+
+# --- Write-Behind Queue ---
+# Inserts that only log activity (messages, interactions) are handed to a single
+# writer thread that commits them in batches, so handlers don't wait on a commit
+# per row. config.DB_WRITE_MODE selects the durability trade-off.
+WRITE_MODES = ('sync', 'group_commit', 'write_behind')
+_write_queue = queue.Queue(maxsize=config.DB_WRITE_QUEUE_SIZE)
+_writer_thread = None
+_writer_lock = threading.Lock()
+_STOP_WRITER = object()
+
+def _write_mode():
+    mode = config.DB_WRITE_MODE
+    if mode not in WRITE_MODES:
+        logger.warning(s.WARN_DB_UNKNOWN_WRITE_MODE.format(mode=mode))
+        return 'sync'
+    return mode
+
+def _ensure_writer_started():
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            _writer_thread.start()
+            logger.info(s.LOG_DB_WRITER_STARTED.format(mode=config.DB_WRITE_MODE, batch_ms=config.DB_WRITE_BATCH_MS,
+                                                       batch_rows=config.DB_WRITE_BATCH_ROWS))
+
+def _execute_write(sql, params):
+    """Run an INSERT/UPDATE according to the configured write mode."""
+    mode = _write_mode()
+    if mode == 'sync' or threading.current_thread() is _writer_thread:
+        with db_connection() as conn:
+            conn.execute(sql, params)
+        return
+    _ensure_writer_started()
+    done = threading.Event() if mode == 'group_commit' else None
+    _write_queue.put((sql, params, done)) # Blocks when the queue is full (backpressure)
+    if done:
+        done.wait()
+
+def _write_batch(batch):
+    """Commit a batch of queued writes in one transaction, falling back to row by row on error."""
+    writes = [(sql, params) for sql, params, _ in batch if sql is not None]
+    if writes:
+        try:
+            with db_connection() as conn:
+                for sql, params in writes:
+                    conn.execute(sql, params)
+        except Exception as batch_err:
+            logger.error(s.ERROR_DB_WRITE_BATCH_FAILED.format(count=len(writes), error=batch_err))
+            for sql, params in writes:
+                try:
+                    with db_connection() as conn:
+                        conn.execute(sql, params)
+                except Exception as row_err:
+                    logger.error(s.ERROR_DB_QUEUED_WRITE_FAILED.format(error=row_err, sql_preview=sql.strip()[:80]))
+    for _, _, done in batch:
+        if done:
+            done.set()
+
+def _writer_loop():
+    batch_window = config.DB_WRITE_BATCH_MS / 1000
+    while True:
+        item = _write_queue.get()
+        if item is _STOP_WRITER:
+            break
+        batch = [item]
+        deadline = time.monotonic() + batch_window
+        caller_waiting = item[2] is not None
+        stop = False
+        # Collect more writes until the batch is full, the window closes, or a flush is requested.
+        # Once a caller is waiting (group_commit, flush) only writes already queued are added.
+        while item[0] is not None and len(batch) < config.DB_WRITE_BATCH_ROWS:
+            remaining = 0 if caller_waiting else deadline - time.monotonic()
+            try:
+                item = _write_queue.get(timeout=remaining) if remaining > 0 else _write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP_WRITER:
+                stop = True
+                break
+            batch.append(item)
+            caller_waiting = caller_waiting or item[2] is not None
+        _write_batch(batch)
+        if stop:
+            break
+    close_connection()
+    logger.info(s.LOG_DB_WRITER_STOPPED)
+
+def flush_pending_writes():
+    """Block until every write queued so far has been committed."""
+    if _writer_thread is None or not _writer_thread.is_alive() or threading.current_thread() is _writer_thread:
+        return
+    done = threading.Event()
+    _write_queue.put((None, None, done)) # A marker with no SQL: commit what is queued, then signal
+    done.wait()
+
+def stop_writer():
+    """Commit pending writes and stop the writer thread (called on shutdown)."""
+    global _writer_thread
+    with _writer_lock:
+        thread = _writer_thread
+        if thread is None:
+            return
+        if thread.is_alive():
+            _write_queue.put(_STOP_WRITER)
+            thread.join()
+        _writer_thread = None
+
+# --- Schema Migrations ---
+# Ordered (version, function) pairs. PRAGMA user_version stores the last applied
+# version, so init_db() only runs the migrations a database is missing.
+def _migration_001_initial_tables(conn):
+    """Base tables. Uses IF NOT EXISTS so databases created before versioning adopt it."""
     cursor = conn.cursor()
     # Create users table
     cursor.execute('''
@@ -54,40 +279,284 @@ def init_db():
         gemini_response TEXT, processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (user_id) REFERENCES users (user_id)
     )''')
-    conn.commit()
-    conn.close()
+
+def _migration_002_hot_query_indexes(conn):
+    """
+    Composite indexes for the per-user lookups that are sorted by time. The time
+    indexes are ascending: SQLite walks them backwards for ORDER BY ... DESC, and
+    because the rowid is the implicit last column they also serve the (timestamp, id)
+    keyset order used for pagination without a sort step.
+    """
+    cursor = conn.cursor()
+    # get_user_message_history, find_form_response_id, get_db_user_messages, get_user_data_summary
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_messages_user_ts ON user_messages (user_id, timestamp)")
+    # get_user_message_history filtered by message_type
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_messages_user_type_ts ON user_messages (user_id, message_type, timestamp)")
+    # get_db_user_interactions
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_interactions_user_ts ON user_interactions (user_id, timestamp)")
+    # get_db_interaction_stats and the interaction counts (covering index for GROUP BY action_type)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_interactions_user_action ON user_interactions (user_id, action_type)")
+    # get_db_image_processing_results
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_results_user_processed ON image_processing_results (user_id, processed_at)")
+
+def _migration_003_counter_tables(conn):
+    """
+    Trigger-maintained counters so listings, summaries and /health don't COUNT(*) whole tables:
+    user_stats (per user), user_action_stats (per user and action_type) and global_stats (one row).
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY, message_count INTEGER NOT NULL DEFAULT 0,
+        interaction_count INTEGER NOT NULL DEFAULT 0, last_activity TIMESTAMP
+    )''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_action_stats (
+        user_id INTEGER NOT NULL, action_type TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, action_type)
+    )''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS global_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1), user_count INTEGER NOT NULL DEFAULT 0,
+        message_count INTEGER NOT NULL DEFAULT 0, interaction_count INTEGER NOT NULL DEFAULT 0
+    )''')
+
+    # Backfill from existing rows
+    cursor.execute("DELETE FROM user_stats")
+    cursor.execute("DELETE FROM user_action_stats")
+    cursor.execute("DELETE FROM global_stats")
+    cursor.execute("""
+    INSERT INTO user_stats (user_id, message_count, interaction_count, last_activity)
+    SELECT user_id, SUM(messages), SUM(interactions), MAX(last_ts) FROM (
+        SELECT user_id, COUNT(*) AS messages, 0 AS interactions, MAX(timestamp) AS last_ts FROM user_messages GROUP BY user_id
+        UNION ALL
+        SELECT user_id, 0, COUNT(*), MAX(timestamp) FROM user_interactions GROUP BY user_id
+    ) WHERE user_id IS NOT NULL GROUP BY user_id
+    """)
+    cursor.execute("""
+    INSERT INTO user_action_stats (user_id, action_type, count)
+    SELECT user_id, COALESCE(action_type, ''), COUNT(*) FROM user_interactions
+    WHERE user_id IS NOT NULL GROUP BY user_id, COALESCE(action_type, '')
+    """)
+    cursor.execute("""
+    INSERT INTO global_stats (id, user_count, message_count, interaction_count) VALUES (1,
+        (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM user_messages), (SELECT COUNT(*) FROM user_interactions))
+    """)
+
+    # Keep the counters in step with every insert and delete
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_insert_stats AFTER INSERT ON users BEGIN
+        UPDATE global_stats SET user_count = user_count + 1 WHERE id = 1;
+    END""")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_delete_stats AFTER DELETE ON users BEGIN
+        UPDATE global_stats SET user_count = user_count - 1 WHERE id = 1;
+        DELETE FROM user_stats WHERE user_id = OLD.user_id;
+        DELETE FROM user_action_stats WHERE user_id = OLD.user_id;
+    END""")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_messages_insert_stats AFTER INSERT ON user_messages BEGIN
+        UPDATE global_stats SET message_count = message_count + 1 WHERE id = 1;
+        INSERT INTO user_stats (user_id, message_count, last_activity) VALUES (NEW.user_id, 1, NEW.timestamp)
+        ON CONFLICT (user_id) DO UPDATE SET message_count = message_count + 1,
+            last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity);
+    END""")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_messages_delete_stats AFTER DELETE ON user_messages BEGIN
+        UPDATE global_stats SET message_count = message_count - 1 WHERE id = 1;
+        UPDATE user_stats SET message_count = message_count - 1 WHERE user_id = OLD.user_id;
+    END""")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_interactions_insert_stats AFTER INSERT ON user_interactions BEGIN
+        UPDATE global_stats SET interaction_count = interaction_count + 1 WHERE id = 1;
+        INSERT INTO user_stats (user_id, interaction_count, last_activity) VALUES (NEW.user_id, 1, NEW.timestamp)
+        ON CONFLICT (user_id) DO UPDATE SET interaction_count = interaction_count + 1,
+            last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity);
+        INSERT INTO user_action_stats (user_id, action_type, count) VALUES (NEW.user_id, COALESCE(NEW.action_type, ''), 1)
+        ON CONFLICT (user_id, action_type) DO UPDATE SET count = count + 1;
+    END""")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_interactions_delete_stats AFTER DELETE ON user_interactions BEGIN
+        UPDATE global_stats SET interaction_count = interaction_count - 1 WHERE id = 1;
+        UPDATE user_stats SET interaction_count = interaction_count - 1 WHERE user_id = OLD.user_id;
+        UPDATE user_action_stats SET count = count - 1 WHERE user_id = OLD.user_id AND action_type = COALESCE(OLD.action_type, '');
+    END""")
+
+def _migration_004_keyset_indexes(conn):
+    """Index for the user listing, which pages on (created_at, user_id): both never change (user_id is the rowid)."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)")
+
+def _migration_005_pending_deletions(conn):
+    """Queue of users whose data the background reaper is deleting, with running totals so a restart resumes."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS pending_deletions (
+        user_id INTEGER PRIMARY KEY, chat_id INTEGER, message_id INTEGER,
+        requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        messages_deleted INTEGER NOT NULL DEFAULT 0, interactions_deleted INTEGER NOT NULL DEFAULT 0,
+        images_deleted INTEGER NOT NULL DEFAULT 0
+    )''')
+
+def _migration_006_form_response_mirror(conn):
+    """Local mirror of Google Form responses, with indexed answer fields for point lookups."""
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS form_responses (
+        form_id TEXT NOT NULL, response_id TEXT NOT NULL, last_submitted_time TEXT,
+        answers_json TEXT, response_json TEXT,
+        PRIMARY KEY (form_id, response_id)
+    )''')
+    # The primary key doubles as the (form_id, field, value) lookup index
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS form_response_fields (
+        form_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, response_id TEXT NOT NULL,
+        PRIMARY KEY (form_id, field, value, response_id)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_form_response_fields_response ON form_response_fields (form_id, response_id)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS form_sync_state (
+        form_id TEXT PRIMARY KEY, last_submitted_time TEXT, synced_at TIMESTAMP
+    )''')
+
+def _migration_007_image_result_cache(conn):
+    """Content hash, prompt version and raw Gemini response on image results, so they double as a result cache."""
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE image_processing_results ADD COLUMN image_sha256 TEXT")
+    cursor.execute("ALTER TABLE image_processing_results ADD COLUMN prompt_version TEXT")
+    cursor.execute("ALTER TABLE image_processing_results ADD COLUMN gemini_raw_response TEXT")
+    # Partial: only rows still holding a cache entry are indexed
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_image_results_cache ON image_processing_results (image_sha256, prompt_version)
+    WHERE image_sha256 IS NOT NULL
+    """)
+
+def _migration_008_user_sessions(conn):
+    """Conversation state per user for the sqlite session store; last_seen (unix time) drives idle expiry."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, data_json TEXT NOT NULL DEFAULT '{}',
+        last_seen REAL NOT NULL
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_last_seen ON user_sessions (last_seen)")
+
+def _migration_009_history_versions(conn):
+    """
+    History version per user, so every process can tell when its cached analysis
+    context is stale. Editing or deleting a message bumps the global counter and
+    stamps it on the user's row; new user_stats rows take the current value, so a
+    deleted and re-created user never matches a version cached before the delete.
+    """
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE user_stats ADD COLUMN history_version INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE global_stats ADD COLUMN history_version INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_stats_insert_history_version AFTER INSERT ON user_stats BEGIN
+        UPDATE user_stats SET history_version = (SELECT history_version FROM global_stats WHERE id = 1) WHERE user_id = NEW.user_id;
+    END""")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_messages_update_history_version AFTER UPDATE OF message_text ON user_messages
+    WHEN OLD.message_text IS NOT NEW.message_text BEGIN
+        UPDATE global_stats SET history_version = history_version + 1 WHERE id = 1;
+        UPDATE user_stats SET history_version = (SELECT history_version FROM global_stats WHERE id = 1) WHERE user_id = NEW.user_id;
+    END""")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_messages_delete_history_version AFTER DELETE ON user_messages BEGIN
+        UPDATE global_stats SET history_version = history_version + 1 WHERE id = 1;
+        UPDATE user_stats SET history_version = (SELECT history_version FROM global_stats WHERE id = 1) WHERE user_id = OLD.user_id;
+    END""")
+
+MIGRATIONS = [
+    (1, _migration_001_initial_tables),
+    (2, _migration_002_hot_query_indexes),
+    (3, _migration_003_counter_tables),
+    (4, _migration_004_keyset_indexes),
+    (5, _migration_005_pending_deletions),
+    (6, _migration_006_form_response_mirror),
+    (7, _migration_007_image_result_cache),
+    (8, _migration_008_user_sessions),
+    (9, _migration_009_history_versions),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version():
+    """Return the schema version recorded in the database (0 for a fresh file)."""
+    with db_connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _set_journal_mode(conn):
+    # Must run outside a transaction; the mode is stored in the database file.
+    requested = config.DB_JOURNAL_MODE
+    actual = conn.execute(f"PRAGMA journal_mode = {requested}").fetchone()[0].upper()
+    if actual != requested:
+        logger.warning(s.WARN_DB_JOURNAL_MODE_NOT_APPLIED.format(requested=requested, actual=actual))
+    else:
+        logger.info(s.LOG_DB_JOURNAL_MODE.format(mode=actual))
+
+def init_db():
+    """Initialize the SQLite database: set the journal mode and apply pending migrations"""
+    conn = get_connection()
+    _set_journal_mode(conn)
+    current_version = get_schema_version()
+    if current_version > SCHEMA_VERSION:
+        raise RuntimeError(s.ERROR_DB_SCHEMA_TOO_NEW.format(version=current_version, latest=SCHEMA_VERSION))
+    for version, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        # Each migration and its version bump commit (or roll back) together
+        with db_connection():
+            conn.execute("BEGIN IMMEDIATE")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+        logger.info(s.LOG_DB_MIGRATION_APPLIED.format(version=version, name=migration.__name__))
+    logger.info(s.LOG_DB_SCHEMA_VERSION.format(version=get_schema_version(), latest=SCHEMA_VERSION))
     logger.info(s.LOG_DB_INIT_SUCCESS)
 
+# Recently saved profiles: (DB_PATH, user_id) -> (profile fields, monotonic time of the write).
+# Lets save_user skip updating an unchanged user written moments ago. The cache is per
+# process, so it never skips inserting a missing row (another worker may have deleted it).
+_user_touch_cache = {}
+_user_touch_lock = threading.Lock()
+_USER_TOUCH_CACHE_MAX = 10000
+
+def _forget_user_touch(user_id):
+    with _user_touch_lock:
+        _user_touch_cache.pop((DB_PATH, user_id), None)
+
 def save_user(user, chat_id=None):
-    """Save or update user information in the database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,))
-    exists = cursor.fetchone()
-    if exists:
-        if chat_id:
-            cursor.execute("""
-            UPDATE users SET username = ?, first_name = ?, last_name = ?, language_code = ?,
-                chat_id = ?, last_activity = CURRENT_TIMESTAMP WHERE user_id = ?
-            """, (user.username, user.first_name, user.last_name, user.language_code, chat_id, user.id))
+    """Save or update user information in the database (single-statement upsert)"""
+    key = (DB_PATH, user.id)
+    fields = (user.username, user.first_name, user.last_name, user.language_code, chat_id)
+    now = time.monotonic()
+    with _user_touch_lock:
+        cached = _user_touch_cache.get(key)
+        touched_recently = bool(cached and cached[0] == fields and now - cached[1] < config.DB_USER_TOUCH_SECONDS)
+    params = (user.id, user.username, user.first_name, user.last_name, user.language_code, user.is_bot, chat_id)
+    with db_connection() as conn:
+        if touched_recently:
+            # Unchanged profile written moments ago: last_activity is close enough, only recreate a missing row
+            conn.execute("""
+            INSERT INTO users (user_id, username, first_name, last_name, language_code, is_bot, chat_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id) DO NOTHING
+            """, params)
         else:
-            cursor.execute("""
-            UPDATE users SET username = ?, first_name = ?, last_name = ?, language_code = ?,
-                last_activity = CURRENT_TIMESTAMP WHERE user_id = ?
-            """, (user.username, user.first_name, user.last_name, user.language_code, user.id))
-    else:
-        cursor.execute("""
-        INSERT INTO users (user_id, username, first_name, last_name, language_code, is_bot, chat_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user.id, user.username, user.first_name, user.last_name, user.language_code, user.is_bot, chat_id))
-        cursor.execute("INSERT INTO user_preferences (user_id) VALUES (?)", (user.id,))
-    conn.commit()
-    conn.close()
+            # chat_id is only overwritten when a new one is known, matching the old UPDATE behaviour
+            conn.execute("""
+            INSERT INTO users (user_id, username, first_name, last_name, language_code, is_bot, chat_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name,
+                language_code = excluded.language_code, chat_id = COALESCE(excluded.chat_id, users.chat_id),
+                last_activity = CURRENT_TIMESTAMP
+            """, params)
+        conn.execute("INSERT INTO user_preferences (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING", (user.id,))
+    if touched_recently:
+        return
+    with _user_touch_lock:
+        if len(_user_touch_cache) >= _USER_TOUCH_CACHE_MAX:
+            _user_touch_cache.clear()
+        _user_touch_cache[key] = (fields, now)
 
 def log_interaction(user_id, action_type, action_data=None):
     """Log user interaction in the database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
     action_data_str = None
     if action_data is not None:
         if isinstance(action_data, str):
@@ -98,10 +567,8 @@ def log_interaction(user_id, action_type, action_data=None):
             except Exception as e:
                 logger.error(f"Error converting action_data to JSON for user {user_id}, action {action_type}: {e}")
                 action_data_str = str(action_data)
-    cursor.execute("INSERT INTO user_interactions (user_id, action_type, action_data) VALUES (?, ?, ?)",
+    _execute_write("INSERT INTO user_interactions (user_id, action_type, action_data) VALUES (?, ?, ?)",
                    (user_id, action_type, action_data_str))
-    conn.commit()
-    conn.close()
 
 def save_message(message, message_type_override=None, text_override=None):
     """Save a user message to the database, allowing overrides for type and text."""
@@ -135,14 +602,10 @@ def save_message(message, message_type_override=None, text_override=None):
     if original_content_type == s.DB_MESSAGE_TYPE_PHOTO and message.photo:
         file_id = message.photo[-1].file_id # Note: file_id is not currently saved in the schema
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    _execute_write("""
     INSERT INTO user_messages (user_id, chat_id, message_id, message_text, message_type, has_media, media_type)
     VALUES (?, ?, ?, ?, ?, ?, ?)
     """, (user_id, chat_id, message_id, final_message_text, final_message_type, has_media, media_type))
-    conn.commit()
-    conn.close()
 
     # Adjust logging based on final content
     if final_message_text:
@@ -156,14 +619,10 @@ def save_message(message, message_type_override=None, text_override=None):
 def save_processed_text(user_id, chat_id, original_message_id, text_to_save, message_type):
     """Saves processed text (like from Gemini, Forms, Sheets) to the user_messages table."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
+        _execute_write("""
         INSERT INTO user_messages (user_id, chat_id, message_id, message_text, message_type, has_media, media_type)
         VALUES (?, ?, ?, ?, ?, ?, ?)
         """, (user_id, chat_id, original_message_id, text_to_save, message_type, False, None))
-        conn.commit()
-        conn.close()
         logger.info(s.LOG_DB_SAVED_PROCESSED_TEXT.format(message_type=message_type, user_id=user_id, original_message_id=original_message_id))
     except Exception as db_err:
         logger.error(s.ERROR_DB_SAVING_PROCESSED_TEXT.format(message_type=message_type, user_id=user_id, db_err=db_err), exc_info=True)
@@ -171,217 +630,583 @@ def save_processed_text(user_id, chat_id, original_message_id, text_to_save, mes
 
 def get_user_preferences(user_id):
     """Get user preferences from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM user_preferences WHERE user_id = ?", (user_id,))
-    prefs = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        prefs = conn.execute("SELECT * FROM user_preferences WHERE user_id = ?", (user_id,)).fetchone()
     if prefs:
         return dict(prefs)
     else:
         return {'user_id': user_id, 'language': s.DB_DEFAULT_LANGUAGE, 'notifications': True, 'theme': s.DB_DEFAULT_THEME}
 
+PREFERENCE_COLUMNS = ('language', 'notifications', 'theme')
+
 def update_user_preference(user_id, preference_name, preference_value):
-    """Update a specific user preference"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM user_preferences WHERE user_id = ?", (user_id,))
-    exists = cursor.fetchone()
-    if exists:
-        cursor.execute(f"UPDATE user_preferences SET {preference_name} = ?, last_updated = CURRENT_TIMESTAMP WHERE user_id = ?",
-                       (preference_value, user_id))
-    else:
-        defaults = {'language': 'en', 'notifications': True, 'theme': 'default'}
-        defaults[preference_name] = preference_value
-        cursor.execute("INSERT INTO user_preferences (user_id, language, notifications, theme) VALUES (?, ?, ?, ?)",
-                       (user_id, defaults['language'], defaults['notifications'], defaults['theme']))
-    conn.commit()
-    conn.close()
+    """Update a specific user preference, creating the preferences row with defaults if needed"""
+    if preference_name not in PREFERENCE_COLUMNS: # Column name is interpolated into the SQL below
+        raise ValueError(s.ERROR_INVALID_PREFERENCE_NAME.format(valid_prefs=list(PREFERENCE_COLUMNS)))
+    with db_connection() as conn:
+        conn.execute(f"""
+        INSERT INTO user_preferences (user_id, {preference_name}) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET {preference_name} = excluded.{preference_name}, last_updated = CURRENT_TIMESTAMP
+        """, (user_id, preference_value))
     return True
 
+# --- Session Store (SESSION_BACKEND=sqlite) ---
+def get_session(user_id, min_last_seen, last_seen):
+    """
+    The user's session row (state, data_json) unless it was last seen before
+    min_last_seen; reading it counts as activity, so last_seen is moved to last_seen.
+    """
+    with db_connection() as conn:
+        touched = conn.execute("UPDATE user_sessions SET last_seen = ? WHERE user_id = ? AND last_seen >= ?",
+                               (last_seen, user_id, min_last_seen)).rowcount
+        if not touched:
+            return None
+        row = conn.execute("SELECT state, data_json FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+    return dict(row)
+
+def save_session(user_id, state, data_json, last_seen):
+    with db_connection() as conn:
+        conn.execute("""
+        INSERT INTO user_sessions (user_id, state, data_json, last_seen) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, data_json = excluded.data_json, last_seen = excluded.last_seen
+        """, (user_id, state, data_json, last_seen))
+
+def delete_session(user_id):
+    with db_connection() as conn:
+        conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+
+def get_session_states(min_last_seen, limit=1000):
+    """(user_id, state) of sessions seen since min_last_seen, most recent first."""
+    with db_connection() as conn:
+        rows = conn.execute("SELECT user_id, state FROM user_sessions WHERE last_seen >= ? ORDER BY last_seen DESC LIMIT ?",
+                            (min_last_seen, limit)).fetchall()
+    return [(row['user_id'], row['state']) for row in rows]
+
+def count_sessions(min_last_seen):
+    with db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM user_sessions WHERE last_seen >= ?", (min_last_seen,)).fetchone()[0]
+
+def purge_expired_sessions(min_last_seen):
+    """Delete sessions last seen before min_last_seen. Returns how many were deleted."""
+    with db_connection() as conn:
+        return conn.execute("DELETE FROM user_sessions WHERE last_seen < ?", (min_last_seen,)).rowcount
+
 def get_user_data_summary(user_id):
-    """Get a summary of all data stored for a user"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    """Get a summary of all data stored for a user in a single query"""
+    with db_connection() as conn:
+        row = conn.execute("""
+        SELECT u.*, p.language, p.notifications, p.theme,
+            COALESCE(st.message_count, 0) AS summary_message_count,
+            COALESCE(st.interaction_count, 0) AS summary_interaction_count,
+            (SELECT json_group_array(json_object('action_type', action_type, 'count', count)) FROM (
+                SELECT action_type, count FROM user_action_stats
+                WHERE user_id = :user_id AND count > 0 ORDER BY count DESC
+            )) AS summary_interaction_types,
+            (SELECT json_group_array(json_object('message_text', message_text, 'timestamp', timestamp)) FROM (
+                SELECT message_text, timestamp FROM user_messages
+                WHERE user_id = :user_id ORDER BY timestamp DESC LIMIT 20
+            )) AS summary_recent_messages
+        FROM users u LEFT JOIN user_preferences p ON u.user_id = p.user_id
+        LEFT JOIN user_stats st ON u.user_id = st.user_id WHERE u.user_id = :user_id
+        """, {'user_id': user_id}).fetchone()
     summary = {}
-    cursor.execute("""
-    SELECT u.*, p.language, p.notifications, p.theme FROM users u
-    LEFT JOIN user_preferences p ON u.user_id = p.user_id WHERE u.user_id = ?
-    """, (user_id,))
-    user = cursor.fetchone()
-    if user:
-        summary['profile'] = dict(user)
-        cursor.execute("SELECT COUNT(*) as count FROM user_messages WHERE user_id = ?", (user_id,))
-        message_count = cursor.fetchone()
-        summary['message_count'] = message_count['count'] if message_count else 0
-        cursor.execute("SELECT COUNT(*) as count FROM user_interactions WHERE user_id = ?", (user_id,))
-        interaction_count = cursor.fetchone()
-        summary['interaction_count'] = interaction_count['count'] if interaction_count else 0
-        cursor.execute("SELECT action_type, COUNT(*) as count FROM user_interactions WHERE user_id = ? GROUP BY action_type ORDER BY count DESC", (user_id,))
-        summary['interaction_types'] = [dict(row) for row in cursor.fetchall()]
-        cursor.execute("SELECT message_text, timestamp FROM user_messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT 20", (user_id,))
-        summary['recent_messages'] = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    if row:
+        profile = dict(row)
+        message_count = profile.pop('summary_message_count')
+        interaction_count = profile.pop('summary_interaction_count')
+        interaction_types = json.loads(profile.pop('summary_interaction_types'))
+        recent_messages = json.loads(profile.pop('summary_recent_messages'))
+        summary['profile'] = profile
+        summary['message_count'] = message_count
+        summary['interaction_count'] = interaction_count
+        summary['interaction_types'] = interaction_types
+        summary['recent_messages'] = recent_messages
     return summary
 
+# Child tables emptied by the batched delete, with the pending_deletions column tracking each
+_DELETE_TABLES = (
+    ('image_processing_results', 'images_deleted'),
+    ('user_messages', 'messages_deleted'),
+    ('user_interactions', 'interactions_deleted'),
+)
+
+def delete_user_data_batch(user_id, batch_rows=None):
+    """
+    Delete up to batch_rows of a user's rows in one short transaction. Once no
+    messages, interactions or image results are left, the preferences, profile and
+    pending_deletions rows go too. Returns (messages, interactions, images, done).
+    """
+    batch_rows = batch_rows or config.DB_DELETE_BATCH_ROWS
+    remaining = batch_rows
+    counts = dict.fromkeys((column for _, column in _DELETE_TABLES), 0)
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for table, column in _DELETE_TABLES:
+            cursor = conn.execute(f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE user_id = ? LIMIT ?)",
+                                  (user_id, remaining))
+            counts[column] = cursor.rowcount
+            remaining -= cursor.rowcount
+            if remaining <= 0:
+                break
+        done = remaining > 0 # The batch wasn't filled, so every table is empty
+        if done:
+            conn.execute("DELETE FROM user_preferences WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM pending_deletions WHERE user_id = ?", (user_id,))
+        else:
+            conn.execute("""
+            UPDATE pending_deletions SET messages_deleted = messages_deleted + :messages_deleted,
+                interactions_deleted = interactions_deleted + :interactions_deleted, images_deleted = images_deleted + :images_deleted
+            WHERE user_id = :user_id
+            """, {**counts, 'user_id': user_id})
+    if done:
+        _forget_user_touch(user_id)
+    return counts['messages_deleted'], counts['interactions_deleted'], counts['images_deleted'], done
+
 def delete_user_data(user_id):
-    """Delete all data associated with a user from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    """Delete all data associated with a user from the database, in short batched transactions"""
     messages_deleted, interactions_deleted = 0, 0
     try:
-        cursor.execute("BEGIN TRANSACTION")
-        cursor.execute("DELETE FROM image_processing_results WHERE user_id = ?", (user_id,)) # Also delete image results
-        cursor.execute("DELETE FROM user_messages WHERE user_id = ?", (user_id,))
-        messages_deleted = cursor.rowcount
-        cursor.execute("DELETE FROM user_interactions WHERE user_id = ?", (user_id,))
-        interactions_deleted = cursor.rowcount
-        cursor.execute("DELETE FROM user_preferences WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        conn.commit()
+        flush_pending_writes() # Queued inserts for this user must not land after the delete
+        done = False
+        while not done:
+            msgs, ints, _, done = delete_user_data_batch(user_id)
+            messages_deleted += msgs
+            interactions_deleted += ints
         logger.info(s.LOG_DB_DELETED_USER_DATA.format(user_id=user_id, messages_deleted=messages_deleted, interactions_deleted=interactions_deleted))
         return True, messages_deleted, interactions_deleted
     except Exception as e:
-        conn.rollback()
         logger.error(s.ERROR_DB_DELETING_USER_DATA.format(error=str(e)))
         return False, 0, 0
-    finally:
-        conn.close()
+
+# --- Background Deletion ---
+# "Delete my data" only marks the user in pending_deletions; a daemon reaper thread
+# then deletes in batches and reports progress through a callback:
+#   report(user_id, chat_id, message_id, messages_deleted, interactions_deleted, done)
+_reaper_thread = None
+_reaper_lock = threading.Lock()
+_reaper_wakeup = threading.Event()
+_reaper_stop = threading.Event()
+
+def mark_user_for_deletion(user_id, chat_id=None, message_id=None):
+    """Queue a user's data for the deletion reaper. Returns False if a deletion is already pending."""
+    with db_connection() as conn:
+        cursor = conn.execute("""
+        INSERT INTO pending_deletions (user_id, chat_id, message_id) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO NOTHING
+        """, (user_id, chat_id, message_id))
+        queued = cursor.rowcount == 1
+    if queued:
+        logger.info(s.LOG_DB_USER_DELETION_QUEUED.format(user_id=user_id, chat_id=chat_id))
+        _reaper_wakeup.set()
+    return queued
+
+def is_user_pending_deletion(user_id):
+    with db_connection() as conn:
+        return conn.execute("SELECT 1 FROM pending_deletions WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+def get_pending_deletions():
+    """Pending deletions, oldest request first"""
+    with db_connection() as conn:
+        cursor = conn.execute("SELECT * FROM pending_deletions ORDER BY requested_at, user_id")
+        return [dict(row) for row in cursor.fetchall()]
+
+def _report_deletion(report, job, totals, done):
+    if report is None:
+        return
+    try:
+        report(job['user_id'], job['chat_id'], job['message_id'], totals['messages_deleted'], totals['interactions_deleted'], done)
+    except Exception as e:
+        logger.error(s.ERROR_DB_DELETION_REPORT_FAILED.format(user_id=job['user_id'], error=e), exc_info=True)
+
+def _reap_user(job, report):
+    """Delete one pending user batch by batch. Returns False if stopped before finishing."""
+    user_id = job['user_id']
+    totals = {key: job[key] for key in ('messages_deleted', 'interactions_deleted', 'images_deleted')} # Resume after a restart
+    last_report = time.monotonic()
+    while not _reaper_stop.is_set():
+        flush_pending_writes() # Queued inserts for this user must not land after the delete
+        msgs, ints, imgs, done = delete_user_data_batch(user_id)
+        totals['messages_deleted'] += msgs
+        totals['interactions_deleted'] += ints
+        totals['images_deleted'] += imgs
+        if done:
+            logger.info(s.LOG_DB_DELETED_USER_DATA.format(user_id=user_id, messages_deleted=totals['messages_deleted'],
+                                                           interactions_deleted=totals['interactions_deleted']))
+            _report_deletion(report, job, totals, True)
+            return True
+        if time.monotonic() - last_report >= config.DB_DELETE_PROGRESS_SECONDS:
+            logger.info(s.LOG_DB_USER_DELETION_PROGRESS.format(user_id=user_id, **totals))
+            _report_deletion(report, job, totals, False)
+            last_report = time.monotonic()
+        _reaper_stop.wait(config.DB_DELETE_BATCH_PAUSE_MS / 1000) # Let other writers take the lock
+    return False
+
+def _reaper_loop(report):
+    while not _reaper_stop.is_set():
+        _reaper_wakeup.clear()
+        failed = False
+        try:
+            jobs = get_pending_deletions()
+        except Exception as e:
+            logger.error(s.ERROR_DB_DELETING_USER_DATA.format(error=str(e)), exc_info=True)
+            jobs, failed = [], True
+        for job in jobs:
+            if _reaper_stop.is_set():
+                break
+            try:
+                _reap_user(job, report)
+            except Exception as e: # Left in pending_deletions and retried later
+                logger.error(s.ERROR_DB_DELETING_USER_DATA.format(error=str(e)), exc_info=True)
+                failed = True
+        if jobs and not failed:
+            continue # More requests may have arrived meanwhile
+        _reaper_wakeup.wait(config.DB_DELETE_RETRY_SECONDS)
+    close_connection()
+
+def start_deletion_reaper(report=None):
+    """Start the background thread that works through pending_deletions (also resumes ones left by a restart)."""
+    global _reaper_thread
+    with _reaper_lock:
+        if _reaper_thread is not None and _reaper_thread.is_alive():
+            return
+        _reaper_stop.clear()
+        _reaper_thread = threading.Thread(target=_reaper_loop, args=(report,), name="db-deletion-reaper", daemon=True)
+        _reaper_thread.start()
+    logger.info(s.LOG_DB_DELETION_REAPER_STARTED.format(batch_rows=config.DB_DELETE_BATCH_ROWS, pause_ms=config.DB_DELETE_BATCH_PAUSE_MS))
+
+def stop_deletion_reaper():
+    """Stop the reaper after its current batch; unfinished deletions resume on the next start."""
+    global _reaper_thread
+    with _reaper_lock:
+        thread = _reaper_thread
+        if thread is None:
+            return
+        _reaper_stop.set()
+        _reaper_wakeup.set()
+        thread.join()
+        _reaper_thread = None
+    logger.info(s.LOG_DB_DELETION_REAPER_STOPPED)
 
 def get_user_message_history(user_id, include_text=False, limit=20):
     """Get the message history for a specific user"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    if include_text:   
-        cursor.execute("""
-        SELECT message_text, timestamp FROM user_messages
-        WHERE user_id = ? AND message_text IS NOT NULL AND message_text != '' AND message_text != '/start'
-        AND (message_type = ? OR message_type = ? OR message_type = ? OR message_type = ? OR message_type = ?) -- Added data_entry type
-        ORDER BY timestamp DESC LIMIT ?
-        """, (user_id, s.DB_MESSAGE_TYPE_TEXT, s.DB_MESSAGE_TYPE_PROCESSED_IMAGE, s.DB_MESSAGE_TYPE_RETRIEVED_SHEET, s.DB_MESSAGE_TYPE_RETRIEVED_FORM, s.DB_MESSAGE_TYPE_DATA_ENTRY, limit)) # Added data_entry constant
-    else:
-        cursor.execute("""
-        SELECT message_text, timestamp FROM user_messages
-        WHERE user_id = ? AND message_text IS NOT NULL AND message_text != '' AND message_text != '/start'
-        AND (message_type = ? OR message_type = ? OR message_type = ? OR message_type = ?) -- Added data_entry type
-        ORDER BY timestamp DESC LIMIT ?
-        """, (user_id, s.DB_MESSAGE_TYPE_PROCESSED_IMAGE, s.DB_MESSAGE_TYPE_RETRIEVED_SHEET, s.DB_MESSAGE_TYPE_RETRIEVED_FORM, s.DB_MESSAGE_TYPE_DATA_ENTRY, limit)) # Added data_entry constant
- 
-    messages = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if include_text:   
+            cursor.execute("""
+            SELECT message_text, timestamp FROM user_messages
+            WHERE user_id = ? AND message_text IS NOT NULL AND message_text != '' AND message_text != '/start'
+            AND (message_type = ? OR message_type = ? OR message_type = ? OR message_type = ? OR message_type = ?) -- Added data_entry type
+            ORDER BY timestamp DESC LIMIT ?
+            """, (user_id, s.DB_MESSAGE_TYPE_TEXT, s.DB_MESSAGE_TYPE_PROCESSED_IMAGE, s.DB_MESSAGE_TYPE_RETRIEVED_SHEET, s.DB_MESSAGE_TYPE_RETRIEVED_FORM, s.DB_MESSAGE_TYPE_DATA_ENTRY, limit)) # Added data_entry constant
+        else:
+            cursor.execute("""
+            SELECT message_text, timestamp FROM user_messages
+            WHERE user_id = ? AND message_text IS NOT NULL AND message_text != '' AND message_text != '/start'
+            AND (message_type = ? OR message_type = ? OR message_type = ? OR message_type = ?) -- Added data_entry type
+            ORDER BY timestamp DESC LIMIT ?
+            """, (user_id, s.DB_MESSAGE_TYPE_PROCESSED_IMAGE, s.DB_MESSAGE_TYPE_RETRIEVED_SHEET, s.DB_MESSAGE_TYPE_RETRIEVED_FORM, s.DB_MESSAGE_TYPE_DATA_ENTRY, limit)) # Added data_entry constant
+     
+        messages = [dict(row) for row in cursor.fetchall()]
     logger.info(s.LOG_DB_RETRIEVED_HISTORY.format(count=len(messages), user_id=user_id))
     return messages
 
-def save_image_processing_result(user_id, message_id, file_id, gemini_response_json):
-    """Save the Gemini API response (as JSON string) to the database"""
+def get_user_history_version(user_id):
+    """Changes whenever one of the user's messages is edited or deleted; None if they have no counters row."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT history_version FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def get_user_text_history_since(user_id, after_id=0, limit=200):
+    """
+    Analysable history rows (the include_text=True types) with id > after_id, oldest
+    first, as dicts with id, chat_id, message_id, message_type, message_text and
+    timestamp. At most the newest `limit` rows are returned, so a first call with
+    after_id=0 stays bounded.
+    """
+    with db_connection() as conn:
+        rows = conn.execute("""
+        SELECT id, chat_id, message_id, message_type, message_text, timestamp FROM user_messages
+        WHERE user_id = ? AND id > ? AND message_text IS NOT NULL AND message_text != '' AND message_text != '/start'
+        AND message_type IN (?, ?, ?, ?, ?)
+        ORDER BY id DESC LIMIT ?
+        """, (user_id, after_id, s.DB_MESSAGE_TYPE_TEXT, s.DB_MESSAGE_TYPE_PROCESSED_IMAGE, s.DB_MESSAGE_TYPE_RETRIEVED_SHEET,
+              s.DB_MESSAGE_TYPE_RETRIEVED_FORM, s.DB_MESSAGE_TYPE_DATA_ENTRY, limit)).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+_image_cache_saves = 0 # Saves since the last eviction pass
+_image_cache_lock = threading.Lock()
+
+def save_image_processing_result(user_id, message_id, file_id, gemini_response_json, image_sha256=None, prompt_version=None, raw_response=None):
+    """
+    Save the Gemini API response (as JSON string) to the database. With image_sha256,
+    prompt_version and the raw response (parsed JSON) the row also serves as a result
+    cache entry for get_cached_image_result.
+    """
+    global _image_cache_saves
     logger.info(s.LOG_DB_INITIATING_IMAGE_RESULT_STORAGE.format(user_id=user_id, message_id=message_id))
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
-        INSERT INTO image_processing_results (user_id, message_id, file_id, gemini_response)
-        VALUES (?, ?, ?, ?)
-        """, (user_id, message_id, file_id, gemini_response_json))
-        record_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        raw_json = json.dumps(raw_response, ensure_ascii=False) if image_sha256 and raw_response is not None else None
+        with db_connection() as conn:
+            cursor = conn.execute("""
+            INSERT INTO image_processing_results (user_id, message_id, file_id, gemini_response, image_sha256, prompt_version, gemini_raw_response)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, message_id, file_id, gemini_response_json, image_sha256 if raw_json else None, prompt_version if raw_json else None, raw_json))
+            record_id = cursor.lastrowid
         logger.info(s.LOG_DB_IMAGE_RESULT_STORED.format(record_id=record_id))
+        if raw_json:
+            with _image_cache_lock:
+                _image_cache_saves += 1
+                evict_now = _image_cache_saves >= config.IMAGE_CACHE_EVICT_EVERY
+                if evict_now:
+                    _image_cache_saves = 0
+            if evict_now:
+                evict_image_cache()
         return True
     except Exception as e:
         logger.error(s.ERROR_DB_SAVING_IMAGE_RESULT.format(error=str(e)), exc_info=True)
         return False
 
+def get_cached_image_result(image_sha256, prompt_version):
+    """Return the raw Gemini response (parsed JSON) stored for this image and prompt version, or None"""
+    with db_connection() as conn:
+        row = conn.execute("""
+        SELECT gemini_raw_response FROM image_processing_results
+        WHERE image_sha256 = ? AND prompt_version = ?
+        ORDER BY id DESC LIMIT 1
+        """, (image_sha256, prompt_version)).fetchone()
+    return json.loads(row['gemini_raw_response']) if row else None
+
+def evict_image_cache(max_entries=None, max_age_days=None):
+    """
+    Drop cache entries older than max_age_days and beyond the newest max_entries.
+    Only the cache columns are cleared; the results stay in the user's history.
+    """
+    max_entries = config.IMAGE_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    max_age_days = config.IMAGE_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    with db_connection() as conn:
+        cursor = conn.execute("""
+        UPDATE image_processing_results SET image_sha256 = NULL, prompt_version = NULL, gemini_raw_response = NULL
+        WHERE image_sha256 IS NOT NULL AND (
+            processed_at < datetime('now', ?)
+            OR id <= (SELECT id FROM image_processing_results WHERE image_sha256 IS NOT NULL ORDER BY id DESC LIMIT 1 OFFSET ?)
+        )
+        """, (f"-{max_age_days} days", max_entries))
+        evicted = cursor.rowcount
+    if evicted:
+        logger.info(s.LOG_DB_IMAGE_CACHE_EVICTED.format(count=evicted, max_entries=max_entries, max_age_days=max_age_days))
+    return evicted
+
 def find_form_response_id(user_id, search_limit=20):
     """Search recent user messages for the form=ID pattern."""
     logger.info(s.LOG_DB_SEARCHING_FORM_ID.format(search_limit=search_limit, user_id=user_id))
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT message_text FROM user_messages
-        WHERE user_id = ? AND message_text IS NOT NULL ORDER BY timestamp DESC LIMIT ?
-    """, (user_id, search_limit))
+    with db_connection() as conn:
+        rows = conn.execute("""
+            SELECT message_text FROM user_messages
+            WHERE user_id = ? AND message_text IS NOT NULL ORDER BY timestamp DESC LIMIT ?
+        """, (user_id, search_limit)).fetchall()
     response_id = None
     pattern = re.compile(r"form=(\d+)", re.IGNORECASE)
-    for row in cursor.fetchall():
+    for row in rows:
         message_text = row[0]
         match = pattern.search(message_text)
         if match:
             response_id = match.group(1)
             logger.info(s.LOG_DB_FOUND_FORM_ID.format(response_id=response_id, message_text=message_text))
             break
-    conn.close()
     if not response_id:
         logger.warning(s.WARN_DB_FORM_ID_NOT_FOUND.format(user_id=user_id))
     return response_id
 
 # --- Functions for viewing data via Flask routes ---
-def get_all_db_users():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT u.user_id, u.username, u.first_name, u.last_name, u.chat_id, u.created_at, u.last_activity,
-           p.language, p.notifications, p.theme,
-           (SELECT COUNT(*) FROM user_interactions WHERE user_id = u.user_id) as interaction_count
-    FROM users u LEFT JOIN user_preferences p ON u.user_id = p.user_id ORDER BY u.last_activity DESC
-    """)
-    users = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return users
+# Listings use keyset pagination: rows are ordered by (sort value, id) descending and
+# the opaque cursor holds the last row's pair, so each page is an index range scan
+# no matter how deep the caller pages (no OFFSET).
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor, size):
+    """Decode a cursor from _encode_cursor; raises ValueError for anything malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception as e:
+        raise ValueError(s.ERROR_INVALID_PAGE_CURSOR) from e
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError(s.ERROR_INVALID_PAGE_CURSOR)
+    return values
+
+def _keyset_page(select_sql, where_sql, params, sort_columns, limit, cursor):
+    """
+    Run select_sql with an optional WHERE, ordered by sort_columns descending.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    conditions = [where_sql] if where_sql else []
+    params = tuple(params)
+    if cursor:
+        conditions.append(f"({', '.join(sort_columns)}) < ({', '.join('?' for _ in sort_columns)})")
+        params += tuple(_decode_cursor(cursor, len(sort_columns)))
+    sql = select_sql
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + ", ".join(f"{column} DESC" for column in sort_columns) + " LIMIT ?"
+    with db_connection() as conn:
+        rows = [dict(row) for row in conn.execute(sql, params + (limit + 1,))] # One extra row tells us if more exist
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor([rows[-1][column.split('.')[-1]] for column in sort_columns])
+    return rows, next_cursor
+
+def get_all_db_users_page(limit=100, cursor=None):
+    """Users, newest first. Pages on the immutable (created_at, user_id) so activity during paging can't skip or repeat anyone."""
+    return _keyset_page("""
+        SELECT u.user_id, u.username, u.first_name, u.last_name, u.chat_id, u.created_at, u.last_activity,
+               p.language, p.notifications, p.theme,
+               COALESCE(st.interaction_count, 0) as interaction_count
+        FROM users u LEFT JOIN user_preferences p ON u.user_id = p.user_id
+        LEFT JOIN user_stats st ON u.user_id = st.user_id""",
+        None, (), ("u.created_at", "u.user_id"), limit, cursor)
 
 def get_db_user_details(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT u.*, p.language, p.notifications, p.theme FROM users u
-    LEFT JOIN user_preferences p ON u.user_id = p.user_id WHERE u.user_id = ?
-    """, (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        user = conn.execute("""
+        SELECT u.*, p.language, p.notifications, p.theme FROM users u
+        LEFT JOIN user_preferences p ON u.user_id = p.user_id WHERE u.user_id = ?
+        """, (user_id,)).fetchone()
     return dict(user) if user else None
 
-def get_db_image_processing_results(user_id, limit=50):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT id, message_id, file_id, processed_at FROM image_processing_results
-    WHERE user_id = ? ORDER BY processed_at DESC LIMIT ?
-    """, (user_id, limit))
-    results = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return results
+def get_db_user_stats(user_id):
+    """Return the maintained message/interaction counters for one user."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT message_count, interaction_count, last_activity FROM user_stats WHERE user_id = ?",
+                           (user_id,)).fetchone()
+    return dict(row) if row else {'message_count': 0, 'interaction_count': 0, 'last_activity': None}
 
-def get_db_user_messages(user_id, limit=100):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM user_messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?", (user_id, limit))
-    messages = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return messages
+def get_db_image_processing_results_page(user_id, limit=50, cursor=None):
+    return _keyset_page("SELECT id, message_id, file_id, processed_at FROM image_processing_results",
+                        "user_id = ?", (user_id,), ("processed_at", "id"), limit, cursor)
 
-def get_db_user_interactions(user_id, limit=100):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM user_interactions WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?", (user_id, limit))
-    interactions = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return interactions
+def get_db_image_processing_results(user_id, limit=50, cursor=None):
+    return get_db_image_processing_results_page(user_id, limit, cursor)[0]
+
+def get_db_user_messages_page(user_id, limit=100, cursor=None):
+    return _keyset_page("SELECT * FROM user_messages", "user_id = ?", (user_id,), ("timestamp", "id"), limit, cursor)
+
+def get_db_user_messages(user_id, limit=100, cursor=None):
+    return get_db_user_messages_page(user_id, limit, cursor)[0]
+
+def get_db_user_interactions_page(user_id, limit=100, cursor=None):
+    return _keyset_page("SELECT * FROM user_interactions", "user_id = ?", (user_id,), ("timestamp", "id"), limit, cursor)
+
+def get_db_user_interactions(user_id, limit=100, cursor=None):
+    return get_db_user_interactions_page(user_id, limit, cursor)[0]
 
 def get_db_interaction_stats(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT action_type, COUNT(*) as count FROM user_interactions
-    WHERE user_id = ? GROUP BY action_type ORDER BY count DESC
-    """, (user_id,))
-    stats = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return stats
+    with db_connection() as conn:
+        rows = conn.execute("""
+        SELECT action_type, count FROM user_action_stats
+        WHERE user_id = ? AND count > 0 ORDER BY count DESC
+        """, (user_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+def get_global_stats():
+    """Return total users, messages and interactions from the maintained counters (constant time)."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT user_count, message_count, interaction_count FROM global_stats WHERE id = 1").fetchone()
+    return dict(row) if row else {'user_count': 0, 'message_count': 0, 'interaction_count': 0}
+
+# --- Export ---
+# Tables included in a full-history export, with the column each one is ordered by
+EXPORT_TABLES = {
+    'user_messages': 'timestamp',
+    'user_interactions': 'timestamp',
+    'image_processing_results': 'processed_at',
+}
+
+def get_export_columns(table):
+    """Column names of an export table, in schema order."""
+    with db_connection() as conn:
+        return [row['name'] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def iter_export_rows(user_id=None, tables=tuple(EXPORT_TABLES), batch_size=500):
+    """
+    Yield (table, row dict) for every row of the given export tables, for one user or all users.
+    Uses a dedicated connection and one read transaction, so the export sees a consistent
+    snapshot and memory stays bounded by batch_size however many rows there are.
+    """
+    flush_pending_writes()
+    conn = _open_connection(DB_PATH)
+    try:
+        conn.execute("BEGIN") # Snapshot across all tables; WAL keeps writers unblocked meanwhile
+        for table in tables:
+            if user_id is None:
+                cursor = conn.execute(f"SELECT * FROM {table} ORDER BY id")
+            else: # Served by the (user_id, time) index without a sort
+                cursor = conn.execute(f"SELECT * FROM {table} WHERE user_id = ? ORDER BY {EXPORT_TABLES[table]}, id", (user_id,))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield table, dict(row)
+    finally:
+        conn.close()
+
+# --- Google Form Response Mirror ---
+def get_form_sync_state(form_id):
+    """Return {'last_submitted_time', 'synced_at', 'age_seconds'} for a mirrored form, or None if never synced"""
+    with db_connection() as conn:
+        row = conn.execute("""
+        SELECT last_submitted_time, synced_at, (julianday('now') - julianday(synced_at)) * 86400 AS age_seconds
+        FROM form_sync_state WHERE form_id = ?
+        """, (form_id,)).fetchone()
+        return dict(row) if row else None
+
+def save_form_responses(form_id, responses):
+    """
+    Upsert mirrored responses in one transaction. Each item is a dict with
+    response_id, last_submitted_time, answers (title -> value), response (raw JSON)
+    and fields, a list of (field, value) pairs to index.
+    """
+    with db_connection() as conn:
+        for item in responses:
+            conn.execute("""
+            INSERT INTO form_responses (form_id, response_id, last_submitted_time, answers_json, response_json)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(form_id, response_id) DO UPDATE SET
+                last_submitted_time = excluded.last_submitted_time, answers_json = excluded.answers_json,
+                response_json = excluded.response_json
+            """, (form_id, item['response_id'], item['last_submitted_time'],
+                  json.dumps(item['answers'], ensure_ascii=False), json.dumps(item['response'], ensure_ascii=False)))
+            conn.execute("DELETE FROM form_response_fields WHERE form_id = ? AND response_id = ?", (form_id, item['response_id']))
+            conn.executemany("INSERT OR IGNORE INTO form_response_fields (form_id, field, value, response_id) VALUES (?, ?, ?, ?)",
+                             [(form_id, field, value, item['response_id']) for field, value in item['fields']])
+
+def mark_form_synced(form_id, last_submitted_time):
+    """Record a completed sync and its watermark (the newest lastSubmittedTime seen so far)"""
+    with db_connection() as conn:
+        conn.execute("""
+        INSERT INTO form_sync_state (form_id, last_submitted_time, synced_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(form_id) DO UPDATE SET
+            last_submitted_time = COALESCE(excluded.last_submitted_time, form_sync_state.last_submitted_time),
+            synced_at = excluded.synced_at
+        """, (form_id, last_submitted_time))
+
+def clear_form_responses(form_id):
+    """Forget a form's mirror so the next sync downloads every response again"""
+    with db_connection() as conn:
+        conn.execute("DELETE FROM form_response_fields WHERE form_id = ?", (form_id,))
+        conn.execute("DELETE FROM form_responses WHERE form_id = ?", (form_id,))
+        conn.execute("DELETE FROM form_sync_state WHERE form_id = ?", (form_id,))
+
+def find_form_response(form_id, field, value):
+    """Indexed lookup of the most recent mirrored response with field == value; returns its title -> answer map or None"""
+    with db_connection() as conn:
+        row = conn.execute("""
+        SELECT r.answers_json FROM form_response_fields f
+        JOIN form_responses r ON r.form_id = f.form_id AND r.response_id = f.response_id
+        WHERE f.form_id = ? AND f.field = ? AND f.value = ?
+        ORDER BY r.last_submitted_time DESC LIMIT 1
+        """, (form_id, field, value)).fetchone()
+    return json.loads(row['answers_json']) if row else None
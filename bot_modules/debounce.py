@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+from . import strings_en
+from . import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+class _Burst:
+    def __init__(self):
+        self.items = [] # Everything received since the last completed run
+        self.generation = 0 # Bumped by every submit; a run is current while it matches
+        self.timer = None
+        self.opened = False # Set once the opener has its status message; the timer starts then
+        self.status_message_id = None
+
+class BurstDebouncer:
+    """
+    Coalesces bursts of items per key (the user id).
+
+    Each submit() restarts the key's quiet timer; once quiet_seconds pass without a
+    new item, run(key, items, status_message_id, is_current) is called with every
+    item of the burst: on the timer thread, or handed to submit(key, func, *args)
+    (e.g. FairJobQueue.submit) when given. If submit rejects it, rejected(key, items,
+    status_message_id) is called instead and the burst ends. An item arriving while
+    a run is queued or in flight supersedes it: is_current() turns False (a queued run
+    is skipped), and the next run covers the old items plus the new ones. The burst
+    (and its status message) ends when a current run returns.
+    """
+
+    def __init__(self, name, quiet_seconds, run, submit=None, rejected=None):
+        self.name = name
+        self.quiet_seconds = quiet_seconds
+        self._run = run
+        self._submit = submit
+        self._rejected = rejected
+        self._bursts = {}
+        self._lock = threading.Lock()
+
+    def status_message_id(self, key):
+        """The status message of key's open burst, or None if there is none yet."""
+        with self._lock:
+            burst = self._bursts.get(key)
+            return burst.status_message_id if burst else None
+
+    def submit(self, key, item, open_status=None):
+        """
+        Add item to key's burst and restart its quiet timer. The submit that opens a
+        burst calls open_status() (outside the lock) for the burst's status message id;
+        concurrent submits join that burst, so there is exactly one per burst.
+        """
+        with self._lock:
+            burst = self._bursts.get(key)
+            opening = burst is None
+            if opening:
+                burst = self._bursts[key] = _Burst()
+            burst.items.append(item)
+            burst.generation += 1
+            if burst.opened:
+                self._restart_timer(key, burst)
+            logger.debug(s.LOG_BURST_ITEM_QUEUED.format(name=self.name, key=key, count=len(burst.items)))
+        if not opening:
+            return
+        status_message_id = None
+        if open_status is not None:
+            try:
+                status_message_id = open_status()
+            except Exception as e: # The run sends its own status message instead
+                logger.warning(s.WARN_BURST_STATUS_FAILED.format(name=self.name, key=key, error=e))
+        with self._lock:
+            if self._bursts.get(key) is burst: # Not cancelled meanwhile
+                burst.status_message_id = status_message_id
+                burst.opened = True
+                self._restart_timer(key, burst)
+
+    def _restart_timer(self, key, burst):
+        """Caller holds _lock."""
+        if burst.timer is not None:
+            burst.timer.cancel()
+        burst.timer = threading.Timer(self.quiet_seconds, self._fire, (key, burst.generation))
+        burst.timer.daemon = True
+        burst.timer.start()
+
+    def _is_current(self, key, generation):
+        with self._lock:
+            burst = self._bursts.get(key)
+            return burst is not None and burst.generation == generation
+
+    def _end(self, key, generation):
+        with self._lock:
+            burst = self._bursts.get(key)
+            if burst is not None and burst.generation == generation:
+                del self._bursts[key]
+
+    def _fire(self, key, generation):
+        with self._lock:
+            burst = self._bursts.get(key)
+            if burst is None or burst.generation != generation:
+                return # A newer item restarted the timer
+            items, status_message_id = list(burst.items), burst.status_message_id
+        if self._submit is None:
+            self._run_burst(key, generation, items, status_message_id)
+        elif not self._submit(key, self._run_burst, key, generation, items, status_message_id):
+            self._end(key, generation)
+            if self._rejected is not None:
+                try:
+                    self._rejected(key, items, status_message_id)
+                except Exception as e:
+                    logger.error(s.ERROR_BURST_RUN_FAILED.format(name=self.name, key=key, error=e), exc_info=True)
+
+    def _run_burst(self, key, generation, items, status_message_id):
+        if not self._is_current(key, generation):
+            return # Superseded while queued; the newer run covers these items
+        logger.info(s.LOG_BURST_RUNNING.format(name=self.name, key=key, count=len(items)))
+        try:
+            self._run(key, items, status_message_id, lambda: self._is_current(key, generation))
+        except Exception as e:
+            logger.error(s.ERROR_BURST_RUN_FAILED.format(name=self.name, key=key, error=e), exc_info=True)
+        finally:
+            self._end(key, generation)
+
+    def cancel(self, key):
+        """Drop key's burst without running it; a queued or in-flight run becomes superseded."""
+        with self._lock:
+            burst = self._bursts.pop(key, None)
+            if burst is not None and burst.timer is not None:
+                burst.timer.cancel()
@@ -0,0 +1,55 @@
+import logging
+import os
+from . import config
+from .job_queue import LaneJobQueue
+from .telegram_bot import bot
+from . import strings_en
+from . import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+# Updates from the webhook and from polling are handled here rather than in the
+# request/polling thread. Each chat is hashed onto one of DISPATCH_LANES lanes, so a
+# chat's updates run one at a time in arrival order while different chats run in parallel.
+update_lanes = LaneJobQueue('updates', config.DISPATCH_LANES, config.DISPATCH_LANE_QUEUE_MAX)
+_handle_updates = bot.process_new_updates # The registered handlers; lane workers call it
+
+def update_chat_key(update):
+    """Ordering key for an update: its chat id, else the sender's id, else the update id."""
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = getattr(update, kind, None)
+        if message is not None:
+            return message.chat.id
+    callback_query = getattr(update, 'callback_query', None)
+    if callback_query is not None:
+        if callback_query.message is not None:
+            return callback_query.message.chat.id
+        return callback_query.from_user.id
+    for kind in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member'):
+        item = getattr(update, kind, None)
+        if item is not None:
+            chat = getattr(item, 'chat', None)
+            return chat.id if chat is not None else item.from_user.id
+    return f"update:{update.update_id}"
+
+def _process_update(update):
+    _handle_updates([update])
+
+def dispatch_update(update, block=False):
+    """
+    Queue an update on its chat's lane. Returns False when it was shed because the
+    lane is full; with block=True the caller waits for room instead.
+    """
+    return update_lanes.submit(update_chat_key(update), _process_update, update, block=block)
+
+def _dispatch_polled_updates(updates):
+    for update in updates:
+        dispatch_update(update, block=True) # A full lane pauses polling rather than dropping updates
+
+def enable_for_polling():
+    """Make bot.infinity_polling hand each fetched update to the lanes instead of handling it in the polling thread."""
+    bot.process_new_updates = _dispatch_polled_updates
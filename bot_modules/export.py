@@ -0,0 +1,97 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sys
+from . import database as db
+from . import strings_en
+from . import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def parse_export_tables(tables_arg):
+    """Turn a comma-separated table list (or None for all) into a tuple, raising ValueError if invalid."""
+    if not tables_arg:
+        return tuple(db.EXPORT_TABLES)
+    tables = tuple(t.strip() for t in tables_arg.split(',') if t.strip())
+    if not tables or any(t not in db.EXPORT_TABLES for t in tables):
+        raise ValueError(s.ERROR_EXPORT_INVALID_TABLES.format(tables=tables_arg, valid_tables=', '.join(db.EXPORT_TABLES)))
+    return tables
+
+def _ndjson_chunks(rows):
+    """One JSON line per row, tagged with the table it came from."""
+    for table, row in rows:
+        yield json.dumps({'table': table, **row}, ensure_ascii=False, default=str) + '\n'
+
+def _csv_chunks(rows, tables):
+    """A header, then one CSV line per row: a 'table' column followed by the union of the tables' columns."""
+    columns = []
+    for table in tables:
+        columns.extend(c for c in db.get_export_columns(table) if c not in columns)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=['table'] + columns, extrasaction='ignore')
+    writer.writeheader()
+    for table, row in rows:
+        writer.writerow({'table': table, **row})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell(): # Header only, no rows
+        yield buffer.getvalue()
+
+def iter_export(export_format, user_id=None, tables=tuple(db.EXPORT_TABLES)):
+    """Stream an export as text chunks (one per row), logging the row count when it completes."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(s.ERROR_EXPORT_INVALID_FORMAT.format(export_format=export_format, formats=', '.join(EXPORT_FORMATS)))
+    scope = f"user {user_id}" if user_id is not None else "all users"
+    logger.info(s.LOG_EXPORT_STARTED.format(export_format=export_format, tables=', '.join(tables), scope=scope))
+    row_count = 0
+
+    def counted_rows():
+        nonlocal row_count
+        for item in db.iter_export_rows(user_id, tables):
+            row_count += 1
+            yield item
+
+    chunks = _ndjson_chunks(counted_rows()) if export_format == 'ndjson' else _csv_chunks(counted_rows(), tables)
+    try:
+        yield from chunks
+    except Exception as e:
+        logger.error(s.ERROR_EXPORT_FAILED.format(scope=scope, error=e), exc_info=True)
+        raise
+    logger.info(s.LOG_EXPORT_FINISHED.format(export_format=export_format, scope=scope, row_count=row_count))
+
+def main(argv=None):
+    """Command line export: python -m bot_modules.export [--user-id ID] [--format csv] [--output FILE]"""
+    parser = argparse.ArgumentParser(description="Export stored messages, interactions and image results.")
+    parser.add_argument('--user-id', type=int, help="Only export this user (default: all users)")
+    parser.add_argument('--format', dest='export_format', choices=list(EXPORT_FORMATS), default='ndjson')
+    parser.add_argument('--tables', help=f"Comma-separated subset of: {', '.join(db.EXPORT_TABLES)}")
+    parser.add_argument('--output', help="Output file (default: stdout)")
+    parser.add_argument('--db', help=f"Database file (default: {db.DB_PATH})")
+    args = parser.parse_args(argv)
+    if args.db:
+        db.DB_PATH = args.db
+    try:
+        tables = parse_export_tables(args.tables)
+    except ValueError as e:
+        parser.error(str(e))
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for chunk in iter_export(args.export_format, args.user_id, tables):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        db.close_all_connections()
+
+if __name__ == '__main__':
+    main()
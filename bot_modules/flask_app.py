@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 import logging
 import telebot # Needed for Update processing
 from datetime import datetime
@@ -10,8 +10,10 @@ import hashlib # For initData validation
 
 # Import from other modules using relative paths
 from . import config
-from .telegram_bot import bot, user_sessions # Import bot instance and sessions
+from .telegram_bot import analysis_queue, bot, photo_queue, user_sessions # Import bot instance and sessions
 from . import database as db # Import database functions
+from . import export # Streaming data export
+from . import dispatcher # Worker pool for webhook updates
 # Remove the individual strings_en/es imports if they are only used for 's'
 # from . import strings_en
 # from . import strings_es
@@ -31,11 +33,25 @@ app = Flask(__name__, template_folder=os.path.join(os.path.dirname(__file__), '.
 # --- Webhook and Basic Routes ---
 @app.route('/' + config.TOKEN, methods=['POST'])
 def webhook():
+    # Validate, queue and answer at once; the dispatcher's workers run the handlers
+    if config.WEBHOOK_SECRET_TOKEN and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != config.WEBHOOK_SECRET_TOKEN:
+        logger.warning(s.WARN_WEBHOOK_BAD_SECRET.format(remote_addr=request.remote_addr))
+        return '', 403
     try:
         json_string = request.stream.read().decode('utf-8')
         logger.info(s.LOG_WEBHOOK_RECEIVED.format(json_preview=json_string[:500])) # Log truncated update
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        try:
+            update = telebot.types.Update.de_json(json_string)
+        except (ValueError, KeyError, TypeError) as e:
+            update, parse_error = None, e
+        else:
+            parse_error = s.ERROR_WEBHOOK_EMPTY_UPDATE
+        if update is None: # Not worth a Telegram retry: it would fail the same way
+            logger.warning(s.WARN_WEBHOOK_INVALID_UPDATE.format(error=parse_error))
+            return jsonify({'error': str(parse_error)}), 400
+        if not dispatcher.dispatch_update(update):
+            # Shed load (the chat's lane is full): Telegram redelivers the update later
+            return jsonify({'error': s.WEBHOOK_BUSY_ERROR}), 503
         return '', 200
     except Exception as e:
         logger.error(s.ERROR_WEBHOOK_PROCESSING.format(error=str(e)), exc_info=True)
@@ -51,7 +67,7 @@ def set_webhook():
     try:
         bot.remove_webhook()
         # Set webhook without sending certificate parameter
-        bot.set_webhook(url=config.WEBHOOK_URL)
+        bot.set_webhook(url=config.WEBHOOK_URL, secret_token=config.WEBHOOK_SECRET_TOKEN or None)
         logger.info(s.LOG_WEBHOOK_SET.format(url=config.WEBHOOK_URL))
         return s.FLASK_WEBHOOK_SET_SUCCESS
     except Exception as e:
@@ -80,7 +96,7 @@ def check_updates():
         bot.remove_webhook()
         updates = bot.get_updates()
         # Re-set webhook immediately
-        bot.set_webhook(url=config.WEBHOOK_URL)
+        bot.set_webhook(url=config.WEBHOOK_URL, secret_token=config.WEBHOOK_SECRET_TOKEN or None)
         return jsonify([u.to_dict() for u in updates])
     except Exception as e:
         logger.error(s.ERROR_CHECK_UPDATES.format(error=e), exc_info=True)
@@ -88,17 +104,37 @@ def check_updates():
 
 @app.route('/user_sessions')
 def view_user_sessions_route(): # Renamed function
-    # Return a sanitized version of user sessions
+    # Return a sanitized version of user sessions (state only, most recently used first)
     return jsonify({
-        'active_users': len(user_sessions),
-        'sessions': {str(user_id): session.get('state', 'N/A') for user_id, session in user_sessions.items()}
+        'backend': user_sessions.backend,
+        'active_users': user_sessions.count(),
+        'sessions': {str(user_id): state for user_id, state in user_sessions.states()}
     })
 
+# --- Pagination for data-view routes ---
+# ?limit=N&cursor=TOKEN; responses carry 'next_cursor' (null on the last page).
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def get_page_args():
+    """Return (limit, cursor) from the query string, raising ValueError for a bad limit."""
+    raw_limit = request.args.get('limit')
+    try:
+        limit = int(raw_limit) if raw_limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(s.ERROR_INVALID_PAGE_LIMIT.format(max_limit=MAX_PAGE_SIZE))
+    return limit, request.args.get('cursor') or None
+
 @app.route('/db_users')
 def view_db_users_route(): # Renamed function
     try:
-        users = db.get_all_db_users()
-        return jsonify({'total_users': len(users), 'users': users})
+        limit, cursor = get_page_args()
+        users, next_cursor = db.get_all_db_users_page(limit, cursor)
+        return jsonify({'total_users': db.get_global_stats()['user_count'], 'users': users, 'next_cursor': next_cursor})
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
     except Exception as e:
         logger.error(s.ERROR_DB_RETRIEVING_USERS.format(error=str(e)), exc_info=True)
         return jsonify({'error': str(e)}), 500
@@ -106,10 +142,13 @@ def view_db_users_route(): # Renamed function
 @app.route('/image_processing_results/<int:user_id>')
 def view_image_processing_results_route(user_id): # Renamed function
     try:
+        limit, cursor = get_page_args()
         user = db.get_db_user_details(user_id)
         if not user: return jsonify({'error': s.ERROR_USER_NOT_FOUND}), 404
-        results = db.get_db_image_processing_results(user_id)
-        return jsonify({'user': user, 'image_processing_results': results, 'total_results': len(results)})
+        results, next_cursor = db.get_db_image_processing_results_page(user_id, limit, cursor)
+        return jsonify({'user': user, 'image_processing_results': results, 'total_results': len(results), 'next_cursor': next_cursor})
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
     except Exception as e:
         logger.error(s.ERROR_DB_RETRIEVING_IMAGE_RESULTS.format(error=str(e)), exc_info=True)
         return jsonify({'error': str(e)}), 500
@@ -117,10 +156,14 @@ def view_image_processing_results_route(user_id): # Renamed function
 @app.route('/user_messages/<int:user_id>')
 def view_user_messages_route(user_id): # Renamed function
     try:
+        limit, cursor = get_page_args()
         user = db.get_db_user_details(user_id)
         if not user: return jsonify({'error': s.ERROR_USER_NOT_FOUND}), 404
-        messages = db.get_db_user_messages(user_id)
-        return jsonify({'user': user, 'messages': messages, 'total_messages': len(messages)})
+        messages, next_cursor = db.get_db_user_messages_page(user_id, limit, cursor)
+        total_messages = db.get_db_user_stats(user_id)['message_count']
+        return jsonify({'user': user, 'messages': messages, 'total_messages': total_messages, 'next_cursor': next_cursor})
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
     except Exception as e:
         logger.error(s.ERROR_DB_RETRIEVING_MESSAGES.format(error=str(e)), exc_info=True)
         return jsonify({'error': str(e)}), 500
@@ -128,19 +171,44 @@ def view_user_messages_route(user_id): # Renamed function
 @app.route('/user_interactions/<int:user_id>')
 def view_user_interactions_route(user_id): # Renamed function
     try:
+        limit, cursor = get_page_args()
         user = db.get_db_user_details(user_id)
         if not user: return jsonify({'error': s.ERROR_USER_NOT_FOUND}), 404
-        interactions = db.get_db_user_interactions(user_id)
+        interactions, next_cursor = db.get_db_user_interactions_page(user_id, limit, cursor)
         stats = db.get_db_interaction_stats(user_id)
+        total_interactions = db.get_db_user_stats(user_id)['interaction_count']
         return jsonify({
             'user': user,
             'preferences': {'language': user.get('language', s.DB_DEFAULT_LANGUAGE), 'notifications': bool(user.get('notifications', True)), 'theme': user.get('theme', s.DB_DEFAULT_THEME)},
-            'interactions': interactions, 'total_interactions': len(interactions), 'interaction_stats': stats
+            'interactions': interactions, 'total_interactions': total_interactions, 'interaction_stats': stats,
+            'next_cursor': next_cursor
         })
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
     except Exception as e:
         logger.error(s.ERROR_DB_RETRIEVING_INTERACTIONS.format(error=str(e)), exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/export')
+@app.route('/export/<int:user_id>')
+def export_route(user_id=None):
+    """Stream the full history (all users, or one) as NDJSON or CSV without loading it into memory."""
+    try:
+        export_format = request.args.get('format', 'ndjson').lower()
+        if export_format not in export.EXPORT_FORMATS:
+            raise ValueError(s.ERROR_EXPORT_INVALID_FORMAT.format(export_format=export_format, formats=', '.join(export.EXPORT_FORMATS)))
+        tables = export.parse_export_tables(request.args.get('tables'))
+        if user_id is not None and not db.get_db_user_details(user_id):
+            return jsonify({'error': s.ERROR_USER_NOT_FOUND}), 404
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    filename = f"export_{user_id if user_id is not None else 'all'}.{export_format}"
+    return Response(
+        stream_with_context(export.iter_export(export_format, user_id, tables)),
+        mimetype=export.EXPORT_FORMATS[export_format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 @app.route('/update_preference/<int:user_id>', methods=['POST'])
 def update_preference_route(user_id): # Renamed function
     try:
@@ -149,14 +217,12 @@ def update_preference_route(user_id): # Renamed function
             return jsonify({'error': s.ERROR_MISSING_PREFERENCE_FIELDS}), 400
         pref_name = data['preference_name']
         pref_value = data['preference_value']
-        valid_prefs = ['language', 'notifications', 'theme']
+        valid_prefs = list(db.PREFERENCE_COLUMNS)
         if pref_name not in valid_prefs:
             return jsonify({'error': s.ERROR_INVALID_PREFERENCE_NAME.format(valid_prefs=valid_prefs)}), 400
         success = db.update_user_preference(user_id, pref_name, pref_value)
         if success:
-            if user_id in user_sessions: # Update active session too
-                if 'preferences' not in user_sessions[user_id]: user_sessions[user_id]['preferences'] = db.get_user_preferences(user_id)
-                else: user_sessions[user_id]['preferences'][pref_name] = pref_value
+            user_sessions.preference_changed(user_id, pref_name, pref_value) # Update active session too
             return jsonify({'success': True, 'message': s.PREFERENCE_UPDATE_SUCCESS.format(pref_name=pref_name)})
         else:
             return jsonify({'error': s.ERROR_DB_UPDATING_PREFERENCE}), 500
@@ -290,53 +356,47 @@ def webapp_save_messages():
             return jsonify({'error': s.ERROR_WEBAPP_INVALID_DATA_FORMAT}), 400
 
         # --- Update Database ---
-        conn = db.sqlite3.connect(db.DB_PATH) # Use db module's sqlite3 and path
-        cursor = conn.cursor()
         success_count = 0
         fail_count = 0
         errors = []
 
         try:
-            cursor.execute("BEGIN TRANSACTION")
-
-            for item in data:
-                db_id = item.get('id')
-                new_text = item.get('text') # Allow empty string, but not null
-
-                # Basic validation
-                if db_id is None or not isinstance(db_id, int) or new_text is None:
-                    logger.warning(s.LOG_WEBAPP_SKIPPING_INVALID_ITEM.format(user_id=user_id, item=item))
-                    fail_count += 1
-                    errors.append(s.ERROR_WEBAPP_INVALID_ITEM_FORMAT.format(item=item))
-                    continue
-
-                # Update the specific message, ensuring it belongs to the user
-                cursor.execute("""
-                    UPDATE user_messages
-                    SET message_text = ?
-                    WHERE id = ? AND user_id = ?
-                """, (new_text, db_id, user_id))
-
-                if cursor.rowcount > 0:
-                    success_count += 1
-                else:
-                    # Log if a message wasn't updated (might belong to another user or ID is wrong)
-                    logger.warning(s.WARN_WEBAPP_UPDATE_FAILED.format(db_id=db_id, user_id=user_id))
-                    fail_count += 1
-                    errors.append(s.ERROR_WEBAPP_MESSAGE_NOT_FOUND.format(db_id=db_id))
-
-
-            conn.commit()
+            with db.db_connection() as conn: # Pooled connection; commits on success, rolls back on error
+                cursor = conn.cursor()
+
+                for item in data:
+                    db_id = item.get('id')
+                    new_text = item.get('text') # Allow empty string, but not null
+
+                    # Basic validation
+                    if db_id is None or not isinstance(db_id, int) or new_text is None:
+                        logger.warning(s.LOG_WEBAPP_SKIPPING_INVALID_ITEM.format(user_id=user_id, item=item))
+                        fail_count += 1
+                        errors.append(s.ERROR_WEBAPP_INVALID_ITEM_FORMAT.format(item=item))
+                        continue
+
+                    # Update the specific message, ensuring it belongs to the user
+                    cursor.execute("""
+                        UPDATE user_messages
+                        SET message_text = ?
+                        WHERE id = ? AND user_id = ?
+                    """, (new_text, db_id, user_id))
+
+                    if cursor.rowcount > 0:
+                        success_count += 1
+                    else:
+                        # Log if a message wasn't updated (might belong to another user or ID is wrong)
+                        logger.warning(s.WARN_WEBAPP_UPDATE_FAILED.format(db_id=db_id, user_id=user_id))
+                        fail_count += 1
+                        errors.append(s.ERROR_WEBAPP_MESSAGE_NOT_FOUND.format(db_id=db_id))
+
             logger.info(s.LOG_WEBAPP_FINISHED_SAVING.format(user_id=user_id, success_count=success_count, fail_count=fail_count))
 
         except Exception as db_e:
-            conn.rollback()
             success_count = 0 # Reset counts on rollback
             fail_count = len(data) # Assume all failed on transaction error
             errors.append(s.WEBAPP_SAVE_ERROR_TRANSACTION.format(error=db_e))
             logger.error(s.ERROR_WEBAPP_DB_TRANSACTION.format(user_id=user_id, error=db_e), exc_info=True)
-        finally:
-            conn.close()
 
         if fail_count == 0:
             return jsonify({'status': s.WEBAPP_SAVE_STATUS_SUCCESS, 'updated': success_count})
@@ -361,16 +421,9 @@ def health_check():
     db_status = 'unknown'
     user_count, message_count, interaction_count = -1, -1, -1
     try:
-        conn = db.sqlite3.connect(db.DB_PATH)
-        cursor = conn.cursor()
-        # Get counts
-        cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM user_messages")
-        message_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM user_interactions")
-        interaction_count = cursor.fetchone()[0]
-        conn.close()
+        # Counts come from the trigger-maintained global_stats row, not COUNT(*) scans
+        stats = db.get_global_stats()
+        user_count, message_count, interaction_count = stats['user_count'], stats['message_count'], stats['interaction_count']
         db_status = s.DB_STATUS_OK
     except Exception as db_e:
         logger.error(s.HEALTH_CHECK_DB_ERROR.format(error=db_e))
@@ -390,7 +443,10 @@ def health_check():
         'bot_info': bot_info_dict,
         'db_status': db_status,
         'service_account_status': service_account_status,
-        'active_users_in_memory': len(user_sessions),
+        'active_sessions': user_sessions.count(),
+        'photo_queue': photo_queue.metrics(),
+        'analysis_queue': analysis_queue.metrics(),
+        'update_lanes': dispatcher.update_lanes.metrics(),
         'total_users_in_db': user_count,
         'total_messages_in_db': message_count,
         'total_interactions_in_db': interaction_count
@@ -1,17 +1,28 @@
+import asyncio
 import logging
 import traceback
 import json
 import base64
+import hashlib
 import requests
 import os
 import re # Import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request as GoogleAuthRequest
+import google_auth_httplib2
+import httplib2
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 from . import strings_en
 from . import strings_es
 from . import config
+from . import http_client
+from . import database as db
 
 # Set language based on environment
 BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
@@ -19,36 +30,124 @@ s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
 
 logger = logging.getLogger(__name__)
 
+# --- Credential Cache ---
+# One credentials object per (service account file, scope set), shared by all threads.
+# Each entry has its own lock, so concurrent callers wait for a single token fetch
+# instead of each doing one, and a daemon thread refreshes tokens before they expire.
+_credential_cache = {}
+_credential_cache_lock = threading.Lock()
+_credential_refresher = None
+_credential_refresher_stop = threading.Event()
+
+def _token_expiring(credentials, margin_seconds):
+    """True if the credentials have no token or it expires within margin_seconds."""
+    if not credentials.token:
+        return True
+    if credentials.expiry is None:
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None) # google-auth keeps expiry as naive UTC
+    return credentials.expiry - now <= timedelta(seconds=margin_seconds)
+
+def _refresh_cache_entry(entry, margin_seconds):
+    """Load and/or refresh an entry's credentials as needed. Caller must hold entry['lock']."""
+    if entry['credentials'] is None:
+        entry['credentials'] = service_account.Credentials.from_service_account_file(entry['path'], scopes=list(entry['scopes']))
+        logger.info(s.LOG_GOOGLE_API_CREDS_CREATED.format(path=entry['path']))
+    credentials = entry['credentials']
+    if _token_expiring(credentials, margin_seconds):
+        logger.info(s.LOG_CREDENTIAL_CACHE_REFRESHING.format(scopes=list(entry['scopes'])))
+        credentials.refresh(GoogleAuthRequest())
+        logger.info(s.LOG_CREDENTIAL_CACHE_REFRESHED.format(scopes=list(entry['scopes']), expiry_time=credentials.expiry))
+    return credentials
+
+def _credential_refresher_loop():
+    margin = config.GOOGLE_CREDENTIALS_REFRESH_MARGIN_SECONDS
+    while not _credential_refresher_stop.wait(config.GOOGLE_CREDENTIALS_CHECK_SECONDS):
+        with _credential_cache_lock:
+            entries = list(_credential_cache.values())
+        for entry in entries:
+            if entry['credentials'] is None or not entry['lock'].acquire(blocking=False):
+                continue # Never loaded, or a caller is refreshing it right now
+            try:
+                _refresh_cache_entry(entry, margin)
+            except Exception as e: # The token is still valid for a while; try again next round
+                logger.warning(s.WARN_CREDENTIAL_BACKGROUND_REFRESH_FAILED.format(scopes=list(entry['scopes']), error=e))
+            finally:
+                entry['lock'].release()
+
+def _ensure_credential_refresher_started():
+    global _credential_refresher
+    if _credential_refresher is not None and _credential_refresher.is_alive():
+        return
+    with _credential_cache_lock:
+        if _credential_refresher is None or not _credential_refresher.is_alive():
+            _credential_refresher_stop.clear()
+            _credential_refresher = threading.Thread(target=_credential_refresher_loop, name="google-credential-refresher", daemon=True)
+            _credential_refresher.start()
+            logger.info(s.LOG_CREDENTIAL_REFRESHER_STARTED.format(check_seconds=config.GOOGLE_CREDENTIALS_CHECK_SECONDS,
+                                                                  margin_seconds=config.GOOGLE_CREDENTIALS_REFRESH_MARGIN_SECONDS))
+
+def get_cached_credentials(scopes):
+    """
+    Return service account credentials for a scope set, holding a valid token.
+    The service account file is read and a token fetched only the first time (and
+    again when the token has expired); raises if either step fails.
+    """
+    key = (config.SERVICE_ACCOUNT_FILE, frozenset(scopes))
+    with _credential_cache_lock:
+        entry = _credential_cache.setdefault(key, {'path': key[0], 'scopes': tuple(scopes), 'credentials': None, 'lock': threading.Lock()})
+    with entry['lock']: # Single flight: concurrent callers wait here and reuse the fresh token
+        credentials = _refresh_cache_entry(entry, margin_seconds=0)
+    _ensure_credential_refresher_started()
+    return credentials
+
+def clear_credential_cache():
+    """Drop every cached credential and stop the refresher (used in tests and when rotating keys)."""
+    global _credential_refresher
+    _credential_refresher_stop.set()
+    with _credential_cache_lock:
+        thread, _credential_refresher = _credential_refresher, None
+        _credential_cache.clear()
+    with _service_cache_lock:
+        _service_cache.clear() # Clients hold the old credentials
+    if thread is not None:
+        thread.join()
+
 # --- Credential Management ---
+GEMINI_SCOPES_TO_TRY = [
+    [s.API_SCOPE_CLOUD_PLATFORM],
+    [s.API_SCOPE_AI_PLATFORM],
+    [s.API_SCOPE_GENERATIVE_AI]
+]
+_gemini_scope = None # First scope that produced a token; later calls skip straight to it
+
 def get_credentials_for_gemini():
-    """Get authenticated credentials specifically for Gemini API"""
-    logger.info(s.LOG_GETTING_GEMINI_CREDS)
+    """Get authenticated credentials specifically for Gemini API (cached, see get_cached_credentials)"""
+    global _gemini_scope
+    logger.debug(s.LOG_GETTING_GEMINI_CREDS)
     try:
         if not config.SERVICE_ACCOUNT_FILE or not os.path.exists(config.SERVICE_ACCOUNT_FILE):
             logger.error(s.ERROR_SERVICE_ACCOUNT_NOT_FOUND.format(path=config.SERVICE_ACCOUNT_FILE))
             return None
-        scopes_to_try = [
-            [s.API_SCOPE_CLOUD_PLATFORM],
-            [s.API_SCOPE_AI_PLATFORM],
-            [s.API_SCOPE_GENERATIVE_AI]
-        ]
+        known_scope = _gemini_scope
+        scopes_to_try = [known_scope] if known_scope else GEMINI_SCOPES_TO_TRY
         for scope in scopes_to_try:
-            logger.info(s.LOG_TRYING_GEMINI_SCOPE.format(scope=scope))
+            if not known_scope:
+                logger.info(s.LOG_TRYING_GEMINI_SCOPE.format(scope=scope))
             try:
-                credentials = service_account.Credentials.from_service_account_file(
-                    config.SERVICE_ACCOUNT_FILE, scopes=scope)
-                auth_req = GoogleAuthRequest()
-                logger.info(s.LOG_REFRESHING_GEMINI_CREDS.format(scope=scope))
-                credentials.refresh(auth_req)
+                credentials = get_cached_credentials(scope)
                 if credentials.token:
-                    token_preview = credentials.token[:10] + "..."
-                    logger.info(s.LOG_GEMINI_TOKEN_SUCCESS.format(token_preview=token_preview))
+                    if not known_scope:
+                        token_preview = credentials.token[:10] + "..."
+                        logger.info(s.LOG_GEMINI_TOKEN_SUCCESS.format(token_preview=token_preview))
+                        _gemini_scope = scope
                     return credentials
                 else:
                     logger.warning(s.WARN_GEMINI_NO_TOKEN.format(scope=scope))
             except Exception as e:
                 logger.warning(s.WARN_GEMINI_FAILED_TOKEN_SCOPE.format(scope=scope, error=str(e)))
                 continue
+        _gemini_scope = None # The remembered scope stopped working; probe all of them next time
         logger.error(s.ERROR_GEMINI_ALL_AUTH_FAILED)
         return None
     except Exception as e:
@@ -57,32 +156,16 @@ def get_credentials_for_gemini():
         return None
 
 def get_credentials_for_google_apis(scopes):
-    """Get authenticated credentials for Google APIs (Forms, Apps Script, etc.)"""
-    logger.info(s.LOG_GETTING_GOOGLE_API_CREDS)
+    """Get authenticated credentials for Google APIs (Forms, Apps Script, etc.), cached per scope set"""
+    logger.debug(s.LOG_GETTING_GOOGLE_API_CREDS)
     try:
         if not config.SERVICE_ACCOUNT_FILE or not os.path.exists(config.SERVICE_ACCOUNT_FILE):
             logger.error(s.ERROR_SERVICE_ACCOUNT_NOT_FOUND.format(path=config.SERVICE_ACCOUNT_FILE))
             return None
-        logger.info(s.LOG_REQUESTING_GOOGLE_API_CREDS.format(scopes=scopes))
-        credentials = service_account.Credentials.from_service_account_file(
-            config.SERVICE_ACCOUNT_FILE, scopes=scopes)
-        logger.info(s.LOG_GOOGLE_API_CREDS_CREATED.format(path=config.SERVICE_ACCOUNT_FILE))
-        try:
-            auth_req = GoogleAuthRequest()
-            logger.info(s.LOG_REFRESHING_GOOGLE_API_CREDS)
-            credentials.refresh(auth_req)
-            logger.info(s.LOG_GOOGLE_API_CREDS_REFRESHED)
-            if credentials.token:
-                token_preview = credentials.token[:10] + "..."
-                logger.info(s.LOG_GOOGLE_API_TOKEN_SUCCESS.format(token_preview=token_preview))
-                expiry_time = getattr(credentials, 'expiry', None)
-                if expiry_time: logger.info(s.LOG_GOOGLE_API_TOKEN_EXPIRY.format(expiry_time=expiry_time))
-                else: logger.info(s.LOG_GOOGLE_API_TOKEN_NO_EXPIRY)
-            else:
-                logger.warning(s.WARN_GOOGLE_API_NO_TOKEN)
-        except Exception as refresh_error:
-            logger.warning(s.WARN_GOOGLE_API_REFRESH_FAILED.format(error=str(refresh_error)))
-        logger.info(s.LOG_GOOGLE_API_CREDS_SUCCESS)
+        logger.debug(s.LOG_REQUESTING_GOOGLE_API_CREDS.format(scopes=scopes))
+        credentials = get_cached_credentials(scopes)
+        if not credentials.token:
+            logger.warning(s.WARN_GOOGLE_API_NO_TOKEN)
         return credentials
     except Exception as e:
         logger.error(s.ERROR_GETTING_GOOGLE_API_CREDS.format(error=str(e)))
@@ -97,7 +180,60 @@ def get_credentials(scopes):
     else:
         return get_credentials_for_google_apis(scopes)
 
+# --- Discovery Clients ---
+# build() parses the discovery document and sets up a transport, so each service is
+# built once per (name, version, credentials) and shared. Discovery documents come
+# from the copies bundled with google-api-python-client (no network fetch).
+# httplib2.Http is not thread-safe, so requests made through a shared service each
+# use an authorized transport owned by the calling thread.
+_service_cache = {}
+_service_cache_lock = threading.Lock()
+_thread_http = threading.local()
+
+def _http_for_thread(credentials):
+    transports = getattr(_thread_http, 'transports', None)
+    if transports is None:
+        transports = _thread_http.transports = {}
+    http = transports.get(id(credentials))
+    if http is None or http.credentials is not credentials:
+        http = transports[id(credentials)] = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    return http
+
+def get_google_service(service_name, version, credentials):
+    """Return a memoized, thread-safe discovery client for credentials from get_credentials_for_google_apis."""
+    key = (service_name, version, id(credentials))
+    with _service_cache_lock:
+        entry = _service_cache.get(key)
+        if entry is None or entry['credentials'] is not credentials:
+            def request_builder(http, *args, **kwargs):
+                return HttpRequest(_http_for_thread(credentials), *args, **kwargs)
+            service = build(service_name, version, credentials=credentials, requestBuilder=request_builder,
+                            static_discovery=True, cache_discovery=False)
+            entry = _service_cache[key] = {'service': service, 'credentials': credentials}
+            logger.info(s.LOG_GOOGLE_SERVICE_BUILT.format(service_name=service_name, version=version))
+    return entry['service']
+
 # --- Gemini API ---
+GEMINI_IMAGE_GENERATION_CONFIG = {
+    "temperature": 0.4,
+    "topK": 32,
+    "topP": 1,
+    "maxOutputTokens": 4096
+}
+# Identifies the prompt, settings and model behind an image result; cached results
+# are only reused for the same version, so editing any of them invalidates the cache.
+GEMINI_IMAGE_PROMPT_VERSION = hashlib.sha256(json.dumps(
+    [s.GEMINI_PROMPT_IMAGE_ANALYSIS, GEMINI_IMAGE_GENERATION_CONFIG, config.GEMINI_API_ENDPOINT], sort_keys=True
+).encode('utf-8')).hexdigest()[:16]
+
+def image_sha256(image_path):
+    """SHA-256 of an image file's bytes (the image result cache key)."""
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def process_image_with_gemini(image_path, user_id):
     """
     Process an image using Gemini 2.0 Lite API with service account authentication
@@ -135,19 +271,12 @@ def process_image_with_gemini(image_path, user_id):
                     ]
                 }
             ],
-            "generationConfig": {
-                "temperature": 0.4,
-                "topK": 32,
-                "topP": 1,
-                "maxOutputTokens": 4096
-            }
+            "generationConfig": GEMINI_IMAGE_GENERATION_CONFIG
         }
 
         logger.info(s.LOG_GEMINI_SENDING_IMAGE.format(endpoint=config.GEMINI_API_ENDPOINT))
 
-        # Get an access token from the credentials
-        auth_req = GoogleAuthRequest()
-        credentials.refresh(auth_req) # Refresh just before use
+        # Cached credentials carry a valid token (refreshed in the background before expiry)
         access_token = credentials.token
 
         if not access_token:
@@ -159,14 +288,13 @@ def process_image_with_gemini(image_path, user_id):
         logger.info(s.LOG_GEMINI_USING_TOKEN.format(token_preview=token_preview))
 
         # Make the API request with the access token
-        response = requests.post(
-            config.GEMINI_API_ENDPOINT,
+        response = http_client.post(
+            'gemini', config.GEMINI_API_ENDPOINT,
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {access_token}"
             },
-            data=json.dumps(payload),
-            timeout=60 # Add a timeout
+            data=json.dumps(payload)
         )
 
         # Log the raw response
@@ -267,8 +395,60 @@ def extract_text_from_gemini_response(gemini_response):
         logger.error(s.DEBUG_GEMINI_EXTRACT_FAIL_SNIPPET.format(snippet=str(gemini_response)[:500]))
         return s.ERROR_GEMINI_EXTRACTING_TEXT_USER_MSG
 
-def analyze_text_with_gemini(prompt_text, user_id):
-    """Sends text prompt to Gemini for analysis (used in Menu 1)."""
+def gemini_response_has_text(gemini_response):
+    """True when a (single or streamed) response carries candidate text, i.e. not blocked, empty or malformed."""
+    segments = gemini_response if isinstance(gemini_response, list) else [gemini_response]
+    for segment in segments:
+        if not isinstance(segment, dict):
+            return False
+        for candidate in (segment.get("candidates") or [])[:1]:
+            for part in (candidate.get("content") or {}).get("parts", []):
+                if str(part.get("text", "")).strip():
+                    return True
+    return False
+
+class GeminiRequestCancelled(Exception):
+    """Raised inside a streamed request when the caller no longer wants the answer."""
+
+def _stream_gemini_response(headers, payload, on_partial, is_cancelled=None):
+    """
+    POST to streamGenerateContent and return the list of response segments (the same
+    shape extract_text_from_gemini_response accepts). on_partial(text_so_far) is
+    called after every segment that adds text.
+    """
+    segments, text_so_far = [], ""
+    with http_client.post('gemini', config.GEMINI_STREAM_ENDPOINT, headers=headers, json=payload, stream=True) as response:
+        if response.status_code >= 400:
+            response.content # Read the error body before the stream is closed
+            logger.info(s.LOG_GEMINI_RAW_RESPONSE.format(status_code=response.status_code, text_preview=response.text[:500]))
+        response.raise_for_status()
+        response.encoding = 'utf-8' # SSE is UTF-8; requests would assume ISO-8859-1 for text/event-stream
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue # Blank separators and SSE comments
+            if is_cancelled and is_cancelled():
+                raise GeminiRequestCancelled() # Closing the response aborts the generation
+            segment = json.loads(line[len('data:'):])
+            segments.append(segment)
+            added = ""
+            for candidate in segment.get('candidates', [])[:1]:
+                for part in candidate.get('content', {}).get('parts', []):
+                    added += part.get('text', '')
+            if added:
+                text_so_far += added
+                on_partial(text_so_far)
+    logger.info(s.LOG_GEMINI_STREAM_COMPLETE.format(segments=len(segments), chars=len(text_so_far)))
+    return segments
+
+GEMINI_TEXT_GENERATION_CONFIG = {"temperature": 0.4, "topK": 32, "topP": 0.95, "maxOutputTokens": 1024}
+
+def analyze_text_with_gemini(prompt_text, user_id, on_partial=None, is_cancelled=None):
+    """
+    Sends text prompt to Gemini for analysis (used in Menu 1).
+    With GEMINI_STREAMING enabled and an on_partial callback, the answer is streamed
+    and on_partial receives the raw text received so far as it grows. If is_cancelled()
+    turns True before or during the request, (None, None) is returned.
+    """
     logger.info(s.LOG_GEMINI_TEXT_ANALYSIS_INITIATED.format(user_id=user_id))
     try:
         credentials = get_credentials_for_gemini()
@@ -289,20 +469,29 @@ def analyze_text_with_gemini(prompt_text, user_id):
 
         payload = {
             "contents": [{"role": "user", "parts": [{"text": prompt_text}]}],
-            "generationConfig": {"temperature": 0.4, "topK": 32, "topP": 0.95, "maxOutputTokens": 1024}
+            "generationConfig": GEMINI_TEXT_GENERATION_CONFIG
         }
 
-        logger.info(s.LOG_GEMINI_TEXT_SENDING_REQUEST.format(endpoint=config.GEMINI_API_ENDPOINT))
-        response = requests.post(config.GEMINI_API_ENDPOINT, headers=headers, json=payload, timeout=60)
+        if is_cancelled and is_cancelled():
+            raise GeminiRequestCancelled()
+        if on_partial and config.GEMINI_STREAMING:
+            logger.info(s.LOG_GEMINI_TEXT_SENDING_REQUEST.format(endpoint=config.GEMINI_STREAM_ENDPOINT))
+            response_json = _stream_gemini_response(headers, payload, on_partial, is_cancelled)
+        else:
+            logger.info(s.LOG_GEMINI_TEXT_SENDING_REQUEST.format(endpoint=config.GEMINI_API_ENDPOINT))
+            response = http_client.post('gemini', config.GEMINI_API_ENDPOINT, headers=headers, json=payload)
 
-        logger.info(s.LOG_GEMINI_RAW_RESPONSE.format(status_code=response.status_code, text_preview=response.text[:500]))
-        response.raise_for_status()
+            logger.info(s.LOG_GEMINI_RAW_RESPONSE.format(status_code=response.status_code, text_preview=response.text[:500]))
+            response.raise_for_status()
 
-        response_json = response.json()
+            response_json = response.json()
         analysis_result = extract_text_from_gemini_response(response_json) # Reuse extraction logic
         logger.info(s.LOG_GEMINI_TEXT_ANALYSIS_SUCCESS.format(user_id=user_id))
         return analysis_result, None
 
+    except GeminiRequestCancelled:
+        logger.info(s.LOG_GEMINI_TEXT_ANALYSIS_CANCELLED.format(user_id=user_id))
+        return None, None
     except requests.exceptions.RequestException as req_err:
          logger.error(s.ERROR_GEMINI_TEXT_REQUEST_FAILED.format(error=req_err), exc_info=True)
          status_code = getattr(req_err.response, 'status_code', None)
@@ -316,6 +505,56 @@ def analyze_text_with_gemini(prompt_text, user_id):
         logger.error(s.ERROR_GEMINI_TEXT_PROCESSING.format(user_id=user_id, error=str(e)), exc_info=True)
         return None, s.ERROR_GEMINI_TEXT_PROCESSING_USER_MSG
 
+async def analyze_text_with_gemini_async(prompt_text, user_id, session):
+    """
+    asyncio version of analyze_text_with_gemini for the async engine. session is an
+    aiohttp.ClientSession, so waiting on Gemini holds no thread; cancelling the
+    calling task aborts the request. Retries 429/5xx like the shared HTTP session.
+    """
+    logger.info(s.LOG_GEMINI_TEXT_ANALYSIS_INITIATED.format(user_id=user_id))
+    try:
+        credentials = await asyncio.to_thread(get_credentials_for_gemini) # Cached; only a cold start fetches a token
+        if not credentials:
+            logger.error(s.ERROR_GEMINI_TEXT_AUTH_FAILED)
+            return None, s.ERROR_GEMINI_AUTH_FAILED_MSG
+        if not credentials.token:
+             logger.error(s.ERROR_GEMINI_TEXT_TOKEN_MISSING)
+             return None, s.ERROR_GEMINI_TEXT_TOKEN_MISSING_MSG
+
+        headers = {"Authorization": f"Bearer {credentials.token}", "Content-Type": "application/json"}
+        payload = {
+            "contents": [{"role": "user", "parts": [{"text": prompt_text}]}],
+            "generationConfig": GEMINI_TEXT_GENERATION_CONFIG
+        }
+        logger.info(s.LOG_GEMINI_TEXT_SENDING_REQUEST.format(endpoint=config.GEMINI_API_ENDPOINT))
+        attempt = 0
+        while True:
+            async with session.post(config.GEMINI_API_ENDPOINT, headers=headers, json=payload) as response:
+                status, retry_after = response.status, response.headers.get('Retry-After')
+                response_text = await response.text()
+            if status not in http_client.RETRY_STATUSES or attempt >= config.HTTP_RETRIES:
+                break
+            attempt += 1
+            delay = http_client.retry_delay(attempt, retry_after)
+            logger.info(s.LOG_HTTP_RETRYING.format(method='POST', host='gemini', status=status, attempt=attempt, delay=delay))
+            await asyncio.sleep(delay)
+
+        logger.info(s.LOG_GEMINI_RAW_RESPONSE.format(status_code=status, text_preview=response_text[:500]))
+        if status >= 400:
+            logger.error(s.ERROR_GEMINI_TEXT_REQUEST_FAILED.format(error=f"HTTP {status}"))
+            return None, s.ERROR_GEMINI_REQUEST_FAILED_USER_MSG.format(status_code=status, error_text_preview=response_text[:200])
+
+        analysis_result = extract_text_from_gemini_response(json.loads(response_text))
+        logger.info(s.LOG_GEMINI_TEXT_ANALYSIS_SUCCESS.format(user_id=user_id))
+        return analysis_result, None
+
+    except json.JSONDecodeError as json_err:
+        logger.error(s.ERROR_GEMINI_TEXT_JSON_DECODE.format(error=json_err), exc_info=True)
+        return None, s.ERROR_GEMINI_JSON_DECODE_USER_MSG
+    except Exception as e: # aiohttp.ClientError and timeouts included; CancelledError is not an Exception
+        logger.error(s.ERROR_GEMINI_TEXT_PROCESSING.format(user_id=user_id, error=str(e)), exc_info=True)
+        return None, s.ERROR_GEMINI_TEXT_PROCESSING_USER_MSG
+
 # --- Google Forms API ---
 def get_google_form_response(form_id, response_id):
     """Retrieves a specific response from a Google Form."""
@@ -335,7 +574,7 @@ def get_google_form_response(form_id, response_id):
 
     try:
         # Build the service object
-        service = build('forms', 'v1', credentials=credentials)
+        service = get_google_service('forms', 'v1', credentials)
 
         # Retrieve the response
         result = service.forms().responses().get(
@@ -365,60 +604,121 @@ def get_google_form_response(form_id, response_id):
         logger.error(s.ERROR_FORM_UNEXPECTED.format(error=e), exc_info=True)
         return None, s.ERROR_GENERIC
 
+# --- Google Forms Response Mirror ---
+# Responses are copied into SQLite (see database.save_form_responses) and indexed by
+# the answer fields in config.FORM_INDEXED_FIELDS, so a patient lookup is a point
+# query. Syncs are incremental: only responses submitted or edited since the newest
+# lastSubmittedTime already mirrored are listed, following every page token.
+FORM_SCOPES = [
+    s.API_SCOPE_FORMS_READONLY,
+    "https://www.googleapis.com/auth/forms.body.readonly",
+    "https://www.googleapis.com/auth/drive.readonly"
+]
+_form_sync_locks = {}
+_form_sync_locks_lock = threading.Lock()
+
+def _timestamp_key(timestamp):
+    """Sort key for RFC 3339 'Zulu' timestamps whose fractional seconds vary in length."""
+    main, _, fraction = timestamp.rstrip('Z').partition('.')
+    return main, fraction.ljust(9, '0')
+
+def _mirror_item(response, qid_title_map):
+    """Turn a Forms API response into a save_form_responses item."""
+    answers, fields = {}, []
+    for qid, ans_data in response.get("answers", {}).items():
+        values = [a.get("value") for a in ans_data.get("textAnswers", {}).get("answers", []) if a.get("value") is not None]
+        title = qid_title_map.get(qid)
+        if not title:
+            continue
+        answers[title] = values[0] if values else None
+        field = title.strip().lower()
+        if field in config.FORM_INDEXED_FIELDS:
+            fields.extend((field, value) for value in values)
+    return {'response_id': response['responseId'], 'last_submitted_time': response.get('lastSubmittedTime'),
+            'answers': answers, 'response': response, 'fields': fields}
+
+def sync_form_responses(form_id, max_age_seconds=0, full=False):
+    """
+    Bring the local mirror of a form's responses up to date. Skipped if the last
+    sync is younger than max_age_seconds; full=True re-downloads everything (which
+    also drops responses deleted from the form).
+    Returns: Tuple (number of responses synced, error message or None)
+    """
+    with _form_sync_locks_lock:
+        lock = _form_sync_locks.setdefault(form_id, threading.Lock())
+    with lock: # Single flight per form: concurrent lookups wait for one sync
+        state = db.get_form_sync_state(form_id)
+        if not full and state and max_age_seconds and state['age_seconds'] < max_age_seconds:
+            return 0, None
+        credentials = get_credentials_for_google_apis(scopes=FORM_SCOPES)
+        if not credentials:
+            logger.error(s.ERROR_FORM_AUTH_FAILED)
+            return 0, s.ERROR_FORM_AUTH_FAILED_MSG
+        qid_title_map, map_error = get_question_id_title_map(form_id)
+        if map_error:
+            return 0, map_error
+        try:
+            service = get_google_service('forms', 'v1', credentials)
+            if full:
+                db.clear_form_responses(form_id)
+                state = None
+            watermark = state['last_submitted_time'] if state else None
+            logger.info(s.LOG_FORM_SYNC_STARTED.format(form_id=form_id, watermark=watermark or "the beginning"))
+            list_args = {'formId': form_id}
+            if watermark: # >= so responses sharing the watermark second aren't missed; upserts make repeats harmless
+                list_args['filter'] = f"timestamp >= {watermark}"
+            count, pages, newest, page_token = 0, 0, watermark, None
+            while True:
+                page = service.forms().responses().list(pageToken=page_token, **list_args).execute()
+                items = [_mirror_item(resp, qid_title_map) for resp in page.get('responses', [])]
+                db.save_form_responses(form_id, items)
+                for item in items:
+                    if item['last_submitted_time'] and (newest is None or _timestamp_key(item['last_submitted_time']) > _timestamp_key(newest)):
+                        newest = item['last_submitted_time']
+                count += len(items)
+                pages += 1
+                page_token = page.get('nextPageToken')
+                if not page_token:
+                    break
+            # Only advance the watermark once every page is in: list order isn't by time
+            db.mark_form_synced(form_id, newest)
+            logger.info(s.LOG_FORM_SYNC_FINISHED.format(count=count, form_id=form_id, pages=pages, watermark=newest))
+            return count, None
+        except HttpError as e:
+            error_details = e.content.decode('utf-8')
+            try:
+                ej = json.loads(error_details)
+                msg = ej.get('error', {}).get('message', s.ERROR_FORM_API_UNKNOWN)
+                code = ej.get('error', {}).get('code', e.resp.status)
+            except json.JSONDecodeError:
+                msg = s.ERROR_FORM_API_STATUS_FALLBACK.format(status_code=e.resp.status)
+                code = e.resp.status
+            logger.error(s.ERROR_FORM_API.format(status_code=code, error_message=msg))
+            return 0, s.ERROR_FORM_API_USER_MSG.format(status_code=code, error_message=msg)
+        except Exception as ex:
+            logger.error(s.ERROR_FORM_UNEXPECTED.format(error=ex), exc_info=True)
+            return 0, s.ERROR_GENERIC
+
 # --- Google Forms by patient_id ---
 def get_google_form_response_by_patient_id(form_id, patient_id):
     """
-    Retrieves the first Google Form response where the answer to the question
-    named "patient_id" matches the provided patient_id.
-    Returns: Tuple (response JSON dict or None, error message or None)
+    Retrieves the most recent Google Form response whose "patient_id" answer
+    matches the provided patient_id, from the local mirror (synced first if stale).
+    Returns: Tuple (title -> answer dict or None, error message or None)
     """
     logger.info(s.LOG_FORM_RETRIEVAL_INITIATED.format(response_id="by_patient_id", form_id=form_id))
-    forms_scope = [
-        s.API_SCOPE_FORMS_READONLY,
-        "https://www.googleapis.com/auth/forms.body.readonly",
-        "https://www.googleapis.com/auth/drive.readonly"
-    ]
-    credentials = get_credentials_for_google_apis(scopes=forms_scope)
-    if not credentials:
-        logger.error(s.ERROR_FORM_AUTH_FAILED)
-        return None, s.ERROR_FORM_AUTH_FAILED_MSG
-    try:
-        service = build('forms', 'v1', credentials=credentials)
-        # Generic scan of all answers for patient_id
-        responses = service.forms().responses().list(formId=form_id).execute().get('responses', [])
-        for resp in responses:
-            for ans in resp.get("answers", {}).values():
-                for txt in ans.get("textAnswers", {}).get("answers", []):
-                    if txt.get('value') == patient_id:
-                        logger.info("Matching response found for patient_id %s", patient_id)
-                        # Build title-to-answer mapping
-                        qid_title_map, map_error = get_question_id_title_map(form_id)
-                        if map_error:
-                            return None, map_error
-                        title_answer_map = {}
-                        for qid, ans_data in resp.get("answers", {}).items():
-                            answers = ans_data.get("textAnswers", {}).get("answers", [])
-                            answer_value = answers[0].get("value") if answers else None
-                            title = qid_title_map.get(qid)
-                            if title:
-                                title_answer_map[title] = answer_value
-                        return title_answer_map, None
-        return None, f"No response found for patient_id {patient_id}"
-    except HttpError as e:
-        error_details = e.content.decode('utf-8')
-        try:
-            ej = json.loads(error_details)
-            msg = ej.get('error', {}).get('message', s.ERROR_FORM_API_UNKNOWN)
-            code = ej.get('error', {}).get('code', e.resp.status)
-        except json.JSONDecodeError:
-            msg = s.ERROR_FORM_API_STATUS_FALLBACK.format(status_code=e.resp.status)
-            code = e.resp.status
-        logger.error(s.ERROR_FORM_API.format(status_code=code, error_message=msg))
-        user_error = s.ERROR_FORM_API_USER_MSG.format(status_code=code, error_message=msg)
-        return None, user_error
-    except Exception as ex:
-        logger.error(s.ERROR_FORM_UNEXPECTED.format(error=ex), exc_info=True)
-        return None, s.ERROR_GENERIC
+    _, sync_error = sync_form_responses(form_id, max_age_seconds=config.FORM_SYNC_MIN_INTERVAL_SECONDS)
+    result = db.find_form_response(form_id, 'patient_id', patient_id)
+    if result is None and not sync_error:
+        # A miss may be a response submitted since a recent sync: catch up and look again
+        _, sync_error = sync_form_responses(form_id)
+        result = db.find_form_response(form_id, 'patient_id', patient_id)
+    if result is not None:
+        if sync_error:
+            logger.warning(s.WARN_FORM_SYNC_FAILED.format(form_id=form_id, error=sync_error))
+        logger.info(s.LOG_FORM_MIRROR_HIT.format(field='patient_id', value=patient_id, form_id=form_id))
+        return result, None
+    return None, sync_error or s.FORM_PATIENT_NOT_FOUND_USER_MSG.format(patient_id=patient_id)
 
 # --- Google Apps Script ---
 def call_apps_script(script_id, function_name, parameters):
@@ -441,7 +741,7 @@ def call_apps_script(script_id, function_name, parameters):
 
     try:
         logger.info(s.LOG_APPS_SCRIPT_BUILDING_SERVICE)
-        service = build('script', 'v1', credentials=credentials)
+        service = get_google_service('script', 'v1', credentials)
         logger.info(s.LOG_APPS_SCRIPT_SERVICE_BUILT)
 
         # Create the request body
@@ -521,9 +821,9 @@ def get_sheet_data_via_webapp(id_to_find):
         # logger.debug(f"Request URL: {target_url}?id={id_to_find}&apiKey={config.APPS_SCRIPT_API_KEY[:4]}...")
 
         # --- START MODIFICATION ---
-        logger.info(s.LOG_WEB_APP_ATTEMPTING_GET.format(target_url=target_url)) # Add log BEFORE request
+        logger.info(s.LOG_WEB_APP_ATTEMPTING_GET.format(target_url=target_url, timeout=config.WEBAPP_TIMEOUT_SECONDS)) # Add log BEFORE request
         # Make the GET request
-        response = requests.get(target_url, params=params, timeout=30) # Existing request
+        response = http_client.get('webapp', target_url, params=params) # Pooled session, timeout from config
         logger.info(s.LOG_WEB_APP_GET_COMPLETED.format(status_code=response.status_code)) # Add log AFTER request
         # --- END MODIFICATION ---
 
@@ -572,9 +872,76 @@ def get_sheet_data_via_webapp(id_to_find):
         logger.error(s.ERROR_WEB_APP_UNEXPECTED.format(error=e), exc_info=True)
         return None, s.WEB_APP_UNEXPECTED_USER_MSG
 
+# --- Form Structure Cache ---
+# form_id -> {'mapping', 'revision_id', 'checked_at' (epoch seconds)}, least recently used first
+_form_structure_cache = OrderedDict()
+_form_structure_lock = threading.Lock()
+_form_structure_file_loaded = False
+
+def _load_form_structure_file():
+    """Fill the cache from FORM_STRUCTURE_CACHE_FILE once. Caller must hold _form_structure_lock."""
+    global _form_structure_file_loaded
+    if _form_structure_file_loaded:
+        return
+    _form_structure_file_loaded = True
+    path = config.FORM_STRUCTURE_CACHE_FILE
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, encoding='utf-8') as f:
+            for form_id, entry in json.load(f).items():
+                _form_structure_cache[form_id] = entry
+        while len(_form_structure_cache) > config.FORM_STRUCTURE_CACHE_MAX:
+            _form_structure_cache.popitem(last=False)
+    except Exception as e:
+        logger.warning(s.WARN_FORM_STRUCTURE_CACHE_FILE.format(path=path, error=e))
+
+def _save_form_structure_file():
+    """Write the cache to FORM_STRUCTURE_CACHE_FILE (atomically). Caller must hold _form_structure_lock."""
+    path = config.FORM_STRUCTURE_CACHE_FILE
+    if not path:
+        return
+    try:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(_form_structure_cache, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(s.WARN_FORM_STRUCTURE_CACHE_FILE.format(path=path, error=e))
+
+def _get_cached_form_structure(form_id):
+    with _form_structure_lock:
+        _load_form_structure_file()
+        entry = _form_structure_cache.get(form_id)
+        if entry is not None:
+            _form_structure_cache.move_to_end(form_id)
+        return entry
+
+def _cache_form_structure(form_id, mapping, revision_id):
+    with _form_structure_lock:
+        _form_structure_cache[form_id] = {'mapping': mapping, 'revision_id': revision_id, 'checked_at': time.time()}
+        _form_structure_cache.move_to_end(form_id)
+        while len(_form_structure_cache) > config.FORM_STRUCTURE_CACHE_MAX:
+            _form_structure_cache.popitem(last=False)
+        _save_form_structure_file()
+
+def clear_form_structure_cache():
+    """Forget cached form structures (the cache file, if any, is rewritten on the next fetch)."""
+    global _form_structure_file_loaded
+    with _form_structure_lock:
+        _form_structure_cache.clear()
+        _form_structure_file_loaded = False
+
 def get_question_id_title_map(form_id):
-    """Retrieves mapping of question IDs to question titles for a Google Form."""
-    logger.info(f"Retrieving form structure for form {form_id}")
+    """
+    Retrieves mapping of question IDs to question titles for a Google Form.
+    Cached for FORM_STRUCTURE_TTL_SECONDS; after that only the form's revisionId is
+    fetched, and the full structure again only if the form changed.
+    """
+    cached = _get_cached_form_structure(form_id)
+    if cached and time.time() - cached['checked_at'] < config.FORM_STRUCTURE_TTL_SECONDS:
+        return dict(cached['mapping']), None
+    logger.info(s.LOG_FORM_STRUCTURE_RETRIEVING.format(form_id=form_id))
     forms_scope = [
         s.API_SCOPE_FORMS_READONLY,
         "https://www.googleapis.com/auth/forms.body.readonly",
@@ -585,7 +952,13 @@ def get_question_id_title_map(form_id):
         logger.error(s.ERROR_FORM_AUTH_FAILED)
         return None, s.ERROR_FORM_AUTH_FAILED_MSG
     try:
-        service = build('forms', 'v1', credentials=credentials)
+        service = get_google_service('forms', 'v1', credentials)
+        if cached:
+            revision_id = service.forms().get(formId=form_id, fields='revisionId').execute().get('revisionId')
+            if revision_id and revision_id == cached['revision_id']:
+                logger.info(s.LOG_FORM_STRUCTURE_REVALIDATED.format(form_id=form_id, revision_id=revision_id))
+                _cache_form_structure(form_id, cached['mapping'], revision_id)
+                return dict(cached['mapping']), None
         form = service.forms().get(formId=form_id).execute()
         mapping = {}
         for item in form.get('items', []):
@@ -597,7 +970,8 @@ def get_question_id_title_map(form_id):
             title = question.get('title') or item.get('title')
             if qid and title:
                 mapping[qid] = title
-        return mapping, None
+        _cache_form_structure(form_id, mapping, form.get('revisionId'))
+        return dict(mapping), None
     except HttpError as error:
         error_details = error.content.decode('utf-8')
         try:
@@ -608,10 +982,16 @@ def get_question_id_title_map(form_id):
             error_message = s.ERROR_FORM_API_STATUS_FALLBACK.format(status_code=error.resp.status)
             status_code = error.resp.status
         logger.error(s.ERROR_FORM_API.format(status_code=status_code, error_message=error_message))
+        if cached: # Structure rarely changes: a stale copy beats failing the lookup
+            logger.warning(s.WARN_FORM_STRUCTURE_STALE.format(form_id=form_id, error=error_message))
+            return dict(cached['mapping']), None
         user_error = s.ERROR_FORM_API_USER_MSG.format(status_code=status_code, error_message=error_message)
         return None, user_error
     except Exception as ex:
-        logger.error(f"Unexpected error getting question map for form {form_id}: {ex}", exc_info=True)
+        logger.error(s.ERROR_FORM_STRUCTURE_UNEXPECTED.format(form_id=form_id, error=ex), exc_info=True)
+        if cached:
+            logger.warning(s.WARN_FORM_STRUCTURE_STALE.format(form_id=form_id, error=ex))
+            return dict(cached['mapping']), None
         return None, s.ERROR_GENERIC
 
 def generate_question_id_title_json(form_id):
@@ -0,0 +1,226 @@
+import io
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+from . import config
+from . import strings_en
+from . import strings_es
+
+try:
+    import httpx # Optional: only used when HTTP_USE_HTTP2 is enabled
+except ImportError:
+    httpx = None
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+# Shared session for outbound calls (Gemini, Apps Script Web App). Reusing it keeps
+# TCP+TLS connections alive between calls instead of handshaking every time.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+_session = None
+_session_lock = threading.Lock()
+
+def _endpoint_settings():
+    """endpoint name -> (url, read timeout, pool size). Read from config at session creation."""
+    return {
+        'gemini': (config.GEMINI_API_ENDPOINT, config.GEMINI_TIMEOUT_SECONDS, config.GEMINI_POOL_MAXSIZE),
+        'webapp': (config.APPS_SCRIPT_WEB_APP_URL, config.WEBAPP_TIMEOUT_SECONDS, config.HTTP_POOL_MAXSIZE),
+    }
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt (1-based): Retry-After if given, else exponential backoff."""
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass # HTTP-date form; fall back to backoff
+    return config.HTTP_RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1))
+
+class _HttpxStream:
+    """
+    File-like view of a streamed httpx response, used as requests' Response.raw so
+    iter_content()/iter_lines() read the body as it arrives. httpx errors are
+    re-raised as the requests exceptions callers already handle.
+    """
+    def __init__(self, resp):
+        self._resp = resp
+        self._chunks = None
+        self._buffer = b""
+
+    def stream(self, chunk_size=1024, decode_content=True):
+        try:
+            yield from self._resp.iter_bytes(chunk_size)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            self._resp.close() # Body done (or abandoned): release the stream
+
+    def read(self, amt=None, decode_content=True):
+        if self._chunks is None:
+            self._chunks = self.stream()
+        while amt is None or len(self._buffer) < amt:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if amt is None:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def close(self):
+        self._resp.close()
+
+    release_conn = close # Response.close() calls this once the body was consumed
+
+class _Http2Adapter(BaseAdapter):
+    """
+    Transport adapter that sends requests over HTTP/2 with httpx, so callers keep
+    using the requests API and its exceptions. Retries 429/5xx and connection errors
+    like the HTTP/1.1 adapter does. stream=True streams the body; verify, cert and
+    proxies are honoured with one httpx client per combination.
+    """
+    def __init__(self, pool_maxsize):
+        super().__init__()
+        self.pool_maxsize = pool_maxsize
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _client(self, verify, cert, proxy):
+        key = (verify, cert if not isinstance(cert, list) else tuple(cert), proxy)
+        with self._clients_lock:
+            client = self._clients.get(key)
+            if client is None:
+                limits = httpx.Limits(max_connections=self.pool_maxsize, max_keepalive_connections=self.pool_maxsize)
+                client = self._clients[key] = httpx.Client(http2=True, limits=limits, verify=verify, cert=cert,
+                                                           proxy=proxy, trust_env=False)
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        client = self._client(verify, cert, requests.utils.select_proxy(request.url, proxies))
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                resp = client.send(client.build_request(request.method, request.url, headers=dict(request.headers),
+                                                        content=request.body, timeout=httpx.Timeout(read, connect=connect)),
+                                   stream=True)
+            except httpx.ReadTimeout as e: # Already waited the full read timeout; don't multiply it
+                raise requests.exceptions.ReadTimeout(e, request=request)
+            except httpx.TimeoutException as e:
+                if attempt >= config.HTTP_RETRIES:
+                    raise requests.exceptions.Timeout(e, request=request)
+                status = type(e).__name__
+            except httpx.TransportError as e:
+                if attempt >= config.HTTP_RETRIES:
+                    raise requests.exceptions.ConnectionError(e, request=request)
+                status = type(e).__name__
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt >= config.HTTP_RETRIES:
+                    return self._build_response(request, resp, stream)
+                status, retry_after = resp.status_code, resp.headers.get('Retry-After')
+                resp.close()
+            attempt += 1
+            delay = retry_delay(attempt, retry_after)
+            logger.info(s.LOG_HTTP_RETRYING.format(method=request.method, host=urlsplit(request.url).hostname,
+                                                   status=status, attempt=attempt, delay=delay))
+            time.sleep(delay)
+
+    def _build_response(self, request, resp, stream=False):
+        """requests.Response for an httpx response: body left streaming if stream, else read in full."""
+        response = requests.Response()
+        response.status_code = resp.status_code
+        response.headers = CaseInsensitiveDict(resp.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.reason = resp.reason_phrase
+        response.url = str(resp.url)
+        response.request = request
+        response.connection = self
+        response.raw = _HttpxStream(resp)
+        if not stream:
+            try:
+                response._content = response.raw.read()
+            except requests.exceptions.RequestException as e:
+                e.request = request
+                raise
+            finally:
+                resp.close()
+            response._content_consumed = True
+            response.raw = io.BytesIO(response._content)
+        return response
+
+    def close(self):
+        with self._clients_lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+def _make_adapter(pool_maxsize, http2):
+    if http2:
+        return _Http2Adapter(pool_maxsize)
+    retry = Retry(
+        total=config.HTTP_RETRIES,
+        backoff_factor=config.HTTP_RETRY_BACKOFF_SECONDS,
+        read=0, # A read timeout already waited the full timeout; don't multiply it
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None, # Also retry POST: generateContent has no side effects
+        raise_on_status=False # Hand the last response back so callers' raise_for_status() reports it
+    )
+    return HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry)
+
+def get_session():
+    """Return the process-wide pooled session, creating it on first use."""
+    global _session
+    if _session is not None:
+        return _session
+    with _session_lock:
+        if _session is None:
+            http2 = config.HTTP_USE_HTTP2
+            if http2 and httpx is None:
+                logger.warning(s.WARN_HTTP2_UNAVAILABLE)
+                http2 = False
+            session = requests.Session()
+            session.mount('https://', _make_adapter(config.HTTP_POOL_MAXSIZE, http2))
+            session.mount('http://', _make_adapter(config.HTTP_POOL_MAXSIZE, http2))
+            # Per-host pools: the most specific mounted prefix wins
+            for url, _, pool_maxsize in _endpoint_settings().values():
+                parts = urlsplit(url or '')
+                if parts.scheme and parts.netloc:
+                    session.mount(f"{parts.scheme}://{parts.netloc}/", _make_adapter(pool_maxsize, http2))
+            logger.info(s.LOG_HTTP_SESSION_CREATED.format(protocol="HTTP/2" if http2 else "HTTP/1.1",
+                                                          pool_maxsize=config.HTTP_POOL_MAXSIZE, retries=config.HTTP_RETRIES))
+            _session = session
+    return _session
+
+def close_session():
+    """Close pooled connections; the next call creates a fresh session (used on shutdown and in tests)."""
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+def request(endpoint, method, url, **kwargs):
+    """Send a request through the shared session with the endpoint's (connect, read) timeout."""
+    _, read_timeout, _ = _endpoint_settings()[endpoint]
+    kwargs.setdefault('timeout', (config.HTTP_CONNECT_TIMEOUT_SECONDS, read_timeout))
+    return get_session().request(method, url, **kwargs)
+
+def post(endpoint, url, **kwargs):
+    return request(endpoint, 'POST', url, **kwargs)
+
+def get(endpoint, url, **kwargs):
+    return request(endpoint, 'GET', url, **kwargs)
@@ -0,0 +1,250 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from . import strings_en
+from . import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+class FairJobQueue:
+    """
+    Bounded job queue served by a pool of worker threads.
+
+    Jobs are grouped per key (the user id). Keys take turns round-robin and each
+    key runs at most one job at a time, so one user sending ten photos can't hold
+    every worker while others wait. submit() never blocks: when the queue or the
+    key's share of it is full the job is rejected and the caller tells the user.
+    """
+
+    def __init__(self, name, workers, max_queued, max_per_key):
+        self.name = name
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_key = max_per_key
+        self._condition = threading.Condition()
+        self._jobs = {} # key -> deque of (func, args, kwargs, enqueued_at)
+        self._ready = deque() # Keys with queued jobs and nothing running, in turn order
+        self._running = set() # Keys with a job in progress
+        self._queued = 0
+        self._threads = []
+        self._stopping = False
+        self._metrics = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0,
+                         'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0, 'run_seconds_total': 0.0}
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) for key. Returns False if it was rejected (backpressure)."""
+        with self._condition:
+            key_jobs = self._jobs.get(key)
+            if self._stopping or self._queued >= self.max_queued or (key_jobs and len(key_jobs) >= self.max_per_key):
+                self._metrics['rejected'] += 1
+                logger.warning(s.WARN_JOB_QUEUE_FULL.format(queue=self.name, key=key, depth=self._queued))
+                return False
+            if key_jobs is None:
+                key_jobs = self._jobs[key] = deque()
+                if key not in self._running:
+                    self._ready.append(key)
+            key_jobs.append((func, args, kwargs, time.monotonic()))
+            self._queued += 1
+            self._metrics['submitted'] += 1
+            self._condition.notify()
+        self._ensure_workers()
+        return True
+
+    def _ensure_workers(self):
+        with self._condition:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers and not self._stopping:
+                thread = threading.Thread(target=self._worker, name=f"{self.name}-worker-{len(self._threads) + 1}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_job(self):
+        """Wait for the next key's turn; returns (key, job) or None when stopping and drained."""
+        with self._condition:
+            while not self._ready:
+                if self._stopping and not self._queued:
+                    return None
+                self._condition.wait()
+            key = self._ready.popleft()
+            key_jobs = self._jobs[key]
+            job = key_jobs.popleft()
+            if not key_jobs:
+                del self._jobs[key]
+            self._running.add(key)
+            self._queued -= 1
+            wait = time.monotonic() - job[3]
+            self._metrics['wait_seconds_total'] += wait
+            self._metrics['wait_seconds_max'] = max(self._metrics['wait_seconds_max'], wait)
+            return key, job
+
+    def _worker(self):
+        while True:
+            item = self._next_job()
+            if item is None:
+                return
+            key, (func, args, kwargs, _) = item
+            started = time.monotonic()
+            failed = False
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                logger.error(s.ERROR_JOB_FAILED.format(queue=self.name, key=key, error=e), exc_info=True)
+            finally:
+                with self._condition:
+                    self._running.discard(key)
+                    if key in self._jobs: # Its next job goes to the back of the line
+                        self._ready.append(key)
+                        self._condition.notify()
+                    self._metrics['failed' if failed else 'completed'] += 1
+                    self._metrics['run_seconds_total'] += time.monotonic() - started
+                    if self._stopping:
+                        self._condition.notify_all()
+
+    def metrics(self):
+        """Counters plus current depth, running jobs and average wait/run times."""
+        with self._condition:
+            metrics = dict(self._metrics)
+            metrics['depth'] = self._queued
+            metrics['running'] = len(self._running)
+            metrics['workers'] = self.workers
+        started = metrics['completed'] + metrics['failed'] + metrics['running']
+        finished = metrics['completed'] + metrics['failed']
+        metrics['wait_seconds_avg'] = metrics['wait_seconds_total'] / started if started else 0.0
+        metrics['run_seconds_avg'] = metrics['run_seconds_total'] / finished if finished else 0.0
+        return metrics
+
+    def stop(self, timeout=None):
+        """Reject new jobs, let the workers finish what is queued, and wait for them."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            threads = list(self._threads)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+class LaneJobQueue:
+    """
+    Jobs hashed by key onto a fixed set of lanes, each a bounded FIFO served by one
+    thread. Jobs with the same key (a chat) always share a lane, so they run one at
+    a time in submission order; different keys run in parallel across lanes.
+    Unlike FairJobQueue, a slow job delays the other keys hashed to its lane.
+    """
+
+    def __init__(self, name, lanes, max_queued_per_lane):
+        self.name = name
+        self._lock = threading.Lock()
+        self._submitters_done = threading.Condition(self._lock)
+        self._submitting = 0 # Submitters past the stopping check whose job is not queued yet
+        self._stopping = False
+        self._lanes = [{'queue': queue.Queue(maxsize=max_queued_per_lane), 'thread': None, 'busy': False,
+                        'metrics': {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0,
+                                    'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0, 'run_seconds_total': 0.0}}
+                       for _ in range(lanes)]
+
+    def lane_for(self, key):
+        return hash(key) % len(self._lanes)
+
+    def submit(self, key, func, *args, block=False, **kwargs):
+        """
+        Queue func(*args, **kwargs) on key's lane. With block=False a full lane rejects
+        the job (returns False); with block=True the caller waits for room.
+        """
+        index = self.lane_for(key)
+        lane = self._lanes[index]
+        with self._lock:
+            if self._stopping:
+                lane['metrics']['rejected'] += 1
+                return False
+            self._ensure_worker(index)
+            self._submitting += 1 # stop() waits for this put before queueing its stop markers
+        try:
+            lane['queue'].put((key, func, args, kwargs, time.monotonic()), block=block)
+            queued = True
+        except queue.Full:
+            queued = False
+        with self._lock:
+            self._submitting -= 1
+            self._submitters_done.notify_all()
+            lane['metrics']['submitted' if queued else 'rejected'] += 1
+        if not queued:
+            logger.warning(s.WARN_JOB_QUEUE_FULL.format(queue=f"{self.name}[{index}]", key=key, depth=lane['queue'].qsize()))
+        return queued
+
+    def _ensure_worker(self, index):
+        """Start the lane's thread on first use (or after it died). Caller holds _lock."""
+        lane = self._lanes[index]
+        if lane['thread'] is None or not lane['thread'].is_alive():
+            lane['thread'] = threading.Thread(target=self._worker, args=(index,), name=f"{self.name}-lane-{index}", daemon=True)
+            lane['thread'].start()
+
+    def _worker(self, index):
+        lane = self._lanes[index]
+        stopping = False
+        while True:
+            if stopping: # Run anything a submitter that outlived stop()'s wait queued behind the marker
+                try:
+                    job = lane['queue'].get_nowait()
+                except queue.Empty:
+                    return
+            else:
+                job = lane['queue'].get()
+            if job is None: # Stop marker, queued behind the remaining jobs
+                stopping = True
+                continue
+            key, func, args, kwargs, enqueued_at = job
+            started = time.monotonic()
+            with self._lock:
+                lane['busy'] = True
+                wait = started - enqueued_at
+                lane['metrics']['wait_seconds_total'] += wait
+                lane['metrics']['wait_seconds_max'] = max(lane['metrics']['wait_seconds_max'], wait)
+            failed = False
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                logger.error(s.ERROR_JOB_FAILED.format(queue=f"{self.name}[{index}]", key=key, error=e), exc_info=True)
+            finally:
+                with self._lock:
+                    lane['busy'] = False
+                    lane['metrics']['failed' if failed else 'completed'] += 1
+                    lane['metrics']['run_seconds_total'] += time.monotonic() - started
+
+    def metrics(self):
+        """Per-lane counters, depth and busy flag, plus totals across lanes."""
+        with self._lock:
+            lanes = [dict(lane['metrics'], lane=index, depth=lane['queue'].qsize(), busy=lane['busy'])
+                     for index, lane in enumerate(self._lanes)]
+        totals = {name: sum(lane[name] for lane in lanes)
+                  for name in ('submitted', 'rejected', 'completed', 'failed', 'depth', 'wait_seconds_total', 'run_seconds_total')}
+        totals['wait_seconds_max'] = max((lane['wait_seconds_max'] for lane in lanes), default=0.0)
+        totals['busy_lanes'] = sum(1 for lane in lanes if lane['busy'])
+        return dict(totals, lanes=lanes)
+
+    def stop(self, timeout=None):
+        """Reject new jobs, let each lane finish what is queued, and wait (up to timeout) for the threads."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        remaining = lambda: None if deadline is None else max(0, deadline - time.monotonic())
+        with self._lock:
+            self._stopping = True
+            # Jobs accepted before now must be queued ahead of the stop markers
+            self._submitters_done.wait_for(lambda: self._submitting == 0, remaining())
+            running = [lane for lane in self._lanes if lane['thread'] is not None]
+        stopped = []
+        for lane in running:
+            try:
+                lane['queue'].put(None, timeout=remaining()) # Waits for room if the lane is full
+                stopped.append(lane)
+            except queue.Full:
+                pass # Deadline passed; the daemon thread is abandoned
+        for lane in stopped:
+            lane['thread'].join(remaining())
@@ -0,0 +1,102 @@
+import fcntl
+import logging
+import os
+import telebot # For ApiTelegramException
+from . import config
+from . import database as db
+from . import http_client
+from .telegram_bot import analysis_queue, bot, photo_queue, report_deletion_progress
+from .dispatcher import update_lanes
+from . import strings_en
+from . import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+# Startup and shutdown steps shared by main.py (single process) and wsgi.py
+# (gunicorn: the database is initialised once in the master, background services
+# run in every worker process).
+_reaper_lock_file = None
+
+def init_database():
+    """Create/migrate the database, then close the connection so nothing is carried across fork()."""
+    db.init_db()
+    db.close_all_connections()
+
+def configure_webhook():
+    """Point Telegram at WEBHOOK_URL. Returns False (after logging why) if it could not be set."""
+    try:
+        logger.info(s.LOG_REMOVING_WEBHOOK)
+        bot.remove_webhook()
+        logger.info(s.LOG_WEBHOOK_REMOVED)
+    except Exception as e:
+        logger.error(s.ERROR_REMOVING_WEBHOOK_PRODUCTION.format(error=e))
+        return False
+
+    try:
+        logger.info(s.LOG_SETTING_WEBHOOK.format(url=config.WEBHOOK_URL))
+        cert_exists = os.path.exists(config.WEBHOOK_SSL_CERT)
+        key_exists = os.path.exists(config.WEBHOOK_SSL_PRIV)
+        if not cert_exists or not key_exists:
+             logger.warning(s.WARN_SSL_CERT_NOT_FOUND.format(cert_path=config.WEBHOOK_SSL_CERT, key_path=config.WEBHOOK_SSL_PRIV))
+
+        bot.set_webhook(url=config.WEBHOOK_URL, secret_token=config.WEBHOOK_SECRET_TOKEN or None) # No cert parameter needed if handled by reverse proxy
+        logger.info(s.LOG_WEBHOOK_SET_NO_CERT_PARAM)
+        webhook_info_check = bot.get_webhook_info()
+        logger.info(s.LOG_WEBHOOK_STATUS_CHECK.format(url=webhook_info_check.url, pending_updates=webhook_info_check.pending_update_count))
+        if webhook_info_check.last_error_message:
+             logger.warning(s.WARN_TELEGRAM_WEBHOOK_ERROR.format(error_message=webhook_info_check.last_error_message))
+        return True
+    except telebot.apihelper.ApiTelegramException as e:
+         logger.error(s.FATAL_WEBHOOK_SET_API_ERROR.format(error=e), exc_info=True)
+    except Exception as e:
+        logger.error(s.FATAL_WEBHOOK_SET_OTHER_ERROR.format(error=e), exc_info=True)
+    return False
+
+def _claim_reaper():
+    """
+    Only one process may run the deletion reaper. The first to take an exclusive
+    lock on a file next to the database keeps it until it exits; the OS releases
+    it then, so a replacement worker can take over.
+    """
+    global _reaper_lock_file
+    if _reaper_lock_file is not None:
+        return True
+    lock_file = open(config.DB_PATH + '.reaper.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _reaper_lock_file = lock_file
+    return True
+
+def after_fork():
+    """In a freshly forked worker: drop anything inherited that must not be shared."""
+    db.reset_connections_after_fork()
+    http_client.close_session()
+
+def start_background_services():
+    """Start this process's background threads (queue workers start on first use)."""
+    if _claim_reaper():
+        db.start_deletion_reaper(report=report_deletion_progress) # Also resumes deletions interrupted by a restart
+    else:
+        logger.info(s.LOG_REAPER_OWNED_ELSEWHERE.format(pid=os.getpid()))
+
+def stop_background_services():
+    """
+    Graceful shutdown: finish queued updates (which may queue analyses and photos), then those,
+    then stop the reaper, close outbound connections, commit pending writes and
+    close the database.
+    """
+    logger.info(s.LOG_SHUTTING_DOWN_SERVICES.format(pid=os.getpid()))
+    update_lanes.stop(config.DISPATCH_DRAIN_SECONDS)
+    analysis_queue.stop(config.ANALYSIS_QUEUE_DRAIN_SECONDS)
+    photo_queue.stop(config.PHOTO_QUEUE_DRAIN_SECONDS)
+    db.stop_deletion_reaper()
+    http_client.close_session()
+    db.stop_writer()
+    db.close_all_connections()
@@ -0,0 +1,131 @@
+import json
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict, deque
+from . import config
+from . import database as db
+from . import strings_en
+from . import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+def estimate_tokens(text):
+    """Rough token count for budgeting (Gemini averages about 4 characters per token)."""
+    return math.ceil(len(text) / config.PROMPT_CHARS_PER_TOKEN)
+
+def render_history_item(msg_text):
+    """Prompt line for one history message; JSON messages are pretty-printed. None for commands."""
+    if not msg_text or (isinstance(msg_text, str) and msg_text.startswith('/')):
+        return None
+    try:
+        if isinstance(msg_text, str) and msg_text.startswith('{') and msg_text.endswith('}'):
+            formatted_json = json.dumps(json.loads(msg_text), indent=2, ensure_ascii=False)
+            return s.CALLBACK_ANALYSIS_PROMPT_JSON.format(formatted_json=formatted_json)
+        return s.CALLBACK_ANALYSIS_PROMPT_TEXT.format(text=msg_text)
+    except Exception as format_err:
+        logger.warning(f"Could not format message text, adding as raw string. Error: {format_err}")
+        return s.CALLBACK_ANALYSIS_PROMPT_TEXT.format(text=str(msg_text))
+
+class _UserContext:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.history_version = None # db.get_user_history_version() when the items were read
+        self.last_id = 0 # Highest user_messages.id already rendered
+        self.items = deque() # (message key, rendered, tokens), newest first
+        self.tokens = 0
+
+class AnalysisPromptBuilder:
+    """
+    Builds the Gemini analysis prompt from a per-user rolling context.
+
+    Each history message is rendered once (JSON pretty-printing included) and kept
+    with its estimated token count; a build only reads and renders rows newer than
+    the last one seen. When the user's history version changed (a message was edited
+    or deleted, possibly by another process) the context is read afresh. Items are added newest first until the token budget is
+    spent, and items that can no longer fit are dropped from the context.
+    """
+
+    def __init__(self, token_budget, max_users):
+        self.token_budget = token_budget
+        self.max_users = max_users
+        self._contexts = OrderedDict() # user_id -> _UserContext, least recently used first
+        self._lock = threading.Lock()
+
+    def _context(self, user_id):
+        with self._lock:
+            context = self._contexts.get(user_id)
+            if context is None:
+                context = self._contexts[user_id] = _UserContext()
+                while len(self._contexts) > self.max_users:
+                    self._contexts.popitem(last=False)
+            else:
+                self._contexts.move_to_end(user_id)
+            return context
+
+    def _catch_up(self, user_id, context):
+        history_version = db.get_user_history_version(user_id)
+        if history_version != context.history_version: # Edited or deleted rows: the renders are stale
+            context.history_version = history_version
+            context.last_id, context.tokens = 0, 0
+            context.items.clear()
+        rows = db.get_user_text_history_since(user_id, context.last_id, limit=config.PROMPT_HISTORY_MAX_ROWS)
+        for row in rows:
+            context.last_id = row['id']
+            rendered = render_history_item(row['message_text'])
+            if rendered:
+                tokens = estimate_tokens(rendered)
+                # Text rows are keyed by their Telegram message, so a just-received message is recognised
+                key = (row['chat_id'], row['message_id']) if row['message_type'] == s.DB_MESSAGE_TYPE_TEXT else None
+                context.items.appendleft((key, rendered, tokens))
+                context.tokens += tokens
+        while context.items and context.tokens > self.token_budget: # Oldest first
+            context.tokens -= context.items.pop()[2]
+        return len(rows)
+
+    def build(self, user_id, latest_messages=()):
+        """
+        Returns (prompt, item_count): the base prompt, the latest messages, then history
+        newest first. latest_messages are (chat_id, message_id, text) of messages just
+        received; their own history rows are skipped, while repeats of the same text are kept.
+        """
+        context = self._context(user_id)
+        with context.lock:
+            new_rows = self._catch_up(user_id, context)
+            parts = [s.GEMINI_PROMPT_TEXT_ANALYSIS]
+            remaining = self.token_budget - estimate_tokens(parts[0])
+            latest_added = 0
+            latest_keys = set()
+            for chat_id, message_id, latest_text in latest_messages:
+                latest_keys.add((chat_id, message_id))
+                latest = render_history_item(latest_text)
+                if latest:
+                    parts.append(latest)
+                    remaining -= estimate_tokens(latest)
+                    latest_added += 1
+            history_added = 0
+            for key, rendered, tokens in context.items:
+                if key in latest_keys:
+                    continue # Already added as a latest message
+                if tokens > remaining:
+                    break
+                parts.append(rendered)
+                remaining -= tokens
+                history_added += 1
+        logger.debug(s.LOG_PROMPT_BUILT.format(user_id=user_id, new_rows=new_rows, items=history_added,
+                                               tokens=self.token_budget - remaining, budget=self.token_budget))
+        return "".join(parts), history_added + latest_added
+
+    def forget(self, user_id):
+        """Drop a user's cached context (after their data is deleted)."""
+        with self._lock:
+            self._contexts.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from . import config
+from . import database as db
+from . import strings_en
+from . import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logger = logging.getLogger(__name__)
+
+SESSION_BACKENDS = ('memory', 'sqlite')
+
+class Session:
+    """One user's conversation state. Preferences are read from the database on first use."""
+
+    def __init__(self, user_id, state, data=None, preferences=None):
+        self.user_id = user_id
+        self.state = state
+        self.data = data if data is not None else {}
+        self._preferences = preferences
+
+    @property
+    def preferences(self):
+        if self._preferences is None:
+            self._preferences = db.get_user_preferences(self.user_id)
+        return self._preferences
+
+    def preference_changed(self, name, value):
+        """Keep already loaded preferences in step with the database."""
+        if self._preferences is not None:
+            self._preferences[name] = value
+
+    def __repr__(self):
+        return f"Session(user_id={self.user_id!r}, state={self.state!r}, data={self.data!r})"
+
+class SessionStore(ABC):
+    """
+    Sessions by user id; a session neither read nor saved for longer than
+    ttl_seconds expires. Changes to a Session are kept once it is passed to save().
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+
+    def create(self, user_id, state=None, preferences=None):
+        """Start a fresh session (replacing any existing one) and save it."""
+        session = Session(user_id, state or s.USER_STATE_MAIN_MENU, preferences=preferences)
+        self.save(session)
+        return session
+
+    def get_or_create(self, user_id):
+        """Returns (session, created)."""
+        session = self.get(user_id)
+        if session is not None:
+            return session, False
+        return self.create(user_id), True
+
+    @abstractmethod
+    def get(self, user_id):
+        pass
+
+    @abstractmethod
+    def save(self, session):
+        pass
+
+    @abstractmethod
+    def delete(self, user_id):
+        pass
+
+    def preference_changed(self, user_id, name, value):
+        """Called after a preference was written to the database."""
+
+    @abstractmethod
+    def states(self, limit=1000):
+        """(user_id, state) of live sessions, most recently used first."""
+
+    @abstractmethod
+    def count(self):
+        pass
+
+class MemorySessionStore(SessionStore):
+    """Sessions in this process: least recently used first, bounded to max_sessions."""
+
+    backend = 'memory'
+
+    def __init__(self, ttl_seconds, max_sessions):
+        super().__init__(ttl_seconds)
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict() # user_id -> (session, monotonic time last used)
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        """Drop idle sessions from the least recently used end. Caller holds _lock."""
+        expired = 0
+        while self._sessions:
+            _, last_used = next(iter(self._sessions.values()))
+            if now - last_used <= self.ttl_seconds:
+                break
+            self._sessions.popitem(last=False)
+            expired += 1
+        if expired:
+            logger.debug(s.LOG_SESSIONS_EXPIRED.format(backend=self.backend, count=expired))
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(user_id)
+            if entry is None:
+                return None
+            self._sessions[user_id] = (entry[0], now)
+            self._sessions.move_to_end(user_id)
+            return entry[0]
+
+    def save(self, session):
+        with self._lock:
+            self._sessions[session.user_id] = (session, time.monotonic())
+            self._sessions.move_to_end(session.user_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def preference_changed(self, user_id, name, value):
+        with self._lock:
+            entry = self._sessions.get(user_id)
+        if entry is not None:
+            entry[0].preference_changed(name, value)
+
+    def states(self, limit=1000):
+        with self._lock:
+            self._expire(time.monotonic())
+            return [(user_id, session.state) for user_id, (session, _) in reversed(self._sessions.items())][:limit]
+
+    def count(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._sessions)
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions in the user_sessions table, so every worker process sees the same
+    state and it survives a restart. Each get() reads the row afresh and refreshes
+    its last_seen; preferences are not stored with it and load lazily from user_preferences.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, ttl_seconds, purge_interval_seconds):
+        super().__init__(ttl_seconds)
+        self.purge_interval_seconds = purge_interval_seconds
+        self._last_purge = time.monotonic()
+        self._purge_lock = threading.Lock()
+
+    def _min_last_seen(self):
+        return time.time() - self.ttl_seconds
+
+    def get(self, user_id):
+        row = db.get_session(user_id, self._min_last_seen(), time.time())
+        if row is None:
+            return None
+        return Session(user_id, row['state'], json.loads(row['data_json']))
+
+    def save(self, session):
+        db.save_session(session.user_id, session.state, json.dumps(session.data), time.time())
+        self._maybe_purge()
+
+    def _maybe_purge(self):
+        """Delete expired rows, at most once per purge interval (readers already ignore them)."""
+        with self._purge_lock:
+            if time.monotonic() - self._last_purge < self.purge_interval_seconds:
+                return
+            self._last_purge = time.monotonic()
+        expired = db.purge_expired_sessions(self._min_last_seen())
+        if expired:
+            logger.debug(s.LOG_SESSIONS_EXPIRED.format(backend=self.backend, count=expired))
+
+    def delete(self, user_id):
+        db.delete_session(user_id)
+
+    def states(self, limit=1000):
+        return db.get_session_states(self._min_last_seen(), limit)
+
+    def count(self):
+        return db.count_sessions(self._min_last_seen())
+
+def create_session_store(backend=None):
+    """The session store selected by SESSION_BACKEND (memory when unknown)."""
+    backend = (backend or config.SESSION_BACKEND).lower()
+    if backend not in SESSION_BACKENDS:
+        logger.warning(s.WARN_SESSION_UNKNOWN_BACKEND.format(backend=backend))
+        backend = 'memory'
+    if backend == 'sqlite':
+        store = SQLiteSessionStore(config.SESSION_TTL_SECONDS, config.SESSION_PURGE_INTERVAL_SECONDS)
+    else:
+        store = MemorySessionStore(config.SESSION_TTL_SECONDS, config.SESSION_MAX_IN_MEMORY)
+    logger.info(s.LOG_SESSION_STORE_READY.format(backend=backend, ttl=config.SESSION_TTL_SECONDS))
+    return store
@@ -25,15 +25,34 @@ LOG_APPS_SCRIPT_WEB_APP_SUCCESS = "APPS_SCRIPT_WEB_APP_URL retrieved successfull
 
 # --- Database ---
 LOG_DB_INIT_SUCCESS = "Database initialized successfully"
+LOG_DB_SCHEMA_VERSION = "Database schema version: {version} (latest: {latest})"
+LOG_DB_MIGRATION_APPLIED = "Applied database migration {version}: {name}"
+LOG_DB_JOURNAL_MODE = "Database journal mode: {mode}"
+WARN_DB_JOURNAL_MODE_NOT_APPLIED = "Requested journal mode '{requested}' was not applied, database is using '{actual}'"
+ERROR_DB_SCHEMA_TOO_NEW = "Database schema version {version} is newer than this code supports ({latest})"
+LOG_DB_WRITER_STARTED = "Database writer thread started (mode: {mode}, batch: {batch_ms} ms / {batch_rows} rows)"
+LOG_DB_WRITER_STOPPED = "Database writer thread stopped"
+WARN_DB_UNKNOWN_WRITE_MODE = "Unknown DB_WRITE_MODE '{mode}', falling back to 'sync'"
+LOG_SESSION_STORE_READY = "User sessions stored in '{backend}' (idle sessions expire after {ttl:.0f}s)"
+WARN_SESSION_UNKNOWN_BACKEND = "Unknown SESSION_BACKEND '{backend}', falling back to 'memory'"
+LOG_SESSIONS_EXPIRED = "Expired {count} idle session(s) from the {backend} session store"
+ERROR_DB_WRITE_BATCH_FAILED = "Batched write of {count} rows failed, retrying rows individually: {error}"
+ERROR_DB_QUEUED_WRITE_FAILED = "Queued database write failed and was dropped: {error} (SQL: {sql_preview})"
 LOG_DB_SAVED_MESSAGE = "Saved message from user {user_id}: {text_preview}..."
 LOG_DB_SAVED_MEDIA_MESSAGE = "Saved {message_type} message from user {user_id}"
 LOG_DB_SAVED_PROCESSED_TEXT = "Saved '{message_type}' text to user_messages for user {user_id}, original message_id {original_message_id}"
 ERROR_DB_SAVING_PROCESSED_TEXT = "Error saving '{message_type}' text to user_messages for user {user_id}: {db_err}"
 LOG_DB_DELETED_USER_DATA = "Deleted user data for user_id {user_id}: {messages_deleted} messages, {interactions_deleted} interactions"
 ERROR_DB_DELETING_USER_DATA = "Error deleting user data: {error}"
+LOG_DB_USER_DELETION_QUEUED = "User {user_id} marked for deletion (chat {chat_id})"
+LOG_DB_USER_DELETION_PROGRESS = "Deleting data for user {user_id}: {messages_deleted} messages, {interactions_deleted} interactions, {images_deleted} image results so far"
+LOG_DB_DELETION_REAPER_STARTED = "Deletion reaper started (batch of {batch_rows} rows, {pause_ms} ms pause)"
+LOG_DB_DELETION_REAPER_STOPPED = "Deletion reaper stopped"
+ERROR_DB_DELETION_REPORT_FAILED = "Reporting deletion progress for user {user_id} failed: {error}"
 LOG_DB_RETRIEVED_HISTORY = "Retrieved {count} messages for user {user_id}, including processed/retrieved data"
 LOG_DB_INITIATING_IMAGE_RESULT_STORAGE = "Initiating database storage for Gemini API response for user_id: {user_id}, message_id: {message_id}"
 LOG_DB_IMAGE_RESULT_STORED = "Successfully stored Gemini API response in database (record ID: {record_id})"
+LOG_DB_IMAGE_CACHE_EVICTED = "Evicted {count} image result cache entries (keeping at most {max_entries}, {max_age_days} days)"
 ERROR_DB_SAVING_IMAGE_RESULT = "Error saving image processing result to database: {error}"
 LOG_DB_SEARCHING_FORM_ID = "Searching for 'form=<ID>' in last {search_limit} messages for user {user_id}"
 LOG_DB_FOUND_FORM_ID = "Found response ID: {response_id} in message: '{message_text}'"
@@ -42,6 +61,13 @@ ERROR_DB_RETRIEVING_USERS = "Error retrieving users from DB: {error}"
 ERROR_DB_RETRIEVING_IMAGE_RESULTS = "Error retrieving image processing results from DB: {error}"
 ERROR_DB_RETRIEVING_MESSAGES = "Error retrieving user messages from DB: {error}"
 ERROR_DB_RETRIEVING_INTERACTIONS = "Error retrieving user interactions from DB: {error}"
+ERROR_INVALID_PAGE_CURSOR = "Invalid pagination cursor"
+ERROR_INVALID_PAGE_LIMIT = "Invalid limit, must be an integer between 1 and {max_limit}"
+LOG_EXPORT_STARTED = "Starting {export_format} export of {tables} for {scope}"
+LOG_EXPORT_FINISHED = "Finished {export_format} export for {scope}: {row_count} rows"
+ERROR_EXPORT_FAILED = "Export for {scope} failed: {error}"
+ERROR_EXPORT_INVALID_FORMAT = "Invalid export format '{export_format}', must be one of: {formats}"
+ERROR_EXPORT_INVALID_TABLES = "Invalid export tables '{tables}', must be a comma-separated subset of: {valid_tables}"
 ERROR_DB_UPDATING_PREFERENCE = "Failed to update preference in DB"
 ERROR_DB_HEALTH_CHECK = "Health check DB error: {error}"
 DB_STATUS_OK = 'ok'
@@ -82,6 +108,24 @@ WARN_GOOGLE_API_NO_TOKEN = "Google API credentials refreshed but no token was ob
 WARN_GOOGLE_API_REFRESH_FAILED = "Token refresh failed, but continuing: {error}"
 LOG_GOOGLE_API_CREDS_SUCCESS = "Successfully obtained credentials for Google APIs."
 ERROR_GETTING_GOOGLE_API_CREDS = "Error getting Google API credentials: {error}"
+LOG_CREDENTIAL_CACHE_REFRESHING = "Refreshing cached Google credentials for scopes: {scopes}"
+LOG_CREDENTIAL_CACHE_REFRESHED = "Cached Google credentials refreshed for scopes {scopes}, token expires at {expiry_time}"
+WARN_CREDENTIAL_BACKGROUND_REFRESH_FAILED = "Background refresh of Google credentials for scopes {scopes} failed: {error}"
+LOG_CREDENTIAL_REFRESHER_STARTED = "Credential refresher started (checks every {check_seconds}s, refreshes {margin_seconds}s before expiry)"
+LOG_GOOGLE_SERVICE_BUILT = "Built {service_name} {version} API client (static discovery document, reused from now on)"
+LOG_FORM_SYNC_STARTED = "Syncing responses of form {form_id} (since {watermark})"
+LOG_FORM_SYNC_FINISHED = "Synced {count} responses of form {form_id} in {pages} page(s); watermark now {watermark}"
+WARN_FORM_SYNC_FAILED = "Syncing responses of form {form_id} failed, using the local mirror: {error}"
+LOG_FORM_MIRROR_HIT = "Found response for {field}={value} of form {form_id} in the local mirror"
+FORM_PATIENT_NOT_FOUND_USER_MSG = "No response found for patient_id {patient_id}"
+LOG_FORM_STRUCTURE_RETRIEVING = "Retrieving form structure for form {form_id}"
+LOG_FORM_STRUCTURE_REVALIDATED = "Form {form_id} unchanged (revision {revision_id}); keeping cached structure"
+WARN_FORM_STRUCTURE_STALE = "Could not refresh structure of form {form_id}, using the cached copy: {error}"
+WARN_FORM_STRUCTURE_CACHE_FILE = "Form structure cache file {path} could not be used: {error}"
+ERROR_FORM_STRUCTURE_UNEXPECTED = "Unexpected error getting question map for form {form_id}: {error}"
+LOG_HTTP_SESSION_CREATED = "Shared HTTP session created ({protocol}, {pool_maxsize} connections per host, {retries} retries)"
+WARN_HTTP2_UNAVAILABLE = "HTTP_USE_HTTP2 is set but httpx[http2] is not installed; using HTTP/1.1"
+LOG_HTTP_RETRYING = "HTTP {method} {host} returned {status}; retry {attempt} in {delay:.2f}s"
 LOG_GEMINI_REQUEST_INITIATED = "Initiating Gemini API request for image from user_id: {user_id}"
 ERROR_GEMINI_AUTH_FAILED = "Failed to get authenticated credentials for Gemini"
 ERROR_GEMINI_AUTH_FAILED_MSG = "Authentication failed."
@@ -115,6 +159,8 @@ ERROR_GEMINI_TEXT_TOKEN_MISSING = "Credentials obtained but token is missing aft
 ERROR_GEMINI_TEXT_TOKEN_MISSING_MSG = "Authentication token issue."
 LOG_GEMINI_TEXT_USING_TOKEN = "Using token starting with: {token_preview} for text analysis"
 LOG_GEMINI_TEXT_SENDING_REQUEST = "Sending text analysis request to Gemini API endpoint: {endpoint}"
+LOG_GEMINI_TEXT_ANALYSIS_CANCELLED = "Gemini text analysis for user {user_id} cancelled (superseded by newer messages)"
+LOG_GEMINI_STREAM_COMPLETE = "Gemini stream finished: {segments} segments, {chars} characters"
 LOG_GEMINI_TEXT_ANALYSIS_SUCCESS = "Successfully received and extracted Gemini analysis for user {user_id}"
 ERROR_GEMINI_TEXT_REQUEST_FAILED = "HTTP request error calling Gemini API for text analysis: {error}"
 ERROR_GEMINI_TEXT_JSON_DECODE = "Error parsing Gemini JSON response for text analysis: {error}"
@@ -160,8 +206,8 @@ LOG_WEB_APP_CALL_INITIATED = "Initiating call to Apps Script Web App for ID: {id
 ERROR_WEB_APP_NOT_CONFIGURED = "Web App URL or API Key is not configured."
 ERROR_WEB_APP_NOT_CONFIGURED_USER_MSG = "Web App retrieval is not configured on the server."
 LOG_WEB_APP_MAKING_REQUEST = "Making GET request to Web App URL (parameters omitted for security)"
-LOG_WEB_APP_ATTEMPTING_GET = "Attempting requests.get to {target_url} with timeout=30..."
-LOG_WEB_APP_GET_COMPLETED = "requests.get call completed. Status code received: {status_code}"
+LOG_WEB_APP_ATTEMPTING_GET = "Attempting GET to {target_url} with timeout={timeout}s..."
+LOG_WEB_APP_GET_COMPLETED = "GET call completed. Status code received: {status_code}"
 LOG_WEB_APP_RESPONSE_RECEIVED = "Received response from Web App. Status: {status_code}, Content-Type: {content_type}"
 LOG_WEB_APP_RAW_RESPONSE = "Raw response text (first 500 chars): {text_preview}"
 WARN_WEB_APP_NOT_FOUND = "Web App returned 'Not Found' for ID: {id_to_find}"
@@ -229,6 +275,7 @@ PHOTO_PROCESSING_USER_MSG = "Processing your image..."
 PHOTO_DOWNLOAD_FAILED_USER_MSG = "Sorry, I couldn't download your image."
 LOG_DOWNLOAD_IMAGE_ERROR = 'download_image_error'
 LOG_IMAGE_PROCESSING_WORKFLOW_START = "Starting image processing workflow for user {user_id}"
+LOG_IMAGE_CACHE_HIT = "User {user_id}: image {image_hash}... analysed before, reusing the stored Gemini result"
 PHOTO_PROCESSING_FAILED_USER_MSG = "Sorry, I couldn't process your image. Error: {error_text}"
 LOG_GEMINI_PROCESSING_ERROR = 'gemini_processing_error'
 LOG_EXTRACTED_TEXT_PREVIEW = "Extracted text from Gemini for user {user_id}: {text_preview}..."
@@ -246,6 +293,12 @@ PHOTO_PROCESSED_NEXT_ACTION_USER_MSG = "Image processed. What would you like to
 ERROR_IMAGE_WORKFLOW = "Error in image processing workflow: {error}"
 PHOTO_ERROR_USER_MSG = "Sorry, an error occurred while processing your image."
 LOG_PHOTO_WORKFLOW_ERROR = 'photo_workflow_error'
+PHOTO_QUEUE_FULL_USER_MSG = "I'm processing a lot of images right now. Please send this one again in a few minutes."
+LOG_PHOTO_QUEUE_FULL = 'photo_queue_full'
+ANALYSIS_QUEUE_FULL_USER_MSG = "I'm analyzing a lot of conversations right now. Please try again in a few minutes."
+LOG_ANALYSIS_QUEUE_FULL = 'analysis_queue_full'
+WARN_JOB_QUEUE_FULL = "Job queue {queue} is full, rejected a job for {key} (depth {depth})"
+ERROR_JOB_FAILED = "Job in queue {queue} for {key} failed: {error}"
 LOG_IMAGE_WORKFLOW_CLEANUP_COMPLETE = "Completed image processing workflow cleanup for user {user_id}"
 TEXT_UNKNOWN_COMMAND_USER_MSG = "Sorry, I don't understand that command."
 LOG_SKIPPED_MENU_FOR_COMMAND = "Skipped sending main menu from handle_text for command '{command}' in chat {chat_id}"
@@ -293,15 +346,26 @@ LOG_CALLBACK_CONFIRM_DELETE = "User {user_id}: Confirmed data deletion"
 CALLBACK_DELETE_SUCCESS_USER_MSG = "✅ Data deleted ({msg_del} msgs, {int_del} interactions). Use /start again."
 CALLBACK_DELETE_SUCCESS_NEXT_ACTION = "Data deleted. Choose an option:"
 CALLBACK_DELETE_ERROR_USER_MSG = "❌ Error deleting data."
+CALLBACK_DELETE_PENDING_USER_MSG = "🗑️ Deleting your data... You'll get a message here when it's done."
+CALLBACK_DELETE_PROGRESS_USER_MSG = "🗑️ Deleting your data... {msg_del} msgs, {int_del} interactions removed so far."
+CALLBACK_DELETE_ALREADY_PENDING = "Your data is already being deleted."
 LOG_CALLBACK_CANCEL_DELETE = "User {user_id}: Canceled data deletion"
 LOG_CALLBACK_MENU1 = "User {user_id}: Menu 1 (Analyze Messages) selected"
 CALLBACK_ANALYZING_MESSAGES = "Analyzing messages..."
 CALLBACK_NO_MESSAGES_TO_ANALYZE = "No messages to analyze."
 CALLBACK_ANALYSIS_PROMPT_JSON = "- JSON Data: {formatted_json}\n"
+LOG_ANALYSIS_SUPERSEDED = "Analysis for user {user_id} superseded by newer messages; result discarded"
+LOG_BURST_ITEM_QUEUED = "{name}: queued item for {key} ({count} in burst)"
+LOG_BURST_RUNNING = "{name}: running burst of {count} items for {key}"
+ERROR_BURST_RUN_FAILED = "{name}: burst run for {key} failed: {error}"
+WARN_BURST_STATUS_FAILED = "{name}: could not open the status message for {key}: {error}"
+LOG_PROMPT_BUILT = "Analysis prompt for user {user_id}: {new_rows} new history rows, {items} history items, ~{tokens}/{budget} tokens"
 CALLBACK_ANALYSIS_PROMPT_TEXT = "- {text}\n"
 LOG_SENDING_PROMPT_TO_GEMINI = "Sending prompt to Gemini for analysis (user {user_id}): {prompt_preview}..."
 CALLBACK_ANALYSIS_ERROR_USER_MSG = "Sorry, couldn't analyze messages. Error: {error_text}"
 CALLBACK_ANALYSIS_RESULT_USER_MSG = "📊 Analysis:\n\n{analysis_result}"
+CALLBACK_ANALYSIS_PARTIAL_USER_MSG = "📊 Analysis:\n\n{analysis_result} …"
+WARN_ANALYSIS_PROGRESS_EDIT_FAILED = "Could not show analysis progress in chat {chat_id}: {error}"
 LOG_CALLBACK_MENU2 = "User {user_id}: Menu 2 selected"
 CALLBACK_MENU2_USER_MSG = "Selected Menu 2. Choose subitem:"
 LOG_CALLBACK_MAIN_MENU = "User {user_id}: Returned to main menu"
@@ -349,6 +413,10 @@ USER_STATE_MENU2 = 'menu2'
 
 # --- Flask App ---
 LOG_WEBHOOK_RECEIVED = "Received update via webhook: {json_preview}..."
+WARN_WEBHOOK_BAD_SECRET = "Webhook request from {remote_addr} without the expected secret token; rejected"
+WARN_WEBHOOK_INVALID_UPDATE = "Invalid webhook update ignored: {error}"
+ERROR_WEBHOOK_EMPTY_UPDATE = "Empty update"
+WEBHOOK_BUSY_ERROR = "Update queue full, try again later"
 ERROR_WEBHOOK_PROCESSING = "Error processing webhook update: {error}"
 LOG_WEBHOOK_SET = "Webhook set to {url}"
 ERROR_WEBHOOK_SET = "Error setting webhook: {error}"
@@ -435,6 +503,13 @@ LOG_WEBHOOK_STATUS_CHECK = "Webhook status check: URL='{url}', Pending Updates={
 WARN_TELEGRAM_WEBHOOK_ERROR = "Telegram reported webhook error: {error_message}"
 FATAL_WEBHOOK_SET_API_ERROR = "FATAL: Failed to set webhook due to Telegram API error: {error}"
 FATAL_WEBHOOK_SET_OTHER_ERROR = "FATAL: Failed to set webhook due to other error: {error}"
+LOG_REAPER_OWNED_ELSEWHERE = "Deletion reaper runs in another process; not starting it in {pid}"
+LOG_SHUTTING_DOWN_SERVICES = "Stopping background services in process {pid}"
+ERROR_ASYNC_ENGINE_UNAVAILABLE = "The async engine needs aiohttp (pip install aiohttp); use BOT_ENGINE=sync or install it"
+WARN_ASYNC_UPDATE_SHED = "Update lanes stopped; dropped update {update_id} received by the async engine"
+ERROR_ASYNC_TEXT_FAILED = "Async engine failed to handle a text message: {error}"
+LOG_ASYNC_ENGINE_STARTED = "Async engine started ({db_threads} DB threads, up to {connections} Gemini connections)"
+LOG_STARTING_ASYNC_ENGINE = "Starting bot with the async engine (long polling)..."
 LOG_STARTING_FLASK = "Starting Flask server on 0.0.0.0:{port} with SSL..."
 FATAL_SSL_FILES_NOT_FOUND_FLASK = "FATAL: SSL certificate or key file not found for Flask server."
 LOG_CERT_PATH_CHECKED = "Cert path checked: {path}"
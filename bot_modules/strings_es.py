@@ -25,15 +25,34 @@ LOG_APPS_SCRIPT_WEB_APP_SUCCESS = "APPS_SCRIPT_WEB_APP_URL obtenida con éxito."
 
 # --- Database ---
 LOG_DB_INIT_SUCCESS = "Base de datos inicializada con éxito"
+LOG_DB_SCHEMA_VERSION = "Versión del esquema de la base de datos: {version} (última: {latest})"
+LOG_DB_MIGRATION_APPLIED = "Migración de base de datos {version} aplicada: {name}"
+LOG_DB_JOURNAL_MODE = "Modo de journal de la base de datos: {mode}"
+WARN_DB_JOURNAL_MODE_NOT_APPLIED = "No se aplicó el modo de journal solicitado '{requested}', la base de datos usa '{actual}'"
+ERROR_DB_SCHEMA_TOO_NEW = "La versión del esquema de la base de datos {version} es más reciente que la soportada por este código ({latest})"
+LOG_DB_WRITER_STARTED = "Hilo de escritura de la base de datos iniciado (modo: {mode}, lote: {batch_ms} ms / {batch_rows} filas)"
+LOG_DB_WRITER_STOPPED = "Hilo de escritura de la base de datos detenido"
+WARN_DB_UNKNOWN_WRITE_MODE = "DB_WRITE_MODE desconocido '{mode}', se usará 'sync'"
+LOG_SESSION_STORE_READY = "Sesiones de usuario almacenadas en '{backend}' (las sesiones inactivas caducan tras {ttl:.0f}s)"
+WARN_SESSION_UNKNOWN_BACKEND = "SESSION_BACKEND desconocido '{backend}', se usará 'memory'"
+LOG_SESSIONS_EXPIRED = "{count} sesión(es) inactiva(s) caducada(s) en el almacén de sesiones {backend}"
+ERROR_DB_WRITE_BATCH_FAILED = "Falló la escritura en lote de {count} filas, reintentando fila por fila: {error}"
+ERROR_DB_QUEUED_WRITE_FAILED = "Falló una escritura en cola de la base de datos y se descartó: {error} (SQL: {sql_preview})"
 LOG_DB_SAVED_MESSAGE = "Mensaje guardado del usuario {user_id}: {text_preview}..."
 LOG_DB_SAVED_MEDIA_MESSAGE = "Mensaje {message_type} guardado del usuario {user_id}"
 LOG_DB_SAVED_PROCESSED_TEXT = "Texto '{message_type}' guardado en user_messages para el usuario {user_id}, message_id original {original_message_id}"
 ERROR_DB_SAVING_PROCESSED_TEXT = "Error al guardar el texto '{message_type}' en user_messages para el usuario {user_id}: {db_err}"
 LOG_DB_DELETED_USER_DATA = "Datos de usuario eliminados para user_id {user_id}: {messages_deleted} mensajes, {interactions_deleted} interacciones"
 ERROR_DB_DELETING_USER_DATA = "Error al eliminar datos de usuario: {error}"
+LOG_DB_USER_DELETION_QUEUED = "Usuario {user_id} marcado para eliminación (chat {chat_id})"
+LOG_DB_USER_DELETION_PROGRESS = "Eliminando datos del usuario {user_id}: {messages_deleted} mensajes, {interactions_deleted} interacciones, {images_deleted} resultados de imagen hasta ahora"
+LOG_DB_DELETION_REAPER_STARTED = "Proceso de eliminación iniciado (lotes de {batch_rows} filas, pausa de {pause_ms} ms)"
+LOG_DB_DELETION_REAPER_STOPPED = "Proceso de eliminación detenido"
+ERROR_DB_DELETION_REPORT_FAILED = "Falló el informe de progreso de eliminación para el usuario {user_id}: {error}"
 LOG_DB_RETRIEVED_HISTORY = "Se recuperaron {count} mensajes para el usuario {user_id}, incluyendo datos procesados/recuperados"
 LOG_DB_INITIATING_IMAGE_RESULT_STORAGE = "Iniciando almacenamiento en base de datos para respuesta de API Gemini para user_id: {user_id}, message_id: {message_id}"
 LOG_DB_IMAGE_RESULT_STORED = "Respuesta de API Gemini almacenada con éxito en la base de datos (ID de registro: {record_id})"
+LOG_DB_IMAGE_CACHE_EVICTED = "Eliminadas {count} entradas de la caché de resultados de imagen (máximo {max_entries}, {max_age_days} días)"
 ERROR_DB_SAVING_IMAGE_RESULT = "Error al guardar el resultado del procesamiento de imagen en la base de datos: {error}"
 LOG_DB_SEARCHING_FORM_ID = "Buscando 'form=<ID>' en los últimos {search_limit} mensajes para el usuario {user_id}"
 LOG_DB_FOUND_FORM_ID = "ID de respuesta encontrado: {response_id} en el mensaje: '{message_text}'"
@@ -42,6 +61,13 @@ ERROR_DB_RETRIEVING_USERS = "Error al recuperar usuarios de la BD: {error}"
 ERROR_DB_RETRIEVING_IMAGE_RESULTS = "Error al recuperar resultados de procesamiento de imágenes de la BD: {error}"
 ERROR_DB_RETRIEVING_MESSAGES = "Error al recuperar mensajes de usuario de la BD: {error}"
 ERROR_DB_RETRIEVING_INTERACTIONS = "Error al recuperar interacciones de usuario de la BD: {error}"
+ERROR_INVALID_PAGE_CURSOR = "Cursor de paginación inválido"
+ERROR_INVALID_PAGE_LIMIT = "Límite inválido, debe ser un entero entre 1 y {max_limit}"
+LOG_EXPORT_STARTED = "Iniciando exportación {export_format} de {tables} para {scope}"
+LOG_EXPORT_FINISHED = "Exportación {export_format} finalizada para {scope}: {row_count} filas"
+ERROR_EXPORT_FAILED = "Falló la exportación para {scope}: {error}"
+ERROR_EXPORT_INVALID_FORMAT = "Formato de exportación inválido '{export_format}', debe ser uno de: {formats}"
+ERROR_EXPORT_INVALID_TABLES = "Tablas de exportación inválidas '{tables}', deben ser un subconjunto separado por comas de: {valid_tables}"
 ERROR_DB_UPDATING_PREFERENCE = "Fallo al actualizar la preferencia en la BD"
 ERROR_DB_HEALTH_CHECK = "Error de BD en la comprobación de estado: {error}"
 DB_STATUS_OK = 'ok'
@@ -82,6 +108,24 @@ WARN_GOOGLE_API_NO_TOKEN = "Credenciales de API de Google refrescadas pero no se
 WARN_GOOGLE_API_REFRESH_FAILED = "Fallo al refrescar el token, pero continuando: {error}"
 LOG_GOOGLE_API_CREDS_SUCCESS = "Credenciales obtenidas con éxito para las APIs de Google."
 ERROR_GETTING_GOOGLE_API_CREDS = "Error al obtener credenciales de API de Google: {error}"
+LOG_CREDENTIAL_CACHE_REFRESHING = "Refrescando credenciales de Google en caché para los scopes: {scopes}"
+LOG_CREDENTIAL_CACHE_REFRESHED = "Credenciales de Google en caché refrescadas para los scopes {scopes}, el token expira a las {expiry_time}"
+WARN_CREDENTIAL_BACKGROUND_REFRESH_FAILED = "Falló el refresco en segundo plano de las credenciales de Google para los scopes {scopes}: {error}"
+LOG_CREDENTIAL_REFRESHER_STARTED = "Refresco de credenciales iniciado (revisa cada {check_seconds}s, refresca {margin_seconds}s antes de expirar)"
+LOG_GOOGLE_SERVICE_BUILT = "Cliente de la API {service_name} {version} construido (documento de descubrimiento estático, reutilizado desde ahora)"
+LOG_FORM_SYNC_STARTED = "Sincronizando respuestas del formulario {form_id} (desde {watermark})"
+LOG_FORM_SYNC_FINISHED = "Sincronizadas {count} respuestas del formulario {form_id} en {pages} página(s); marca de agua ahora {watermark}"
+WARN_FORM_SYNC_FAILED = "Falló la sincronización de respuestas del formulario {form_id}, usando la copia local: {error}"
+LOG_FORM_MIRROR_HIT = "Respuesta para {field}={value} del formulario {form_id} encontrada en la copia local"
+FORM_PATIENT_NOT_FOUND_USER_MSG = "No se encontró respuesta para patient_id {patient_id}"
+LOG_FORM_STRUCTURE_RETRIEVING = "Obteniendo la estructura del formulario {form_id}"
+LOG_FORM_STRUCTURE_REVALIDATED = "Formulario {form_id} sin cambios (revisión {revision_id}); se mantiene la estructura en caché"
+WARN_FORM_STRUCTURE_STALE = "No se pudo actualizar la estructura del formulario {form_id}, usando la copia en caché: {error}"
+WARN_FORM_STRUCTURE_CACHE_FILE = "No se pudo usar el archivo de caché de estructura de formularios {path}: {error}"
+ERROR_FORM_STRUCTURE_UNEXPECTED = "Error inesperado al obtener el mapa de preguntas del formulario {form_id}: {error}"
+LOG_HTTP_SESSION_CREATED = "Sesión HTTP compartida creada ({protocol}, {pool_maxsize} conexiones por host, {retries} reintentos)"
+WARN_HTTP2_UNAVAILABLE = "HTTP_USE_HTTP2 está activado pero httpx[http2] no está instalado; usando HTTP/1.1"
+LOG_HTTP_RETRYING = "HTTP {method} {host} devolvió {status}; reintento {attempt} en {delay:.2f}s"
 LOG_GEMINI_REQUEST_INITIATED = "Iniciando solicitud a la API Gemini para imagen del user_id: {user_id}"
 ERROR_GEMINI_AUTH_FAILED = "Fallo al obtener credenciales autenticadas para Gemini"
 ERROR_GEMINI_AUTH_FAILED_MSG = "Falló la autenticación."
@@ -115,6 +159,8 @@ ERROR_GEMINI_TEXT_TOKEN_MISSING = "Credenciales obtenidas pero falta el token de
 ERROR_GEMINI_TEXT_TOKEN_MISSING_MSG = "Problema con el token de autenticación."
 LOG_GEMINI_TEXT_USING_TOKEN = "Usando token que comienza con: {token_preview} para análisis de texto"
 LOG_GEMINI_TEXT_SENDING_REQUEST = "Enviando solicitud de análisis de texto al endpoint de la API Gemini: {endpoint}"
+LOG_GEMINI_TEXT_ANALYSIS_CANCELLED = "Análisis de texto con Gemini para el usuario {user_id} cancelado (reemplazado por mensajes más recientes)"
+LOG_GEMINI_STREAM_COMPLETE = "Stream de Gemini finalizado: {segments} segmentos, {chars} caracteres"
 LOG_GEMINI_TEXT_ANALYSIS_SUCCESS = "Análisis de Gemini recibido y extraído con éxito para el usuario {user_id}"
 ERROR_GEMINI_TEXT_REQUEST_FAILED = "Error de solicitud HTTP al llamar a la API Gemini para análisis de texto: {error}"
 ERROR_GEMINI_TEXT_JSON_DECODE = "Error al parsear la respuesta JSON de Gemini para análisis de texto: {error}"
@@ -160,8 +206,8 @@ LOG_WEB_APP_CALL_INITIATED = "Iniciando llamada a la Aplicación Web de Apps Scr
 ERROR_WEB_APP_NOT_CONFIGURED = "La URL de la Aplicación Web o la Clave API no están configuradas."
 ERROR_WEB_APP_NOT_CONFIGURED_USER_MSG = "La recuperación mediante Aplicación Web no está configurada en el servidor."
 LOG_WEB_APP_MAKING_REQUEST = "Realizando solicitud GET a la URL de la Aplicación Web (parámetros omitidos por seguridad)"
-LOG_WEB_APP_ATTEMPTING_GET = "Intentando requests.get a {target_url} con timeout=30..."
-LOG_WEB_APP_GET_COMPLETED = "Llamada requests.get completada. Código de estado recibido: {status_code}"
+LOG_WEB_APP_ATTEMPTING_GET = "Intentando GET a {target_url} con timeout={timeout}s..."
+LOG_WEB_APP_GET_COMPLETED = "Llamada GET completada. Código de estado recibido: {status_code}"
 LOG_WEB_APP_RESPONSE_RECEIVED = "Respuesta recibida de la Aplicación Web. Estado: {status_code}, Content-Type: {content_type}"
 LOG_WEB_APP_RAW_RESPONSE = "Texto de respuesta crudo (primeros 500 caracteres): {text_preview}"
 WARN_WEB_APP_NOT_FOUND = "La Aplicación Web devolvió 'No Encontrado' para el ID: {id_to_find}"
@@ -229,6 +275,7 @@ PHOTO_PROCESSING_USER_MSG = "Procesando tu imagen..."
 PHOTO_DOWNLOAD_FAILED_USER_MSG = "Lo siento, no pude descargar tu imagen."
 LOG_DOWNLOAD_IMAGE_ERROR = 'error_descarga_imagen' # 'download_image_error'
 LOG_IMAGE_PROCESSING_WORKFLOW_START = "Iniciando flujo de trabajo de procesamiento de imagen para el usuario {user_id}"
+LOG_IMAGE_CACHE_HIT = "Usuario {user_id}: imagen {image_hash}... ya analizada, reutilizando el resultado de Gemini guardado"
 PHOTO_PROCESSING_FAILED_USER_MSG = "Lo siento, no pude procesar tu imagen. Error: {error_text}"
 LOG_GEMINI_PROCESSING_ERROR = 'error_procesamiento_gemini' # 'gemini_processing_error'
 LOG_EXTRACTED_TEXT_PREVIEW = "Texto extraído de Gemini para el usuario {user_id}: {text_preview}..."
@@ -246,6 +293,12 @@ PHOTO_PROCESSED_NEXT_ACTION_USER_MSG = "Imagen procesada. ¿Qué te gustaría ha
 ERROR_IMAGE_WORKFLOW = "Error en el flujo de trabajo de procesamiento de imagen: {error}"
 PHOTO_ERROR_USER_MSG = "Lo siento, ocurrió un error mientras procesaba tu imagen."
 LOG_PHOTO_WORKFLOW_ERROR = 'error_flujo_trabajo_foto' # 'photo_workflow_error'
+PHOTO_QUEUE_FULL_USER_MSG = "Estoy procesando muchas imágenes en este momento. Por favor, vuelve a enviar esta en unos minutos."
+LOG_PHOTO_QUEUE_FULL = 'cola_fotos_llena' # 'photo_queue_full'
+ANALYSIS_QUEUE_FULL_USER_MSG = "Estoy analizando muchas conversaciones en este momento. Por favor, inténtalo de nuevo en unos minutos."
+LOG_ANALYSIS_QUEUE_FULL = 'cola_analisis_llena' # 'analysis_queue_full'
+WARN_JOB_QUEUE_FULL = "La cola de trabajos {queue} está llena, trabajo rechazado para {key} (profundidad {depth})"
+ERROR_JOB_FAILED = "Falló un trabajo de la cola {queue} para {key}: {error}"
 LOG_IMAGE_WORKFLOW_CLEANUP_COMPLETE = "Limpieza del flujo de trabajo de procesamiento de imagen completada para el usuario {user_id}"
 TEXT_UNKNOWN_COMMAND_USER_MSG = "Lo siento, no entiendo ese comando."
 LOG_SKIPPED_MENU_FOR_COMMAND = "Se omitió el envío del menú principal desde handle_text para el comando '{command}' en el chat {chat_id}"
@@ -293,15 +346,26 @@ LOG_CALLBACK_CONFIRM_DELETE = "Usuario {user_id}: Confirmó eliminación de dato
 CALLBACK_DELETE_SUCCESS_USER_MSG = "✅ Datos eliminados ({msg_del} msgs, {int_del} interacciones). Usa /start de nuevo."
 CALLBACK_DELETE_SUCCESS_NEXT_ACTION = "Datos eliminados. Elige una opción:"
 CALLBACK_DELETE_ERROR_USER_MSG = "❌ Error al eliminar datos."
+CALLBACK_DELETE_PENDING_USER_MSG = "🗑️ Eliminando tus datos... Recibirás un mensaje aquí cuando termine."
+CALLBACK_DELETE_PROGRESS_USER_MSG = "🗑️ Eliminando tus datos... {msg_del} msgs, {int_del} interacciones eliminadas hasta ahora."
+CALLBACK_DELETE_ALREADY_PENDING = "Tus datos ya se están eliminando."
 LOG_CALLBACK_CANCEL_DELETE = "Usuario {user_id}: Canceló eliminación de datos"
 LOG_CALLBACK_MENU1 = "Usuario {user_id}: Menú 1 (Analizar Mensajes) seleccionado"
 CALLBACK_ANALYZING_MESSAGES = "Analizando mensajes..."
 CALLBACK_NO_MESSAGES_TO_ANALYZE = "No hay mensajes para analizar."
 CALLBACK_ANALYSIS_PROMPT_JSON = "- Datos JSON: {formatted_json}\n"
+LOG_ANALYSIS_SUPERSEDED = "Análisis del usuario {user_id} reemplazado por mensajes más recientes; resultado descartado"
+LOG_BURST_ITEM_QUEUED = "{name}: elemento en cola para {key} ({count} en la ráfaga)"
+LOG_BURST_RUNNING = "{name}: procesando ráfaga de {count} elementos para {key}"
+ERROR_BURST_RUN_FAILED = "{name}: falló el procesamiento de la ráfaga para {key}: {error}"
+WARN_BURST_STATUS_FAILED = "{name}: no se pudo abrir el mensaje de estado para {key}: {error}"
+LOG_PROMPT_BUILT = "Prompt de análisis para el usuario {user_id}: {new_rows} filas nuevas de historial, {items} elementos de historial, ~{tokens}/{budget} tokens"
 CALLBACK_ANALYSIS_PROMPT_TEXT = "- {text}\n"
 LOG_SENDING_PROMPT_TO_GEMINI = "Enviando prompt a Gemini para análisis (usuario {user_id}): {prompt_preview}..."
 CALLBACK_ANALYSIS_ERROR_USER_MSG = "Lo siento, no pude analizar los mensajes. Error: {error_text}"
 CALLBACK_ANALYSIS_RESULT_USER_MSG = "📊 Análisis:\n\n{analysis_result}"
+CALLBACK_ANALYSIS_PARTIAL_USER_MSG = "📊 Análisis:\n\n{analysis_result} …"
+WARN_ANALYSIS_PROGRESS_EDIT_FAILED = "No se pudo mostrar el progreso del análisis en el chat {chat_id}: {error}"
 LOG_CALLBACK_MENU2 = "Usuario {user_id}: Menú 2 seleccionado"
 CALLBACK_MENU2_USER_MSG = "Menú 2 seleccionado. Elige subítem:"
 LOG_CALLBACK_MAIN_MENU = "Usuario {user_id}: Volvió al menú principal"
@@ -349,6 +413,10 @@ USER_STATE_MENU2 = 'menu2'
 
 # --- Flask App ---
 LOG_WEBHOOK_RECEIVED = "Actualización recibida vía webhook: {json_preview}..."
+WARN_WEBHOOK_BAD_SECRET = "Solicitud de webhook desde {remote_addr} sin el token secreto esperado; rechazada"
+WARN_WEBHOOK_INVALID_UPDATE = "Actualización de webhook inválida ignorada: {error}"
+ERROR_WEBHOOK_EMPTY_UPDATE = "Actualización vacía"
+WEBHOOK_BUSY_ERROR = "Cola de actualizaciones llena, inténtalo más tarde"
 ERROR_WEBHOOK_PROCESSING = "Error al procesar actualización de webhook: {error}"
 LOG_WEBHOOK_SET = "Webhook configurado en {url}"
 ERROR_WEBHOOK_SET = "Error al configurar webhook: {error}"
@@ -435,6 +503,13 @@ LOG_WEBHOOK_STATUS_CHECK = "Comprobación de estado del webhook: URL='{url}', Ac
 WARN_TELEGRAM_WEBHOOK_ERROR = "Telegram reportó error de webhook: {error_message}"
 FATAL_WEBHOOK_SET_API_ERROR = "FATAL: Fallo al configurar webhook debido a error de API de Telegram: {error}"
 FATAL_WEBHOOK_SET_OTHER_ERROR = "FATAL: Fallo al configurar webhook debido a otro error: {error}"
+LOG_REAPER_OWNED_ELSEWHERE = "El proceso de borrado se ejecuta en otro proceso; no se inicia en {pid}"
+LOG_SHUTTING_DOWN_SERVICES = "Deteniendo servicios en segundo plano en el proceso {pid}"
+ERROR_ASYNC_ENGINE_UNAVAILABLE = "El motor asíncrono necesita aiohttp (pip install aiohttp); usa BOT_ENGINE=sync o instálalo"
+WARN_ASYNC_UPDATE_SHED = "Carriles de actualizaciones detenidos; descartada la actualización {update_id} recibida por el motor asíncrono"
+ERROR_ASYNC_TEXT_FAILED = "El motor asíncrono no pudo procesar un mensaje de texto: {error}"
+LOG_ASYNC_ENGINE_STARTED = "Motor asíncrono iniciado ({db_threads} hilos de BD, hasta {connections} conexiones a Gemini)"
+LOG_STARTING_ASYNC_ENGINE = "Iniciando el bot con el motor asíncrono (long polling)..."
 LOG_STARTING_FLASK = "Iniciando servidor Flask en 0.0.0.0:{port} con SSL..."
 FATAL_SSL_FILES_NOT_FOUND_FLASK = "FATAL: Archivo de certificado o clave SSL no encontrado para el servidor Flask."
 LOG_CERT_PATH_CHECKED = "Ruta de certificado comprobada: {path}"
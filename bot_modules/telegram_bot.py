@@ -14,6 +14,10 @@ from . import config
 from . import database as db
 from . import google_apis
 from . import utils
+from .debounce import BurstDebouncer
+from .job_queue import FairJobQueue
+from .prompt_builder import AnalysisPromptBuilder
+from .session_store import create_session_store
 from . import strings_es
 from . import strings_en
 
@@ -31,13 +35,20 @@ BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
 s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
 logger.info(f"BOT_LANGUAGE set to: {BOT_LANGUAGE}")
 
-# Initialize bot
-bot = telebot.TeleBot(config.TOKEN)
+# Initialize bot. Updates are handed to the per-chat lanes in dispatcher.py (webhook,
+# polling and the async engine alike), so handlers run inline on the lane threads.
+bot = telebot.TeleBot(config.TOKEN, threaded=False)
 logger.info("TeleBot initialized.")
 
-# User sessions (kept in memory for simplicity, consider persistent storage for production)
-user_sessions = {}
-logger.info("In-memory user_sessions initialized.")
+# User sessions: in memory (LRU, idle expiry) or in SQLite, per SESSION_BACKEND
+user_sessions = create_session_store()
+
+# Photo processing runs here rather than in the telebot handler threads
+photo_queue = FairJobQueue('photo', config.PHOTO_WORKERS, config.PHOTO_QUEUE_MAX, config.PHOTO_QUEUE_MAX_PER_USER)
+# Gemini text analyses started by a handler, kept off the dispatcher lanes
+analysis_queue = FairJobQueue('analysis', config.ANALYSIS_WORKERS, config.ANALYSIS_QUEUE_MAX, config.ANALYSIS_QUEUE_MAX_PER_USER)
+# Rendered history per user for the Gemini analysis prompt
+analysis_prompts = AnalysisPromptBuilder(config.PROMPT_TOKEN_BUDGET, config.PROMPT_CONTEXT_MAX_USERS)
 
 # --- Menu Generation ---
 def generate_main_menu():
@@ -110,6 +121,22 @@ def send_main_menu_message(chat_id, text="Choose an option from the menu:"):
     logger.debug("<<< Exiting send_main_menu_message")
 
 
+def report_deletion_progress(user_id, chat_id, message_id, msg_del, int_del, done):
+    """Progress/result callback for the database deletion reaper: edits the confirmation message."""
+    if done:
+        user_sessions.delete(user_id) # Drop anything recreated while the deletion ran
+        analysis_prompts.forget(user_id)
+        text = s.CALLBACK_DELETE_SUCCESS_USER_MSG.format(msg_del=msg_del, int_del=int_del)
+    else:
+        text = s.CALLBACK_DELETE_PROGRESS_USER_MSG.format(msg_del=msg_del, int_del=int_del)
+    if message_id:
+        bot.edit_message_text(text, chat_id, message_id)
+    else:
+        bot.send_message(chat_id, text)
+    if done:
+        send_main_menu_message(chat_id, text=s.CALLBACK_DELETE_SUCCESS_NEXT_ACTION)
+
+
 # --- Telegram Utilities ---
 def download_image_from_telegram(file_id, user_id, message_id):
     """Download an image from Telegram servers using file_id"""
@@ -216,7 +243,7 @@ def handle_start_help(message):
         prefs = db.get_user_preferences(user_id)
         logger.debug(f"User {user_id} preferences: {prefs}")
         logger.debug(f"Initializing session for user {user_id}...")
-        user_sessions[user_id] = {'state': s.USER_STATE_MAIN_MENU, 'data': {}, 'preferences': prefs}
+        user_sessions.create(user_id, preferences=prefs)
         welcome_text_key = s.WELCOME_MESSAGE_DEFAULT_ES if prefs.get('language') == 'es' else s.WELCOME_MESSAGE_DEFAULT
         logger.debug(f"Determined welcome text key: {welcome_text_key}")
         logger.debug(f"Calling send_main_menu_message for chat_id {chat_id}...")
@@ -261,30 +288,50 @@ def handle_photo(message):
     processing_msg = bot.reply_to(message, s.PHOTO_PROCESSING_USER_MSG)
     logger.debug(f"Processing message sent, ID: {processing_msg.message_id}")
 
+    # The slow part (download, Gemini, storage) runs on the photo worker pool; the worker edits the reply when done
+    if photo_queue.submit(user_id, _process_photo, user_id, chat_id, message_id, file_id, processing_msg.message_id):
+        logger.debug(f"Photo job queued for user {user_id} (queue depth {photo_queue.metrics()['depth']})")
+    else:
+        bot.edit_message_text(s.PHOTO_QUEUE_FULL_USER_MSG, chat_id, processing_msg.message_id)
+        db.log_interaction(user_id, s.LOG_PHOTO_QUEUE_FULL)
+    logger.debug("<<< Exiting handle_photo")
+
+
+def _process_photo(user_id, chat_id, message_id, file_id, processing_message_id):
+    """Photo job: download, analyse (or reuse a cached result), store, and edit the processing message."""
+    logger.debug(f">>> Entering _process_photo for user: {user_id}, chat: {chat_id}, msg_id: {message_id}")
     image_path = None
     try:
         logger.debug(f"Attempting to download image for file_id: {file_id}")
         image_path = download_image_from_telegram(file_id, user_id, message_id)
         if not image_path:
             logger.warning(f"Image download failed for file_id: {file_id}")
-            logger.debug(f"Editing message {processing_msg.message_id} to show download failed.")
-            bot.edit_message_text(s.PHOTO_DOWNLOAD_FAILED_USER_MSG, chat_id, processing_msg.message_id)
+            logger.debug(f"Editing message {processing_message_id} to show download failed.")
+            bot.edit_message_text(s.PHOTO_DOWNLOAD_FAILED_USER_MSG, chat_id, processing_message_id)
             db.log_interaction(user_id, s.LOG_DOWNLOAD_IMAGE_ERROR, {'file_id': file_id})
-            logger.debug("<<< Exiting handle_photo (Download failed)")
+            logger.debug("<<< Exiting _process_photo (Download failed)")
             return
 
         logger.info(s.LOG_IMAGE_PROCESSING_WORKFLOW_START.format(user_id=user_id))
-        logger.debug(f"Calling google_apis.process_image_with_gemini for path: {image_path}")
-        gemini_response, error_msg = google_apis.process_image_with_gemini(image_path, user_id)
+        # Identical images (forwards, resends after an error) reuse the stored result instead of a new Gemini call
+        image_hash = google_apis.image_sha256(image_path) if config.IMAGE_CACHE_ENABLED else None
+        gemini_response = db.get_cached_image_result(image_hash, google_apis.GEMINI_IMAGE_PROMPT_VERSION) if image_hash else None
+        cache_hit = gemini_response is not None and google_apis.gemini_response_has_text(gemini_response) # Older entries may hold a failure
+        if cache_hit:
+            logger.info(s.LOG_IMAGE_CACHE_HIT.format(user_id=user_id, image_hash=image_hash[:12]))
+            error_msg = None
+        else:
+            logger.debug(f"Calling google_apis.process_image_with_gemini for path: {image_path}")
+            gemini_response, error_msg = google_apis.process_image_with_gemini(image_path, user_id)
         logger.debug(f"Gemini response received. Error msg: '{error_msg}'. Response exists: {gemini_response is not None}")
 
         if error_msg or not gemini_response:
             error_text = error_msg or s.ERROR_AI_NO_RESPONSE
             logger.warning(f"Gemini processing failed or no response for user {user_id}. Error: {error_text}")
-            logger.debug(f"Editing message {processing_msg.message_id} to show processing failed.")
-            bot.edit_message_text(s.PHOTO_PROCESSING_FAILED_USER_MSG.format(error_text=error_text), chat_id, processing_msg.message_id)
+            logger.debug(f"Editing message {processing_message_id} to show processing failed.")
+            bot.edit_message_text(s.PHOTO_PROCESSING_FAILED_USER_MSG.format(error_text=error_text), chat_id, processing_message_id)
             db.log_interaction(user_id, s.LOG_GEMINI_PROCESSING_ERROR, {'error': error_text})
-            logger.debug("<<< Exiting handle_photo (Gemini processing failed)")
+            logger.debug("<<< Exiting _process_photo (Gemini processing failed)")
             return
 
         logger.debug("Extracting text from Gemini response...")
@@ -316,7 +363,11 @@ def handle_photo(message):
 
         # Save result to image_processing_results table
         logger.debug(f"Saving image processing result to DB for user {user_id}, msg_id {message_id}...")
-        save_success = db.save_image_processing_result(user_id, message_id, file_id, json_to_save)
+        save_success = db.save_image_processing_result(user_id, message_id, file_id, json_to_save, image_sha256=image_hash,
+                                                       prompt_version=google_apis.GEMINI_IMAGE_PROMPT_VERSION,
+                                                       # One cache entry per image, and only for a real extraction:
+                                                       # a blocked or empty answer is retried next time
+                                                       raw_response=gemini_response if not cache_hit and google_apis.gemini_response_has_text(gemini_response) else None)
         if not save_success: logger.warning(s.WARN_FAILED_SAVING_IMAGE_RESULT.format(user_id=user_id))
         else: logger.debug("Image processing result saved successfully.")
 
@@ -331,8 +382,8 @@ def handle_photo(message):
         if len(final_message_text) > 4096:
             final_message_text = final_message_text[:4093] + "..."
             logger.warning(s.WARN_TRUNCATED_MESSAGE.format(user_id=user_id))
-        logger.debug(f"Editing message {processing_msg.message_id} to show final result.")
-        bot.edit_message_text(final_message_text, chat_id, processing_msg.message_id)
+        logger.debug(f"Editing message {processing_message_id} to show final result.")
+        bot.edit_message_text(final_message_text, chat_id, processing_message_id)
         db.log_interaction(user_id, s.LOG_SENT_EXTRACTED_TEXT, {'length': len(result_text)})
         logger.info(s.LOG_IMAGE_PROCESSING_WORKFLOW_SUCCESS.format(user_id=user_id))
         logger.debug(f"Calling send_main_menu_message for chat_id {chat_id} after photo processing.")
@@ -341,8 +392,8 @@ def handle_photo(message):
     except Exception as e:
         logger.error(s.ERROR_IMAGE_WORKFLOW.format(error=str(e)), exc_info=True)
         try:
-            logger.debug(f"Editing message {processing_msg.message_id} to show generic photo error.")
-            bot.edit_message_text(s.PHOTO_ERROR_USER_MSG, chat_id, processing_msg.message_id)
+            logger.debug(f"Editing message {processing_message_id} to show generic photo error.")
+            bot.edit_message_text(s.PHOTO_ERROR_USER_MSG, chat_id, processing_message_id)
         except Exception as api_e:
              logger.error(s.ERROR_SENDING_ERROR_MSG.format(user_id=user_id, error=api_e), exc_info=True)
         db.log_interaction(user_id, s.LOG_PHOTO_WORKFLOW_ERROR, {'error': str(e)})
@@ -350,13 +401,48 @@ def handle_photo(message):
         logger.debug(f"Cleaning up temporary image file: {image_path}")
         utils.cleanup_temp_file(image_path)
         logger.info(s.LOG_IMAGE_WORKFLOW_CLEANUP_COMPLETE.format(user_id=user_id))
-    logger.debug("<<< Exiting handle_photo")
+    logger.debug("<<< Exiting _process_photo")
 
 
 # --- Helper Function for Gemini Analysis ---
-def _trigger_gemini_analysis(user_id, chat_id, message_id_to_edit=None, latest_message_text=None):
-    """Fetches history, optionally adds latest message, calls Gemini, and replies/edits."""
-    logger.debug(f">>> Entering _trigger_gemini_analysis for user: {user_id}, chat: {chat_id}, edit_id: {message_id_to_edit}, latest_text: {latest_message_text is not None}")
+def _analysis_progress_editor(chat_id, message_id, is_current=None):
+    """
+    on_partial callback for streamed analyses: edits the "Analyzing..." message with
+    the text received so far, at most once per GEMINI_STREAM_EDIT_INTERVAL_SECONDS and
+    longer when Telegram answers 429. Failures only skip that update.
+    """
+    state = {'next_edit_at': 0.0, 'last_text': None}
+
+    def show_partial(text_so_far):
+        now = time.monotonic()
+        if now < state['next_edit_at'] or (is_current and not is_current()):
+            return
+        state['next_edit_at'] = now + config.GEMINI_STREAM_EDIT_INTERVAL_SECONDS
+        partial_text = s.CALLBACK_ANALYSIS_PARTIAL_USER_MSG.format(analysis_result=text_so_far)
+        if len(partial_text) > 4096:
+            partial_text = partial_text[:4093] + "..."
+        if partial_text == state['last_text']:
+            return # Telegram rejects edits that change nothing
+        try:
+            bot.edit_message_text(partial_text, chat_id, message_id)
+            state['last_text'] = partial_text
+        except telebot.apihelper.ApiTelegramException as api_ex:
+            if api_ex.error_code == 429:
+                retry_after = (api_ex.result_json or {}).get('parameters', {}).get('retry_after', 5)
+                state['next_edit_at'] = now + retry_after
+            logger.warning(s.WARN_ANALYSIS_PROGRESS_EDIT_FAILED.format(chat_id=chat_id, error=api_ex))
+        except Exception as e:
+            logger.warning(s.WARN_ANALYSIS_PROGRESS_EDIT_FAILED.format(chat_id=chat_id, error=e))
+
+    return show_partial
+
+def _trigger_gemini_analysis(user_id, chat_id, message_id_to_edit=None, latest_messages=(), is_current=None):
+    """
+    Fetches history, optionally adds the latest messages, calls Gemini, and replies/edits.
+    When is_current() turns False (a newer analysis replaced this one) the request is
+    abandoned and nothing more is edited.
+    """
+    logger.debug(f">>> Entering _trigger_gemini_analysis for user: {user_id}, chat: {chat_id}, edit_id: {message_id_to_edit}, latest_messages: {len(latest_messages)}")
     processing_message_id = None
     try:
         # Send "Analyzing..." message
@@ -367,53 +453,37 @@ def _trigger_gemini_analysis(user_id, chat_id, message_id_to_edit=None, latest_m
             logger.debug(f"New processing message ID: {processing_message_id}")
         else:
             logger.debug(f"Editing message {message_id_to_edit} to 'Analyzing...'.")
-            bot.edit_message_text(s.CALLBACK_ANALYZING_MESSAGES, chat_id, message_id_to_edit)
+            try:
+                bot.edit_message_text(s.CALLBACK_ANALYZING_MESSAGES, chat_id, message_id_to_edit)
+            except telebot.apihelper.ApiTelegramException as api_ex:
+                if 'message is not modified' not in str(api_ex): # Already showing it (debounced burst)
+                    raise
             processing_message_id = message_id_to_edit
             logger.debug(f"Using existing message ID for processing: {processing_message_id}")
 
-        # Fetch history
-        logger.debug(f"Fetching message history for user {user_id}...")
-        messages = db.get_user_message_history(user_id, include_text=True, limit=20) # Ensure include_text=True
-        logger.debug(f"Fetched {len(messages)} messages from history.")
+        # Build the prompt from the user's cached rolling context (only new history rows are read)
+        logger.debug(f"Building analysis prompt for user {user_id}...")
+        prompt, item_count = analysis_prompts.build(user_id, latest_messages)
 
-        if not messages and not latest_message_text:
+        if not item_count:
             logger.warning(f"No messages found to analyze for user {user_id}.")
             bot.edit_message_text(s.CALLBACK_NO_MESSAGES_TO_ANALYZE, chat_id, processing_message_id, reply_markup=generate_main_menu())
             logger.debug("<<< Exiting _trigger_gemini_analysis (No messages)")
             return
-
-        # Construct the prompt
-        prompt = s.GEMINI_PROMPT_TEXT_ANALYSIS
-        logger.debug("Base prompt set.")
-
-        # Add the latest message text first
-        if latest_message_text and not latest_message_text.startswith('/'):
-             logger.debug("Adding latest_message_text to prompt.")
-             prompt += s.CALLBACK_ANALYSIS_PROMPT_TEXT.format(text=latest_message_text)
-
-        # Add historical messages
-        logger.debug("Adding historical messages to prompt...")
-        history_added_count = 0
-        for msg in messages:
-            msg_text = msg.get('message_text')
-            if msg_text and msg_text != latest_message_text and not (isinstance(msg_text, str) and msg_text.startswith('/')):
-                history_added_count += 1
-                try: # Format JSON nicely
-                    if isinstance(msg_text, str) and msg_text.startswith('{') and msg_text.endswith('}'):
-                        json_data = json.loads(msg_text)
-                        formatted_json = json.dumps(json_data, indent=2, ensure_ascii=False)
-                        prompt += s.CALLBACK_ANALYSIS_PROMPT_JSON.format(formatted_json=formatted_json)
-                    else: prompt += s.CALLBACK_ANALYSIS_PROMPT_TEXT.format(text=msg_text)
-                except Exception as format_err:
-                    logger.warning(f"Could not format message text, adding as raw string. Error: {format_err}")
-                    prompt += s.CALLBACK_ANALYSIS_PROMPT_TEXT.format(text=str(msg_text)) # Add as string
-        logger.debug(f"Added {history_added_count} historical messages to prompt.")
+        logger.debug(f"Prompt built with {item_count} messages.")
 
         logger.info(s.LOG_SENDING_PROMPT_TO_GEMINI.format(user_id=user_id, prompt_preview=prompt[:500]))
         logger.debug("Calling google_apis.analyze_text_with_gemini...")
-        analysis_result, error_msg = google_apis.analyze_text_with_gemini(prompt, user_id)
+        analysis_result, error_msg = google_apis.analyze_text_with_gemini(
+            prompt, user_id, on_partial=_analysis_progress_editor(chat_id, processing_message_id, is_current),
+            is_cancelled=(lambda: not is_current()) if is_current else None)
         logger.debug(f"Gemini text analysis result received. Error msg: '{error_msg}'. Result exists: {analysis_result is not None}")
 
+        if is_current and not is_current():
+            logger.info(s.LOG_ANALYSIS_SUPERSEDED.format(user_id=user_id))
+            logger.debug("<<< Exiting _trigger_gemini_analysis (Superseded)")
+            return
+
         if error_msg or not analysis_result:
              error_text = error_msg or s.ERROR_AI_NO_RESPONSE
              logger.warning(f"Gemini text analysis failed for user {user_id}. Error: {error_text}")
@@ -433,7 +503,9 @@ def _trigger_gemini_analysis(user_id, chat_id, message_id_to_edit=None, latest_m
         logger.error(s.LOG_TRIGGER_GEMINI_ERROR.format(user_id=user_id, error=e), exc_info=True)
         try:
             error_edit_id = processing_message_id if processing_message_id else message_id_to_edit
-            if error_edit_id:
+            if is_current and not is_current():
+                logger.debug("Analysis superseded; leaving the message to the newer one.")
+            elif error_edit_id:
                 logger.debug(f"Attempting to edit message {error_edit_id} to show generic error.")
                 bot.edit_message_text(s.ERROR_PROCESSING_REQUEST, chat_id, error_edit_id, reply_markup=generate_main_menu())
             else:
@@ -444,6 +516,34 @@ def _trigger_gemini_analysis(user_id, chat_id, message_id_to_edit=None, latest_m
     logger.debug("<<< Exiting _trigger_gemini_analysis")
 
 
+def _report_analysis_queue_full(user_id, chat_id, message_id_to_edit=None):
+    db.log_interaction(user_id, s.LOG_ANALYSIS_QUEUE_FULL)
+    if message_id_to_edit is None:
+        bot.send_message(chat_id, s.ANALYSIS_QUEUE_FULL_USER_MSG, reply_markup=generate_main_menu())
+    else:
+        bot.edit_message_text(s.ANALYSIS_QUEUE_FULL_USER_MSG, chat_id, message_id_to_edit, reply_markup=generate_main_menu())
+
+def _queue_gemini_analysis(user_id, chat_id, message_id_to_edit=None, latest_messages=()):
+    """Run _trigger_gemini_analysis on the analysis pool; tells the user if the pool is full."""
+    if analysis_queue.submit(user_id, _trigger_gemini_analysis, user_id, chat_id,
+                             message_id_to_edit=message_id_to_edit, latest_messages=latest_messages):
+        return True
+    _report_analysis_queue_full(user_id, chat_id, message_id_to_edit)
+    return False
+
+def _run_text_analysis_burst(user_id, items, status_message_id, is_current):
+    """BurstDebouncer callback (on the analysis pool): one analysis over every text of the burst."""
+    chat_id = items[-1][0]
+    _trigger_gemini_analysis(user_id, chat_id, message_id_to_edit=status_message_id,
+                             latest_messages=items, is_current=is_current)
+
+def _reject_text_analysis_burst(user_id, items, status_message_id):
+    _report_analysis_queue_full(user_id, items[-1][0], status_message_id)
+
+text_analysis_bursts = BurstDebouncer('text_analysis', config.TEXT_ANALYSIS_DEBOUNCE_SECONDS, _run_text_analysis_burst,
+                                      submit=analysis_queue.submit, rejected=_reject_text_analysis_burst)
+
+
 @bot.message_handler(func=lambda message: True, content_types=[s.DB_MESSAGE_TYPE_TEXT])
 def handle_text(message):
     user_id = message.from_user.id
@@ -484,8 +584,14 @@ def handle_text(message):
         logger.info(s.LOG_SKIPPED_MENU_FOR_COMMAND.format(command=message.text, chat_id=chat_id))
     else:
        logger.info(s.LOG_TRIGGER_GEMINI_TEXT_MSG.format(user_id=user_id))
-       logger.debug(f"Calling _trigger_gemini_analysis for user {user_id} with latest text.")
-       _trigger_gemini_analysis(user_id, chat_id, latest_message_text=message.text)
+       if config.TEXT_ANALYSIS_DEBOUNCE_SECONDS > 0:
+           # One "Analyzing..." message per burst (sent by whichever message opens it); the
+           # analysis is queued on the analysis pool once the user pauses
+           text_analysis_bursts.submit(user_id, (chat_id, message.message_id, message.text),
+                                       open_status=lambda: bot.send_message(chat_id, s.CALLBACK_ANALYZING_MESSAGES).message_id)
+       else:
+           logger.debug(f"Queueing Gemini analysis for user {user_id} with latest text.")
+           _queue_gemini_analysis(user_id, chat_id, latest_messages=[(chat_id, message.message_id, message.text)])
        # Menu is sent by the helper function now
     logger.debug("<<< Exiting handle_text (Default handling)")
 
@@ -514,13 +620,12 @@ def handle_callback_query(call):
     db.log_interaction(user_id, s.LOG_BUTTON_CLICK, callback_data)
 
     # Ensure user session exists
-    if user_id not in user_sessions:
+    session, created = user_sessions.get_or_create(user_id)
+    if created:
         logger.warning(f"User session for {user_id} not found! Reinitializing.")
-        prefs = db.get_user_preferences(user_id)
-        user_sessions[user_id] = {'state': s.USER_STATE_MAIN_MENU, 'data': {}, 'preferences': prefs}
-        logger.debug(f"Reinitialized session for {user_id}: {user_sessions[user_id]}")
+        logger.debug(f"Reinitialized session for {user_id}: {session}")
     else:
-        logger.debug(f"Existing session found for user {user_id}: {user_sessions[user_id]}")
+        logger.debug(f"Existing session found for user {user_id}: {session}")
 
 
     try: # Wrap handler logic in try/except
@@ -620,7 +725,8 @@ def handle_callback_query(call):
             logger.debug(f"Callback Handler: Matched '{s.CALLBACK_DATA_DELETE_DATA}'")
             logger.info(s.LOG_CALLBACK_DELETE_DATA.format(user_id=user_id))
             logger.debug(f"Setting user {user_id} state to '{s.USER_STATE_DELETE_CONFIRMATION}'")
-            user_sessions[user_id]['state'] = s.USER_STATE_DELETE_CONFIRMATION
+            session.state = s.USER_STATE_DELETE_CONFIRMATION
+            user_sessions.save(session)
             logger.debug(f"Attempting bot.edit_message_text for message_id {message_id} (Delete Confirmation)")
             bot.edit_message_text(s.CALLBACK_DELETE_CONFIRMATION_USER_MSG, chat_id, message_id, reply_markup=generate_delete_confirmation_menu())
             logger.debug(f"Successfully edited message {message_id} with delete confirmation.")
@@ -628,31 +734,26 @@ def handle_callback_query(call):
         elif callback_data == s.CALLBACK_DATA_CONFIRM_DELETE:
             logger.debug(f"Callback Handler: Matched '{s.CALLBACK_DATA_CONFIRM_DELETE}'")
             logger.info(s.LOG_CALLBACK_CONFIRM_DELETE.format(user_id=user_id))
-            logger.debug(f"Attempting to delete data for user {user_id} from DB...")
-            db_del_start = time.monotonic()
-            success, msg_del, int_del = db.delete_user_data(user_id)
-            db_del_end = time.monotonic()
-            logger.debug(f"DB delete_user_data took {db_del_end - db_del_start:.4f} seconds. Success: {success}, Counts: {msg_del}, {int_del}")
-            if user_id in user_sessions:
-                logger.debug(f"Deleting in-memory session for user {user_id}")
-                del user_sessions[user_id]
-            if success:
-                logger.debug(f"Attempting bot.edit_message_text for message_id {message_id} (Delete Success)")
-                bot.edit_message_text(s.CALLBACK_DELETE_SUCCESS_USER_MSG.format(msg_del=msg_del, int_del=int_del), chat_id, message_id)
-                logger.debug(f"Successfully edited message {message_id} with delete success.")
-                logger.debug(f"Calling send_main_menu_message for chat_id {chat_id} after delete success.")
-                send_main_menu_message(chat_id, text=s.CALLBACK_DELETE_SUCCESS_NEXT_ACTION)
+            logger.debug(f"Marking user {user_id} for background deletion...")
+            queued = db.mark_user_for_deletion(user_id, chat_id, message_id)
+            analysis_prompts.forget(user_id)
+            text_analysis_bursts.cancel(user_id)
+            logger.debug(f"Deleting session for user {user_id}")
+            user_sessions.delete(user_id)
+            if queued:
+                # The deletion reaper edits this message with progress and the final counts
+                logger.debug(f"Attempting bot.edit_message_text for message_id {message_id} (Delete Pending)")
+                bot.edit_message_text(s.CALLBACK_DELETE_PENDING_USER_MSG, chat_id, message_id)
             else:
-                logger.error(f"Data deletion failed in DB for user {user_id}.")
-                logger.debug(f"Attempting bot.edit_message_text for message_id {message_id} (Delete Error)")
-                bot.edit_message_text(s.CALLBACK_DELETE_ERROR_USER_MSG, chat_id, message_id, reply_markup=generate_main_menu())
-                logger.debug(f"Successfully edited message {message_id} with delete error + Main Menu.")
+                logger.debug(f"Deletion already pending for user {user_id}")
+                bot.answer_callback_query(call.id, s.CALLBACK_DELETE_ALREADY_PENDING)
 
         elif callback_data == s.CALLBACK_DATA_CANCEL_DELETE:
             logger.debug(f"Callback Handler: Matched '{s.CALLBACK_DATA_CANCEL_DELETE}'")
             logger.info(s.LOG_CALLBACK_CANCEL_DELETE.format(user_id=user_id))
             logger.debug(f"Setting user {user_id} state back to '{s.USER_STATE_MAIN_MENU}'")
-            user_sessions[user_id]['state'] = s.USER_STATE_MAIN_MENU
+            session.state = s.USER_STATE_MAIN_MENU
+            user_sessions.save(session)
             logger.debug(f"Attempting bot.edit_message_text for message_id {message_id} (Cancel Delete)")
             bot.edit_message_text(s.OPERATION_CANCELED, chat_id, message_id, reply_markup=generate_main_menu())
             logger.debug(f"Successfully edited message {message_id} with cancel confirmation + Main Menu.")
@@ -662,17 +763,18 @@ def handle_callback_query(call):
             logger.debug(f"Callback Handler: Matched '{s.CALLBACK_DATA_MENU1}'")
             logger.info(s.LOG_CALLBACK_MENU1.format(user_id=user_id))
             logger.debug(f"Setting user {user_id} state to '{s.USER_STATE_MENU1}'")
-            user_sessions[user_id]['state'] = s.USER_STATE_MENU1
-            logger.debug(f"Calling _trigger_gemini_analysis for user {user_id}, editing message {message_id}")
-            _trigger_gemini_analysis(user_id, chat_id, message_id_to_edit=message_id)
-            logger.debug(f"Returned from _trigger_gemini_analysis for '{s.CALLBACK_DATA_MENU1}'")
+            session.state = s.USER_STATE_MENU1
+            user_sessions.save(session)
+            logger.debug(f"Queueing Gemini analysis for user {user_id}, editing message {message_id}")
+            _queue_gemini_analysis(user_id, chat_id, message_id_to_edit=message_id) # Off the lane: other chats keep moving
 
         # --- Menu 2 (Example) ---
         elif callback_data == s.CALLBACK_DATA_MENU2:
             logger.debug(f"Callback Handler: Matched '{s.CALLBACK_DATA_MENU2}'")
             logger.info(s.LOG_CALLBACK_MENU2.format(user_id=user_id))
             logger.debug(f"Setting user {user_id} state to '{s.USER_STATE_MENU2}'")
-            user_sessions[user_id]['state'] = s.USER_STATE_MENU2
+            session.state = s.USER_STATE_MENU2
+            user_sessions.save(session)
             logger.debug(f"Attempting bot.edit_message_text for message_id {message_id} (Menu 2)")
             bot.edit_message_text(s.CALLBACK_MENU2_USER_MSG, chat_id, message_id, reply_markup=generate_submenu(s.CALLBACK_DATA_MENU2))
             logger.debug(f"Successfully edited message {message_id} with Menu 2 submenu.")
@@ -682,7 +784,8 @@ def handle_callback_query(call):
             logger.debug(f"Callback Handler: Matched '{s.CALLBACK_DATA_MAIN_MENU}'")
             logger.info(s.LOG_CALLBACK_MAIN_MENU.format(user_id=user_id))
             logger.debug(f"Setting user {user_id} state to '{s.USER_STATE_MAIN_MENU}'")
-            user_sessions[user_id]['state'] = s.USER_STATE_MAIN_MENU
+            session.state = s.USER_STATE_MAIN_MENU
+            user_sessions.save(session)
             logger.debug(f"Attempting bot.edit_message_text for message_id {message_id} (Back to Main)")
             bot.edit_message_text(s.CALLBACK_MAIN_MENU_USER_MSG, chat_id, message_id, reply_markup=generate_main_menu())
             logger.debug(f"Successfully edited message {message_id} with main menu.")
@@ -692,7 +795,8 @@ def handle_callback_query(call):
             logger.debug(f"Callback Handler: Matched submenu item '{callback_data}'")
             logger.info(s.LOG_CALLBACK_SUBMENU.format(user_id=user_id, callback_data=callback_data))
             logger.debug(f"Setting user {user_id} data 'selected_item' to '{callback_data}'")
-            user_sessions[user_id]['data']['selected_item'] = callback_data
+            session.data['selected_item'] = callback_data
+            user_sessions.save(session)
             logger.debug(f"Answering callback query {callback_id}...")
             bot.answer_callback_query(call.id, s.CALLBACK_PROCESSING_SUBMENU.format(callback_data=callback_data))
             logger.debug(f"Calling send_main_menu_message for chat_id {chat_id} after submenu action.")
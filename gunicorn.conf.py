@@ -0,0 +1,39 @@
+# gunicorn.conf.py - settings for serving wsgi:app in production
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Everything comes from bot_modules/config.py (environment variables), like the
+# rest of the bot. Reload with SIGHUP; SIGTERM shuts down gracefully: workers
+# stop accepting requests, drain their update and photo queues and commit
+# pending database writes before exiting.
+import os
+
+from bot_modules import config
+
+bind = config.WSGI_BIND
+workers = config.WSGI_WORKERS
+threads = config.WSGI_THREADS
+worker_class = 'gthread'
+preload_app = True # Import wsgi.py (DB init, webhook registration) once, in the master
+timeout = config.WSGI_TIMEOUT_SECONDS
+graceful_timeout = config.WSGI_GRACEFUL_TIMEOUT_SECONDS
+max_requests = config.WSGI_MAX_REQUESTS
+max_requests_jitter = config.WSGI_MAX_REQUESTS // 10
+accesslog = '-'
+
+# TLS is terminated here when the certificates exist (same files main.py uses);
+# behind a reverse proxy they are usually absent and plain HTTP is served.
+if os.path.exists(config.WEBHOOK_SSL_CERT) and os.path.exists(config.WEBHOOK_SSL_PRIV):
+    certfile = config.WEBHOOK_SSL_CERT
+    keyfile = config.WEBHOOK_SSL_PRIV
+
+
+def post_fork(server, worker):
+    from bot_modules import lifecycle
+    lifecycle.after_fork()
+    lifecycle.start_background_services()
+
+
+def worker_exit(server, worker):
+    from bot_modules import lifecycle
+    lifecycle.stop_background_services()
@@ -2,11 +2,12 @@
 import logging
 import os
 import getpass
-import telebot # Keep for ApiTelegramException
+import atexit
 
 # Import from our modules
 from bot_modules import config
-from bot_modules.database import init_db
+from bot_modules import dispatcher
+from bot_modules import lifecycle
 from bot_modules.telegram_bot import bot # Import the initialized bot instance
 from bot_modules.flask_app import app # Import the initialized Flask app
 from bot_modules import strings_en
@@ -37,7 +38,9 @@ except Exception as e:
 
 # --- Database Initialization ---
 try:
-    init_db()
+    lifecycle.init_database()
+    lifecycle.start_background_services()
+    atexit.register(lifecycle.stop_background_services) # Drains queues, then commits pending writes
 except Exception as db_init_e:
     logger.error(s.FATAL_DB_INIT_FAILED.format(error=db_init_e), exc_info=True)
     exit(1) # Exit if DB can't be initialized
@@ -46,7 +49,23 @@ except Exception as db_init_e:
 if __name__ == '__main__':
     inferred_base_url = "localhost" in config.BASE_URL or "127.0.0.1" in config.BASE_URL
 
-    if config.DEBUG_MODE:
+    if config.BOT_ENGINE == 'async':
+        logger.info(s.LOG_STARTING_ASYNC_ENGINE)
+        try:
+            logger.info(s.LOG_REMOVING_WEBHOOK)
+            bot.remove_webhook() # Long polling and a webhook can't both be active
+            logger.info(s.LOG_WEBHOOK_REMOVED)
+        except Exception as e:
+            logger.warning(s.WARN_CANNOT_REMOVE_WEBHOOK.format(error=e))
+        from bot_modules import async_engine
+        try:
+            async_engine.run()
+        except Exception as poll_e:
+             logger.error(s.ERROR_POLLING_FAILED.format(error=poll_e), exc_info=True)
+        finally:
+             logger.info(s.LOG_POLLING_STOPPED)
+
+    elif config.DEBUG_MODE:
         logger.info(s.LOG_STARTING_DEBUG_POLLING)
         try:
             logger.info(s.LOG_REMOVING_WEBHOOK)
@@ -55,6 +74,7 @@ if __name__ == '__main__':
         except Exception as e:
             logger.warning(s.WARN_CANNOT_REMOVE_WEBHOOK.format(error=e))
 
+        dispatcher.enable_for_polling() # Handlers run on the per-chat lanes, not the polling thread
         logger.info(s.LOG_POLLING_STARTED)
         # Note: Flask server is NOT started automatically in polling mode.
         # Web Apps and webhook routes will not be reachable unless Flask is run separately.
@@ -72,33 +92,7 @@ if __name__ == '__main__':
              logger.error(s.LOG_CURRENT_BASE_URL.format(base_url=config.BASE_URL))
              exit(1)
 
-        try:
-            logger.info(s.LOG_REMOVING_WEBHOOK)
-            bot.remove_webhook()
-            logger.info(s.LOG_WEBHOOK_REMOVED)
-        except Exception as e:
-            logger.error(s.ERROR_REMOVING_WEBHOOK_PRODUCTION.format(error=e))
-            exit(1)
-
-        try:
-            logger.info(s.LOG_SETTING_WEBHOOK.format(url=config.WEBHOOK_URL))
-            cert_exists = os.path.exists(config.WEBHOOK_SSL_CERT)
-            key_exists = os.path.exists(config.WEBHOOK_SSL_PRIV)
-            if not cert_exists or not key_exists:
-                 logger.warning(s.WARN_SSL_CERT_NOT_FOUND.format(cert_path=config.WEBHOOK_SSL_CERT, key_path=config.WEBHOOK_SSL_PRIV))
-
-            bot.set_webhook(url=config.WEBHOOK_URL) # No cert parameter needed if handled by reverse proxy
-            logger.info(s.LOG_WEBHOOK_SET_NO_CERT_PARAM)
-            webhook_info_check = bot.get_webhook_info()
-            logger.info(s.LOG_WEBHOOK_STATUS_CHECK.format(url=webhook_info_check.url, pending_updates=webhook_info_check.pending_update_count))
-            if webhook_info_check.last_error_message:
-                 logger.warning(s.WARN_TELEGRAM_WEBHOOK_ERROR.format(error_message=webhook_info_check.last_error_message))
-
-        except telebot.apihelper.ApiTelegramException as e:
-             logger.error(s.FATAL_WEBHOOK_SET_API_ERROR.format(error=e), exc_info=True)
-             exit(1)
-        except Exception as e:
-            logger.error(s.FATAL_WEBHOOK_SET_OTHER_ERROR.format(error=e), exc_info=True)
+        if not lifecycle.configure_webhook():
             exit(1)
 
         # Start the Flask web server
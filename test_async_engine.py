@@ -0,0 +1,119 @@
+"""
+test_async_engine.py
+
+Tests for the parts of bot_modules/async_engine.py that don't need aiohttp:
+routing of updates between the async text path and the sync handlers, per-chat
+ordering of text messages, and the database executor.
+
+To run:
+    pytest test_async_engine.py -q
+"""
+
+import asyncio
+import os
+import threading
+import time
+import pytest
+import telebot
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import bot_modules.async_engine as async_engine
+from bot_modules.job_queue import LaneJobQueue
+
+
+def text_update(text):
+    return telebot.types.Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': text,
+        'chat': {'id': 5, 'type': 'private'}, 'from': {'id': 5, 'is_bot': False, 'first_name': 'T'}}})
+
+
+def test_only_plain_text_takes_the_async_path():
+    assert async_engine.is_async_text(text_update("my glucose was 110"))
+    assert not async_engine.is_async_text(text_update("/start"))
+    assert not async_engine.is_async_text(text_update("Datos: peso 70"))
+    assert not async_engine.is_async_text(telebot.types.Update.de_json({'update_id': 2, 'callback_query': {
+        'id': '1', 'chat_instance': 'c', 'data': 'x', 'from': {'id': 5, 'is_bot': False, 'first_name': 'T'}}}))
+
+
+@pytest.mark.asyncio
+async def test_db_calls_run_off_the_event_loop():
+    loop_thread = threading.current_thread()
+    thread = await async_engine.run_db(threading.current_thread)
+    assert thread is not loop_thread and thread.name.startswith("async-db")
+
+
+def test_full_lane_is_waited_on_not_shed(monkeypatch):
+    lanes = LaneJobQueue('updates', lanes=1, max_queued_per_lane=1)
+    monkeypatch.setattr(async_engine.dispatcher, "update_lanes", lanes)
+    gate, handled = threading.Event(), []
+    monkeypatch.setattr(async_engine.dispatcher, "_process_update", lambda update: gate.wait(2) and handled.append(update.update_id))
+    updates = [telebot.types.Update.de_json({'update_id': n, 'callback_query': {
+        'id': str(n), 'chat_instance': 'c', 'data': 'x', 'from': {'id': 5, 'is_bot': False, 'first_name': 'T'}}}) for n in range(3)]
+
+    async def forward_all():
+        threading.Timer(0.2, gate.set).start() # Lane busy with update 0, update 1 queued: update 2 waits
+        started = time.monotonic()
+        results = [await async_engine.forward_to_lanes(update) for update in updates]
+        return results, time.monotonic() - started
+    results, elapsed = asyncio.run(forward_all())
+    lanes.stop(timeout=5)
+    assert results == [True, True, True] and elapsed >= 0.15
+    assert handled == [0, 1, 2]
+
+
+def bare_engine(monkeypatch, save_message):
+    """An AsyncBotEngine without AsyncTeleBot (aiohttp isn't needed for the text bookkeeping)."""
+    engine = object.__new__(async_engine.AsyncBotEngine)
+    engine._texts, engine._status, engine._tasks, engine._handlers, engine._chat_locks = {}, {}, {}, set(), {}
+    class FakeBot:
+        async def send_message(self, chat_id, text):
+            return None
+    engine.bot = FakeBot()
+    async def analyse_burst(user_id, chat_id):
+        pass
+    engine._analyse_burst = analyse_burst
+    monkeypatch.setattr(async_engine.db, "save_user", lambda user, chat_id: None)
+    monkeypatch.setattr(async_engine.db, "save_message", save_message)
+    monkeypatch.setattr(async_engine.db, "log_interaction", lambda user_id, kind: None)
+    return engine
+
+
+def numbered_text_update(message_id, text):
+    update = text_update(text)
+    update.message.message_id = message_id
+    return update
+
+
+def test_a_chats_texts_are_handled_in_arrival_order(monkeypatch):
+    saved = []
+    def save_message(message):
+        if message.message_id == 1:
+            time.sleep(0.2) # The first save is slow; the second must still wait for it
+        saved.append(message.message_id)
+    engine = bare_engine(monkeypatch, save_message)
+
+    async def dispatch_both():
+        await engine.dispatch(numbered_text_update(1, "first"))
+        await engine.dispatch(numbered_text_update(2, "second"))
+        assert len(engine._handlers) == 2 # Strongly referenced while running
+        await asyncio.gather(*engine._handlers)
+    asyncio.run(dispatch_both())
+    assert saved == [1, 2]
+    assert [message_id for _, message_id, _ in engine._texts[5]] == [1, 2]
+    assert not engine._handlers and not engine._chat_locks
+
+
+def test_a_failed_text_handler_is_logged(monkeypatch, caplog):
+    def save_message(message):
+        raise RuntimeError("disk I/O error")
+    engine = bare_engine(monkeypatch, save_message)
+
+    async def dispatch_one():
+        await engine.dispatch(numbered_text_update(1, "hello"))
+        await asyncio.gather(*engine._handlers, return_exceptions=True)
+        await asyncio.sleep(0) # Let the done callback run
+    asyncio.run(dispatch_one())
+    assert "disk I/O error" in caplog.text
+    assert not engine._handlers and not engine._chat_locks
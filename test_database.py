@@ -0,0 +1,285 @@
+"""
+test_database.py
+
+Tests for the SQLite layer in bot_modules/database.py.
+
+Each test runs against a fresh database file in pytest's tmp_path, created
+through init_db() so the full migration chain (tables, pragmas, indexes) is
+exercised.
+
+To run:
+    pytest test_database.py -q
+"""
+
+import os
+import types
+import pytest
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import bot_modules.database as db
+from bot_modules.database import s
+
+# Tables whose per-user queries must be served by an index
+INDEXED_TABLES = ("user_messages", "user_interactions", "image_processing_results")
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """Point the database module at an empty file and run the migrations."""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "test_bot_users.db"))
+    db.init_db()
+    yield db
+    db.stop_writer()
+    db.close_all_connections()
+
+
+def make_user(user_id, username="tester"):
+    return types.SimpleNamespace(id=user_id, username=username, first_name="Test", last_name="User",
+                                 language_code="en", is_bot=False)
+
+
+def make_message(user_id, message_id, text, chat_id=1000):
+    return types.SimpleNamespace(
+        from_user=make_user(user_id), chat=types.SimpleNamespace(id=chat_id), message_id=message_id,
+        content_type=s.DB_MESSAGE_TYPE_TEXT, text=text, photo=None)
+
+
+def capture_selects(func, *args, **kwargs):
+    """Run func and return the SELECT statements it executed, with parameters expanded."""
+    statements = []
+    conn = db.get_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        func(*args, **kwargs)
+    finally:
+        conn.set_trace_callback(None)
+    return [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+
+
+def query_plan(sql):
+    conn = db.get_connection()
+    return [row["detail"] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def test_init_db_records_schema_version_and_wal(fresh_db):
+    assert db.get_schema_version() == db.SCHEMA_VERSION
+    journal_mode = db.get_connection().execute("PRAGMA journal_mode").fetchone()[0]
+    assert journal_mode.upper() == db.config.DB_JOURNAL_MODE
+    db.init_db() # Running again must be a no-op
+    assert db.get_schema_version() == db.SCHEMA_VERSION
+
+
+@pytest.mark.parametrize("func, args", [
+    (db.get_user_message_history, (42,)),
+    (db.get_user_message_history, (42, True)),
+    (db.find_form_response_id, (42,)),
+    (db.get_db_user_messages, (42,)),
+    (db.get_db_user_interactions, (42,)),
+    (db.get_db_interaction_stats, (42,)),
+    (db.get_db_image_processing_results, (42,)),
+    (db.get_user_data_summary, (42,)),
+    (db.get_cached_image_result, ("0" * 64, "v1")),
+    (db.get_user_text_history_since, (42, 10)),
+    (db.get_all_db_users_page, (10, db._encode_cursor(["2030-01-01 00:00:00", 99]))),
+])
+def test_hot_queries_use_an_index(fresh_db, func, args):
+    db.save_user(make_user(42), chat_id=1000)
+    db.save_message(make_message(42, 1, "hello form=123"))
+    db.log_interaction(42, "text")
+
+    selects = capture_selects(func, *args)
+    assert selects, f"{func.__name__} executed no SELECT"
+    for sql in selects:
+        for detail in query_plan(sql):
+            for table in INDEXED_TABLES:
+                if detail.startswith(("SCAN " + table, "SEARCH " + table)):
+                    assert "INDEX" in detail, f"{func.__name__} does a full scan: {detail}"
+
+
+@pytest.mark.parametrize("write_mode", ["sync", "group_commit", "write_behind"])
+def test_logged_rows_are_committed_in_every_write_mode(fresh_db, monkeypatch, write_mode):
+    monkeypatch.setattr(db.config, "DB_WRITE_MODE", write_mode)
+    db.save_user(make_user(7), chat_id=1000)
+    for i in range(25):
+        db.save_message(make_message(7, i, f"message {i}"))
+        db.log_interaction(7, "text", {"n": i})
+    db.flush_pending_writes()
+
+    summary = db.get_user_data_summary(7)
+    assert summary["message_count"] == 25
+    assert summary["interaction_count"] == 25
+
+
+def test_delete_user_data_waits_for_queued_writes(fresh_db, monkeypatch):
+    monkeypatch.setattr(db.config, "DB_WRITE_MODE", "write_behind")
+    db.save_user(make_user(8), chat_id=1000)
+    for i in range(10):
+        db.log_interaction(8, "text")
+
+    success, _, interactions_deleted = db.delete_user_data(8)
+    db.flush_pending_writes()
+
+    assert success and interactions_deleted == 10
+    assert db.get_db_user_interactions(8) == []
+
+
+def test_save_user_upserts_and_skips_unchanged_recent_profiles(fresh_db):
+    db.save_user(make_user(9, username="first"), chat_id=1000)
+    assert db.get_db_user_details(9)["username"] == "first"
+    assert db.get_user_preferences(9)["theme"] == s.DB_DEFAULT_THEME
+
+    statements = []
+    db.get_connection().set_trace_callback(statements.append)
+    db.save_user(make_user(9, username="first"), chat_id=1000) # Unchanged, within the touch window
+    db.save_user(make_user(9, username="renamed")) # Changed profile, no chat_id
+    db.get_connection().set_trace_callback(None)
+
+    assert len([sql for sql in statements if "INSERT INTO users" in sql and "DO UPDATE" in sql]) == 1
+    details = db.get_db_user_details(9)
+    assert details["username"] == "renamed"
+    assert details["chat_id"] == 1000 # Kept when no new chat_id is given
+
+
+def test_save_user_recreates_user_deleted_elsewhere_within_touch_window(fresh_db):
+    db.save_user(make_user(14, username="gone"), chat_id=1400)
+    with db.db_connection() as conn: # Another worker's reaper: this process's touch cache stays warm
+        conn.execute("DELETE FROM user_preferences WHERE user_id = ?", (14,))
+        conn.execute("DELETE FROM users WHERE user_id = ?", (14,))
+
+    db.save_user(make_user(14, username="gone"), chat_id=1400)
+
+    assert db.get_db_user_details(14)["chat_id"] == 1400
+    assert db.get_user_preferences(14)["theme"] == s.DB_DEFAULT_THEME
+
+
+def test_update_user_preference_upserts(fresh_db):
+    assert db.update_user_preference(10, "theme", "dark") # No row yet: created with defaults
+    assert db.update_user_preference(10, "language", "es")
+    prefs = db.get_user_preferences(10)
+    assert (prefs["theme"], prefs["language"], prefs["notifications"]) == ("dark", "es", 1)
+    with pytest.raises(ValueError):
+        db.update_user_preference(10, "theme = 'x'; --", "dark")
+
+
+def test_counter_tables_track_inserts_and_deletes(fresh_db, monkeypatch):
+    monkeypatch.setattr(db.config, "DB_WRITE_MODE", "sync")
+    for user_id in (11, 12):
+        db.save_user(make_user(user_id), chat_id=1000)
+    for i in range(5):
+        db.save_message(make_message(11, i, f"message {i}"))
+        db.log_interaction(11, "text" if i % 2 else "button_click")
+    db.log_interaction(12, "text")
+
+    assert db.get_global_stats() == {'user_count': 2, 'message_count': 5, 'interaction_count': 6}
+    listed = {user["user_id"]: user["interaction_count"] for user in db.get_all_db_users_page()[0]}
+    assert listed == {11: 5, 12: 1}
+    assert db.get_db_interaction_stats(11) == [{'action_type': 'button_click', 'count': 3},
+                                               {'action_type': 'text', 'count': 2}]
+    summary = db.get_user_data_summary(11)
+    assert (summary["message_count"], summary["interaction_count"]) == (5, 5)
+
+    db.delete_user_data(11)
+    assert db.get_global_stats() == {'user_count': 1, 'message_count': 0, 'interaction_count': 1}
+
+
+def test_keyset_pagination_walks_every_row_once(fresh_db, monkeypatch):
+    monkeypatch.setattr(db.config, "DB_WRITE_MODE", "sync")
+    db.save_user(make_user(13), chat_id=1000)
+    for i in range(23): # Many rows share a timestamp, so the id tie-breaker matters
+        db.save_message(make_message(13, i, f"message {i}"))
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = db.get_db_user_messages_page(13, limit=5, cursor=cursor)
+        seen.extend(row["id"] for row in rows)
+        pages += 1
+        if cursor is None:
+            break
+    assert pages == 5
+    assert seen == sorted(seen, reverse=True) and len(set(seen)) == 23
+
+    with pytest.raises(ValueError):
+        db.get_db_user_messages_page(13, limit=5, cursor="not-a-cursor")
+
+
+def test_user_listing_pages_are_stable_while_users_are_active(fresh_db, monkeypatch):
+    monkeypatch.setattr(db.config, "DB_WRITE_MODE", "sync")
+    monkeypatch.setattr(db.config, "DB_USER_TOUCH_SECONDS", 0)
+    for user_id in range(20, 30):
+        db.save_user(make_user(user_id), chat_id=1000)
+    first, cursor = db.get_all_db_users_page(limit=4)
+    db.get_connection().execute("UPDATE users SET last_activity = '2999-01-01' WHERE user_id = ?", (first[-1]["user_id"] - 1,))
+    db.get_connection().commit() # A user on the next page becomes active mid-listing
+    seen = [user["user_id"] for user in first]
+    while cursor:
+        rows, cursor = db.get_all_db_users_page(limit=4, cursor=cursor)
+        seen.extend(user["user_id"] for user in rows)
+    assert sorted(seen) == list(range(20, 30)) and len(seen) == 10
+
+
+def test_export_streams_every_row_as_ndjson_and_csv(fresh_db, monkeypatch):
+    import csv, json
+    from bot_modules import export
+    monkeypatch.setattr(db.config, "DB_WRITE_MODE", "sync")
+    for user_id in (14, 15):
+        db.save_user(make_user(user_id), chat_id=1000)
+        for i in range(7):
+            db.save_message(make_message(user_id, i, f"line {i}, with a comma"))
+        db.log_interaction(user_id, "command", "/start")
+
+    lines = [json.loads(line) for line in export.iter_export("ndjson", user_id=14)]
+    assert [row["table"] for row in lines] == ["user_messages"] * 7 + ["user_interactions"]
+    assert all(row["user_id"] == 14 for row in lines)
+
+    rows = list(csv.DictReader("".join(export.iter_export("csv")).splitlines(keepends=True)))
+    assert len(rows) == 16 and rows[0]["message_text"] == "line 0, with a comma"
+
+    with pytest.raises(ValueError):
+        export.parse_export_tables("users")
+
+
+def test_deletion_reaper_deletes_in_batches_and_reports(fresh_db, monkeypatch):
+    import threading
+    monkeypatch.setattr(db.config, "DB_DELETE_BATCH_ROWS", 4)
+    monkeypatch.setattr(db.config, "DB_DELETE_BATCH_PAUSE_MS", 0)
+    monkeypatch.setattr(db.config, "DB_DELETE_PROGRESS_SECONDS", 0)
+    for user_id in (16, 17):
+        db.save_user(make_user(user_id), chat_id=1000)
+        for i in range(9):
+            db.save_message(make_message(user_id, i, f"message {i}"))
+        db.log_interaction(user_id, "text")
+
+    reports, finished = [], threading.Event()
+    def report(user_id, chat_id, message_id, msg_del, int_del, done):
+        reports.append((msg_del, int_del, done))
+        if done:
+            finished.set()
+
+    assert db.mark_user_for_deletion(16, chat_id=1000, message_id=55)
+    assert not db.mark_user_for_deletion(16, chat_id=1000, message_id=56)
+    assert db.is_user_pending_deletion(16)
+    db.start_deletion_reaper(report=report)
+    try:
+        assert finished.wait(5)
+    finally:
+        db.stop_deletion_reaper()
+
+    assert reports[-1] == (9, 1, True) and len(reports) == 3 # Batches of 4: two progress reports, then done
+    assert not db.is_user_pending_deletion(16) and db.get_db_user_details(16) is None
+    assert db.get_global_stats() == {'user_count': 1, 'message_count': 9, 'interaction_count': 1}
+
+
+def test_image_result_cache_hits_and_evicts(fresh_db, monkeypatch):
+    db.save_user(make_user(18), chat_id=1000)
+    raw = {"candidates": [{"content": {"parts": [{"text": "name=Ana|dob=null"}]}}]}
+    for i in range(4):
+        db.save_image_processing_result(18, i, f"file-{i}", "{}", image_sha256=f"hash-{i}", prompt_version="v1", raw_response=raw)
+
+    assert db.get_cached_image_result("hash-3", "v1") == raw
+    assert db.get_cached_image_result("hash-3", "v2") is None # Another prompt version is a miss
+
+    assert db.evict_image_cache(max_entries=2, max_age_days=30) == 2 # Oldest beyond the newest two
+    assert db.get_cached_image_result("hash-0", "v1") is None and db.get_cached_image_result("hash-2", "v1") == raw
+    assert len(db.get_db_image_processing_results(18)) == 4 # History is kept
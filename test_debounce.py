@@ -0,0 +1,108 @@
+"""
+test_debounce.py
+
+Tests for the per-key burst coalescing in bot_modules/debounce.py.
+
+To run:
+    pytest test_debounce.py -q
+"""
+
+import threading
+import time
+
+from bot_modules.debounce import BurstDebouncer
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_a_burst_runs_once_with_every_item():
+    runs = []
+    debouncer = BurstDebouncer("test", 0.1, lambda key, items, status, is_current: runs.append((key, items, status)))
+    debouncer.submit(1, "a", open_status=lambda: 10)
+    debouncer.submit(1, "b", open_status=lambda: 11) # Joins the open burst: no second status message
+    debouncer.submit(2, "x")
+    assert wait_for(lambda: len(runs) == 2)
+    assert sorted(runs) == [(1, ["a", "b"], 10), (2, ["x"], None)]
+    assert debouncer.status_message_id(1) is None # Burst finished
+
+
+def test_an_item_during_a_run_supersedes_it():
+    started, release = threading.Event(), threading.Event()
+    runs = []
+    def run(key, items, status, is_current):
+        if len(runs) == 0:
+            started.set()
+            release.wait(2)
+        runs.append((items, is_current()))
+    debouncer = BurstDebouncer("test", 0.05, run)
+    debouncer.submit(1, "a", open_status=lambda: 10)
+    assert started.wait(2)
+    debouncer.submit(1, "b") # Same burst (and status message) while the first run is in flight
+    assert debouncer.status_message_id(1) == 10
+    release.set()
+    assert wait_for(lambda: len(runs) == 2)
+    assert runs == [(["a"], False), (["a", "b"], True)]
+
+
+def test_racing_submits_open_one_status_message():
+    opened, runs = [], []
+    def open_status():
+        opened.append(len(opened) + 10)
+        time.sleep(0.1) # Slow send: the other submits arrive meanwhile
+        return opened[-1]
+    debouncer = BurstDebouncer("test", 0.05, lambda key, items, status, is_current: runs.append((sorted(items), status)))
+    threads = [threading.Thread(target=debouncer.submit, args=(1, item, open_status)) for item in "abc"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert wait_for(lambda: runs)
+    assert opened == [10]
+    assert runs == [(["a", "b", "c"], 10)]
+
+
+def test_a_failed_status_message_still_runs_the_burst():
+    runs = []
+    def open_status():
+        raise RuntimeError("429 Too Many Requests")
+    debouncer = BurstDebouncer("test", 0.05, lambda key, items, status, is_current: runs.append((items, status)))
+    debouncer.submit(1, "a", open_status)
+    assert wait_for(lambda: runs)
+    assert runs == [(["a"], None)]
+
+
+def test_runs_are_handed_to_submit_and_rejections_reported():
+    rejected, runs = [], []
+    accept = [True, False]
+    def submit(key, func, *args):
+        if accept.pop(0):
+            threading.Thread(target=func, args=args).start()
+            return True
+        return False
+    debouncer = BurstDebouncer("test", 0.05, lambda key, items, status, is_current: runs.append((items, is_current())),
+                               submit=submit, rejected=lambda key, items, status: rejected.append((key, items, status)))
+    debouncer.submit(1, "a", open_status=lambda: 10)
+    assert wait_for(lambda: runs and debouncer.status_message_id(1) is None)
+    debouncer.submit(1, "b", open_status=lambda: 11)
+    assert wait_for(lambda: rejected)
+    assert runs == [(["a"], True)]
+    assert rejected == [(1, ["b"], 11)]
+    assert debouncer.status_message_id(1) is None # A rejected burst ends too
+
+
+def test_a_run_superseded_while_queued_is_skipped():
+    queued, runs = [], []
+    debouncer = BurstDebouncer("test", 0.05, lambda key, items, status, is_current: runs.append(items),
+                               submit=lambda key, func, *args: queued.append((func, args)) or True)
+    debouncer.submit(1, "a")
+    assert wait_for(lambda: len(queued) == 1)
+    debouncer.submit(1, "b")
+    assert wait_for(lambda: len(queued) == 2)
+    for func, args in queued:
+        func(*args)
+    assert runs == [["a", "b"]]
@@ -0,0 +1,82 @@
+"""
+test_dispatcher.py
+
+Tests for update dispatching (bot_modules/dispatcher.py and the webhook
+route in bot_modules/flask_app.py). Handlers are replaced by a recorder, so no
+request reaches Telegram.
+
+To run:
+    pytest test_dispatcher.py -q
+"""
+
+import json
+import os
+import threading
+import time
+import pytest
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import bot_modules.dispatcher as dispatcher
+import bot_modules.flask_app as flask_app
+from bot_modules.job_queue import LaneJobQueue
+
+
+def message_update(update_id, chat_id, text):
+    return json.dumps({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'}, 'from': {'id': chat_id, 'is_bot': False, 'first_name': 'T'}}})
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    lanes = LaneJobQueue('updates', lanes=2, max_queued_per_lane=2) # Chats 1 and 3 share lane 1, chat 2 has lane 0
+    monkeypatch.setattr(dispatcher, "update_lanes", lanes)
+    handled = []
+    gate = threading.Event()
+    def process(update):
+        gate.wait(2)
+        time.sleep(0.01)
+        handled.append((update.message.chat.id, update.message.text))
+    monkeypatch.setattr(dispatcher, "_process_update", process)
+    client = flask_app.app.test_client()
+    yield lambda body, headers=None: client.post('/' + flask_app.config.TOKEN, data=body, headers=headers or {}).status_code, handled, gate
+    gate.set()
+    lanes.stop(timeout=5)
+
+
+def test_webhook_queues_updates_and_answers_at_once(webhook):
+    post, handled, gate = webhook
+    started = time.monotonic()
+    assert post(message_update(0, 1, "a0")) == 200
+    time.sleep(0.05) # Lane 1 takes a0 and blocks on the gate
+    assert [post(message_update(i, 1, f"a{i}")) for i in (1, 2)] == [200, 200]
+    assert post(message_update(3, 1, "a3")) == 503 # Lane 1 full: shed
+    assert post(message_update(4, 2, "b0")) == 200 # Lane 0 is independent
+    assert post(message_update(5, 3, "c0")) == 503 # Chat 3 hashes to the full lane 1
+    assert time.monotonic() - started < 1 # Nobody waited for a handler
+    metrics = dispatcher.update_lanes.metrics()
+    assert [(lane['submitted'], lane['rejected']) for lane in metrics['lanes']] == [(1, 0), (3, 2)]
+    assert metrics['lanes'][1]['busy'] and metrics['lanes'][1]['depth'] == 2
+    gate.set()
+    dispatcher.update_lanes.stop(timeout=5)
+    assert [text for chat, text in handled if chat == 1] == ["a0", "a1", "a2"] # Per-chat order kept
+    assert dispatcher.update_lanes.metrics()['completed'] == 4
+
+
+def test_webhook_rejects_invalid_updates_and_wrong_secret(webhook, monkeypatch):
+    post, handled, _ = webhook
+    assert post("not json") == 400
+    monkeypatch.setattr(flask_app.config, "WEBHOOK_SECRET_TOKEN", "s3cret")
+    assert post(message_update(1, 1, "x")) == 403
+    assert post(message_update(1, 1, "x"), {'X-Telegram-Bot-Api-Secret-Token': 's3cret'}) == 200
+
+
+def test_updates_are_keyed_by_chat():
+    import telebot
+    callback = telebot.types.Update.de_json({'update_id': 9, 'callback_query': {
+        'id': '1', 'chat_instance': 'c', 'data': 'x', 'from': {'id': 77, 'is_bot': False, 'first_name': 'T'}}})
+    assert dispatcher.update_chat_key(callback) == 77
+    assert dispatcher.update_chat_key(telebot.types.Update.de_json(message_update(1, 42, "hi"))) == 42
+    assert dispatcher.update_chat_key(telebot.types.Update.de_json({'update_id': 3})) == "update:3"
@@ -0,0 +1,332 @@
+"""
+test_google_apis.py
+
+Unit tests for bot_modules/google_apis.py that run without network access or a
+real service account: google-auth's credential loading is replaced with a fake
+whose refresh() only counts calls.
+
+To run:
+    pytest test_google_apis.py -q
+"""
+
+import json
+import os
+import threading
+import time
+import types
+from datetime import datetime, timedelta, timezone
+import pytest
+import google.auth.credentials
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import bot_modules.google_apis as api
+
+
+class FakeCredentials(google.auth.credentials.Credentials):
+    """Stands in for service_account.Credentials; each refresh issues a new token."""
+    refresh_count = 0
+    lifetime = timedelta(hours=1)
+
+    def __init__(self, scopes):
+        super().__init__()
+        self.scopes = scopes
+
+    def refresh(self, request):
+        time.sleep(0.05) # Long enough for concurrent callers to pile up
+        FakeCredentials.refresh_count += 1
+        self.token = f"token-{FakeCredentials.refresh_count}"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + self.lifetime
+
+
+@pytest.fixture
+def fake_credentials(tmp_path, monkeypatch):
+    key_file = tmp_path / "service_account.json"
+    key_file.write_text("{}")
+    monkeypatch.setattr(api.config, "SERVICE_ACCOUNT_FILE", str(key_file))
+    monkeypatch.setattr(api.service_account.Credentials, "from_service_account_file",
+                        lambda path, scopes: FakeCredentials(scopes))
+    monkeypatch.setattr(FakeCredentials, "refresh_count", 0)
+    api.clear_credential_cache()
+    monkeypatch.setattr(api, "_gemini_scope", None)
+    yield FakeCredentials
+    api.clear_credential_cache()
+
+
+def test_credentials_are_cached_per_scope_set(fake_credentials):
+    first = api.get_credentials_for_google_apis(["scope-a", "scope-b"])
+    again = api.get_credentials_for_google_apis(["scope-b", "scope-a"])
+    other = api.get_credentials_for_google_apis(["scope-c"])
+    assert first is again and first is not other
+    assert fake_credentials.refresh_count == 2
+
+    assert api.get_credentials_for_gemini() is api.get_credentials_for_gemini()
+    assert fake_credentials.refresh_count == 3
+
+
+def test_concurrent_callers_share_one_token_fetch(fake_credentials):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(api.get_cached_credentials(["scope-a"]).token))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["token-1"] * 8 and fake_credentials.refresh_count == 1
+
+
+def test_refresher_renews_tokens_before_they_expire(fake_credentials, monkeypatch):
+    monkeypatch.setattr(api.config, "GOOGLE_CREDENTIALS_CHECK_SECONDS", 0.01)
+    monkeypatch.setattr(fake_credentials, "lifetime", timedelta(seconds=60)) # Inside the 300 s refresh margin
+    credentials = api.get_cached_credentials(["scope-a"])
+    deadline = time.monotonic() + 2
+    while credentials.token == "token-1" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert credentials.token != "token-1"
+
+
+def test_discovery_clients_are_built_once_and_use_a_transport_per_thread(fake_credentials, monkeypatch):
+    builds = []
+    real_build = api.build
+    monkeypatch.setattr(api, "build", lambda *args, **kwargs: builds.append(args) or real_build(*args, **kwargs))
+    credentials = api.get_credentials_for_google_apis(["scope-a"])
+    service = api.get_google_service("forms", "v1", credentials)
+    assert api.get_google_service("forms", "v1", credentials) is service
+    assert api.get_google_service("script", "v1", credentials) is not service
+    assert builds == [("forms", "v1"), ("script", "v1")]
+
+    transports = []
+    def make_request():
+        transports.append(service.forms().get(formId="form-1").http)
+    threads = [threading.Thread(target=make_request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    make_request()
+    make_request()
+    assert transports[0] is not transports[1] and transports[2] is transports[3]
+
+
+class FakeFormsService:
+    """Serves forms().responses().list() pages from a list of responses, two per page."""
+    def __init__(self, items):
+        self.items = items
+        self.list_calls = []
+
+    def forms(self):
+        return self
+
+    def responses(self):
+        return self
+
+    def list(self, formId, pageToken=None, filter=None):
+        self.list_calls.append({'pageToken': pageToken, 'filter': filter})
+        matching = [r for r in self.items if not filter or r['lastSubmittedTime'] >= filter.split(">= ")[1]]
+        start = int(pageToken or 0)
+        page = {'responses': matching[start:start + 2]}
+        if start + 2 < len(matching):
+            page['nextPageToken'] = str(start + 2)
+        return types.SimpleNamespace(execute=lambda: page)
+
+
+def make_form_response(response_id, patient_id, submitted):
+    return {'responseId': response_id, 'lastSubmittedTime': submitted,
+            'answers': {'q1': {'textAnswers': {'answers': [{'value': patient_id}]}},
+                        'q2': {'textAnswers': {'answers': [{'value': f"notes {response_id}"}]}}}}
+
+
+@pytest.fixture
+def form_mirror(tmp_path, monkeypatch, fake_credentials):
+    import bot_modules.database as db
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "mirror.db"))
+    db.init_db()
+    service = FakeFormsService([make_form_response(f"r{i}", f"p{i}", f"2026-01-0{i + 1}T10:00:00.5Z") for i in range(5)])
+    monkeypatch.setattr(api, "get_google_service", lambda *args: service)
+    monkeypatch.setattr(api, "get_question_id_title_map", lambda form_id: ({'q1': 'Patient_ID', 'q2': 'Notes'}, None))
+    yield service
+    db.stop_writer()
+    db.close_all_connections()
+
+
+def test_form_mirror_syncs_incrementally_and_answers_from_the_index(form_mirror):
+    result, error = api.get_google_form_response_by_patient_id("form-1", "p3")
+    assert error is None and result == {'Patient_ID': 'p3', 'Notes': 'notes r3'}
+    assert [call['pageToken'] for call in form_mirror.list_calls] == [None, '2', '4'] # Every page followed
+
+    form_mirror.list_calls.clear()
+    assert api.get_google_form_response_by_patient_id("form-1", "p1")[0]['Notes'] == 'notes r1'
+    assert form_mirror.list_calls == [] # Recent sync and a hit: no API call
+
+    form_mirror.items.append(make_form_response("r9", "p9", "2026-02-01T10:00:00Z"))
+    result, _ = api.get_google_form_response_by_patient_id("form-1", "p9")
+    assert result['Notes'] == 'notes r9' # A miss triggers an incremental catch-up
+    assert form_mirror.list_calls[-1]['filter'] == "timestamp >= 2026-01-05T10:00:00.5Z"
+
+    assert api.get_google_form_response_by_patient_id("form-1", "nobody") == \
+        (None, api.s.FORM_PATIENT_NOT_FOUND_USER_MSG.format(patient_id="nobody"))
+
+
+class FakeFormStructureService:
+    """forms().get(): the full form, or just {'revisionId'} when fields='revisionId'."""
+    def __init__(self):
+        self.revision = "rev-1"
+        self.calls = []
+
+    def forms(self):
+        return self
+
+    def get(self, formId, fields=None):
+        self.calls.append(fields or "full")
+        form = {'revisionId': self.revision,
+                'items': [{'questionItem': {'question': {'questionId': 'q1', 'title': f"Patient_ID ({self.revision})"}}}]}
+        return types.SimpleNamespace(execute=lambda: {'revisionId': self.revision} if fields == 'revisionId' else form)
+
+
+def test_form_structure_is_cached_and_revalidated_by_revision(fake_credentials, monkeypatch, tmp_path):
+    service = FakeFormStructureService()
+    monkeypatch.setattr(api, "get_google_service", lambda *args: service)
+    monkeypatch.setattr(api.config, "FORM_STRUCTURE_CACHE_FILE", str(tmp_path / "forms.json"))
+    api.clear_form_structure_cache()
+
+    assert api.get_question_id_title_map("form-1") == ({'q1': 'Patient_ID (rev-1)'}, None)
+    assert api.generate_question_id_title_json("form-1")[0] == '{"q1": "Patient_ID (rev-1)"}'
+    assert service.calls == ["full"] # Second call served from the cache
+
+    monkeypatch.setattr(api.config, "FORM_STRUCTURE_TTL_SECONDS", 0)
+    api.get_question_id_title_map("form-1")
+    assert service.calls == ["full", "revisionId"] # Expired but unchanged: only the revision is fetched
+    service.revision = "rev-2"
+    assert api.get_question_id_title_map("form-1")[0] == {'q1': 'Patient_ID (rev-2)'}
+    assert service.calls[-2:] == ["revisionId", "full"]
+
+    api.clear_form_structure_cache() # A restart: reloaded from the cache file
+    monkeypatch.setattr(api.config, "FORM_STRUCTURE_TTL_SECONDS", 600)
+    assert api.get_question_id_title_map("form-1")[0] == {'q1': 'Patient_ID (rev-2)'}
+    assert len(service.calls) == 4
+    api.clear_form_structure_cache()
+
+
+class FakeStreamResponse:
+    """What http_client.post(..., stream=True) returns for streamGenerateContent."""
+    status_code = 200
+    encoding = None
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, decode_unicode=False):
+        for chunk in self.chunks:
+            yield "data: " + json.dumps({'candidates': [{'content': {'parts': [{'text': chunk}]}}]})
+            yield ""
+
+
+def test_streamed_analysis_reports_partial_text(fake_credentials, monkeypatch):
+    posts = []
+    def fake_post(endpoint, url, **kwargs):
+        posts.append((url, kwargs.get('stream')))
+        return FakeStreamResponse(["Glucose", " is high", ", café"])
+    monkeypatch.setattr(api.http_client, "post", fake_post)
+    monkeypatch.setattr(api.config, "GEMINI_STREAMING", True)
+    partials = []
+
+    result, error = api.analyze_text_with_gemini("prompt", 1, on_partial=partials.append)
+    assert error is None and result == "Glucose is high, café"
+    assert partials == ["Glucose", "Glucose is high", "Glucose is high, café"]
+    assert posts == [(api.config.GEMINI_STREAM_ENDPOINT, True)]
+
+
+@pytest.mark.parametrize("response, cacheable", [
+    ({'candidates': [{'content': {'parts': [{'text': "Glucose=110|Unit=mg/dL"}]}}]}, True),
+    ([{'candidates': [{'content': {'parts': [{'text': "Gluc"}]}}]}, {'candidates': []}], True),
+    ({'promptFeedback': {'blockReason': "SAFETY"}}, False),
+    ({'candidates': [{'finishReason': "SAFETY"}]}, False),
+    ({'candidates': [{'content': {'parts': [{'text': "  "}]}}]}, False),
+    ("not json", False),
+])
+def test_only_real_extractions_are_cacheable(response, cacheable):
+    assert api.gemini_response_has_text(response) is cacheable
+
+
+class FakeHttpxStream:
+    """An httpx streaming response body, counting how many chunks have been read."""
+    status_code = 200
+    reason_phrase = "OK"
+    url = "https://example.test/stream"
+    headers = {"Content-Type": "text/event-stream"}
+
+    def __init__(self, chunks):
+        self.chunks, self.read_count = chunks, 0
+
+    def iter_bytes(self, chunk_size=None):
+        for chunk in self.chunks:
+            self.read_count += 1
+            yield chunk
+
+    def close(self):
+        pass
+
+
+def test_streamed_analysis_over_http2_adapter_is_incremental(fake_credentials, monkeypatch):
+    import requests
+    events = [("data: " + json.dumps({'candidates': [{'content': {'parts': [{'text': text}]}}]}) + "\r\n\r\n").encode()
+              for text in ("Glucose", " is high", ", café")]
+    body = FakeHttpxStream([events[0], events[1][:20], events[1][20:], events[2]])
+    adapter = api.http_client._Http2Adapter(pool_maxsize=1)
+    def fake_post(endpoint, url, **kwargs):
+        return adapter._build_response(requests.Request("POST", url).prepare(), body, stream=kwargs.get('stream'))
+    monkeypatch.setattr(api.http_client, "post", fake_post)
+    monkeypatch.setattr(api.config, "GEMINI_STREAMING", True)
+    reads_at_partial = []
+
+    result, error = api.analyze_text_with_gemini("prompt", 1, on_partial=lambda text: reads_at_partial.append((text, body.read_count)))
+    assert error is None and result == "Glucose is high, café"
+    # Each partial is reported as soon as its event arrived, not after the whole body
+    assert reads_at_partial == [("Glucose", 1), ("Glucose is high", 3), ("Glucose is high, café", 4)]
+
+
+class FakeAsyncResponse:
+    def __init__(self, status, body):
+        self.status, self.body, self.headers = status, body, {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def text(self):
+        return self.body
+
+
+class FakeAsyncSession:
+    """Stands in for aiohttp.ClientSession: replies with the queued (status, body) pairs."""
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.posts = 0
+
+    def post(self, url, headers=None, json=None):
+        self.posts += 1
+        return FakeAsyncResponse(*self.replies.pop(0))
+
+
+@pytest.mark.asyncio
+async def test_async_analysis_retries_and_extracts_text(fake_credentials, monkeypatch):
+    monkeypatch.setattr(api.config, "HTTP_RETRY_BACKOFF_SECONDS", 0.01)
+    answer = json.dumps({'candidates': [{'content': {'parts': [{'text': "Glucose is high"}]}}]})
+    session = FakeAsyncSession([(503, "busy"), (200, answer)])
+    assert await api.analyze_text_with_gemini_async("prompt", 1, session) == ("Glucose is high", None)
+    assert session.posts == 2
+
+    result, error = await api.analyze_text_with_gemini_async("prompt", 1, FakeAsyncSession([(400, "bad request")]))
+    assert result is None and "400" in error
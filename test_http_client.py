@@ -0,0 +1,125 @@
+"""
+test_http_client.py
+
+Tests for the shared outbound HTTP session in bot_modules/http_client.py,
+against a throwaway HTTP/1.1 server on localhost.
+
+To run:
+    pytest test_http_client.py -q
+"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import requests
+import bot_modules.http_client as http_client
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive
+    failures_left = 0
+    requests_seen = 0
+    connections = set()
+
+    def do_POST(self):
+        Handler.requests_seen += 1
+        Handler.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if Handler.failures_left:
+            Handler.failures_left -= 1
+            self._reply(503, b"busy")
+        else:
+            self._reply(200, b'{"ok": true}')
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}/generate"
+    monkeypatch.setattr(http_client.config, "GEMINI_API_ENDPOINT", url)
+    monkeypatch.setattr(http_client.config, "HTTP_RETRY_BACKOFF_SECONDS", 0.01)
+    monkeypatch.setattr(Handler, "failures_left", 0)
+    monkeypatch.setattr(Handler, "requests_seen", 0)
+    monkeypatch.setattr(Handler, "connections", set())
+    http_client.close_session()
+    yield url
+    http_client.close_session()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_requests_reuse_one_kept_alive_connection(server):
+    for _ in range(5):
+        assert http_client.post("gemini", server, json={"n": 1}).json() == {"ok": True}
+    assert Handler.requests_seen == 5 and len(Handler.connections) == 1
+
+
+def test_server_errors_are_retried_with_backoff(server, monkeypatch):
+    Handler.failures_left = 2
+    response = http_client.post("gemini", server, json={})
+    assert response.status_code == 200 and Handler.requests_seen == 3
+
+    monkeypatch.setattr(http_client.config, "HTTP_RETRIES", 1)
+    http_client.close_session()
+    Handler.failures_left = 5
+    response = http_client.post("gemini", server, json={})
+    assert response.status_code == 503 # Retries exhausted: the last response is handed back
+
+
+class FakeHttpxResponse:
+    """Just the parts of httpx.Response the HTTP/2 adapter reads."""
+    status_code = 200
+    reason_phrase = "OK"
+    url = "https://example.test/stream"
+    headers = {"Content-Type": "text/event-stream; charset=utf-8"}
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_bytes(self, chunk_size=None):
+        yield from self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_http2_adapter_responses_support_iter_lines_and_close(stream):
+    adapter = http_client._Http2Adapter(pool_maxsize=1) # No client is opened until a request is sent
+    fake = FakeHttpxResponse([b"data: one\n", b"data: t", b"wo\n"])
+    request = requests.Request("POST", fake.url).prepare()
+    with adapter._build_response(request, fake, stream=stream) as response:
+        assert fake.closed != stream # Buffered bodies are read in full and released at once
+        assert list(response.iter_lines(decode_unicode=True)) == ["data: one", "data: two"]
+        if not stream: # A streamed body can only be read once, as with requests' own adapter
+            assert response.text == "data: one\ndata: two\n"
+    assert fake.closed
+
+
+def test_http2_session_streams_over_httpx(server, monkeypatch):
+    pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    monkeypatch.setattr(http_client.config, "HTTP_USE_HTTP2", True)
+    http_client.close_session()
+    Handler.failures_left = 1
+    with http_client.post("gemini", server, json={}, stream=True) as response:
+        assert list(response.iter_lines()) == [b'{"ok": true}']
+    assert Handler.requests_seen == 2
@@ -0,0 +1,100 @@
+"""
+test_job_queue.py
+
+Tests for the bounded worker queues in bot_modules/job_queue.py.
+
+To run:
+    pytest test_job_queue.py -q
+"""
+
+import threading
+import time
+import pytest
+
+from bot_modules.job_queue import FairJobQueue, LaneJobQueue
+
+
+@pytest.fixture
+def queue():
+    q = FairJobQueue("test", workers=1, max_queued=10, max_per_key=3)
+    yield q
+    q.stop(timeout=5)
+
+
+def test_keys_take_turns(queue):
+    gate = threading.Event()
+    order = []
+    assert queue.submit("blocker", gate.wait)
+    time.sleep(0.05) # Let the single worker pick up the blocker
+    for n in range(3):
+        assert queue.submit("busy", order.append, f"busy-{n}")
+    assert queue.submit("quiet", order.append, "quiet-0")
+    gate.set()
+    queue.stop(timeout=5)
+    # The quiet user's only photo is not stuck behind the busy user's whole backlog
+    assert order == ["busy-0", "quiet-0", "busy-1", "busy-2"]
+
+
+def test_full_queue_rejects_and_metrics_add_up(queue):
+    gate = threading.Event()
+    assert queue.submit("a", gate.wait)
+    time.sleep(0.05)
+    assert all(queue.submit("a", time.sleep, 0) for _ in range(3))
+    assert not queue.submit("a", time.sleep, 0) # Per-key limit
+    for key in range(6):
+        assert queue.submit(key, time.sleep, 0)
+    assert queue.submit("broken", None) # Fails when run; the worker carries on
+    assert not queue.submit("late", time.sleep, 0) # Queue limit
+    assert queue.metrics()['depth'] == 10 and queue.metrics()['running'] == 1
+
+    gate.set()
+    queue.stop(timeout=5)
+    metrics = queue.metrics()
+    assert metrics['submitted'] == 11 and metrics['rejected'] == 2
+    assert metrics['completed'] == 10 and metrics['failed'] == 1 
+    assert metrics['depth'] == 0 and metrics['wait_seconds_max'] > 0
+    assert not queue.submit("a", time.sleep, 0) # Stopped
+
+
+def test_lanes_keep_key_order_and_run_in_parallel():
+    lanes = LaneJobQueue("test", lanes=4, max_queued_per_lane=50)
+    gate = threading.Event()
+    order = {key: [] for key in range(8)}
+    assert lanes.submit(0, gate.wait) # Blocks lane 0 (keys 0 and 4)
+    for n in range(20):
+        for key in range(8):
+            assert lanes.submit(key, order[key].append, n)
+    time.sleep(0.1)
+    assert order[1] == list(range(20)) and order[0] == [] # Other lanes were not held up
+    gate.set()
+    lanes.stop(timeout=5)
+    assert all(order[key] == list(range(20)) for key in order)
+    metrics = lanes.metrics()
+    assert metrics['submitted'] == 161 and metrics['completed'] == 161
+    assert [lane['submitted'] for lane in metrics['lanes']] == [41, 40, 40, 40]
+    assert not lanes.submit(1, time.sleep, 0) # Stopped
+
+
+def test_lane_stop_runs_jobs_accepted_while_stopping_and_honours_timeout():
+    lanes = LaneJobQueue("test", lanes=1, max_queued_per_lane=1)
+    gate, ran, accepted = threading.Event(), [], []
+    assert lanes.submit("a", gate.wait, 5)
+    time.sleep(0.05)
+    assert lanes.submit("a", ran.append, 1) # Lane now full
+    submitter = threading.Thread(target=lambda: accepted.append(lanes.submit("a", ran.append, 2, block=True)))
+    submitter.start()
+    time.sleep(0.05) # Blocked waiting for room when stop() begins
+    threading.Timer(0.1, gate.set).start()
+    lanes.stop(timeout=5)
+    submitter.join()
+    assert accepted == [True] and ran == [1, 2] # Accepted, so it ran before the lane stopped
+
+    stuck = LaneJobQueue("stuck", lanes=1, max_queued_per_lane=1)
+    release = threading.Event()
+    stuck.submit("a", release.wait, 5)
+    time.sleep(0.05)
+    stuck.submit("a", time.sleep, 0)
+    started = time.monotonic()
+    stuck.stop(timeout=0.2) # No room for the stop marker: gives up at the deadline
+    assert time.monotonic() - started < 1
+    release.set()
@@ -0,0 +1,94 @@
+"""
+test_prompt_builder.py
+
+Tests for the token-budgeted analysis prompt builder in bot_modules/prompt_builder.py,
+against a fresh database file.
+
+To run:
+    pytest test_prompt_builder.py -q
+"""
+
+import os
+import pytest
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import bot_modules.database as db
+import bot_modules.prompt_builder as prompt_builder
+from test_database import fresh_db, make_message, make_user # noqa: F401 (fixture)
+
+
+@pytest.fixture
+def history(fresh_db):
+    db.save_user(make_user(5), chat_id=1000)
+    message_ids = iter(range(1, 1000))
+    def add(*texts):
+        for text in texts:
+            db.save_message(make_message(5, next(message_ids), text))
+        db.flush_pending_writes()
+    return add
+
+
+def test_prompt_renders_history_once_and_reads_only_new_rows(history, monkeypatch):
+    history('{"glucose": 110}', "/help", "feeling tired")
+    builder = prompt_builder.AnalysisPromptBuilder(token_budget=10000, max_users=10)
+    prompt, count = builder.build(5, [(1000, 3, "feeling tired")])
+    assert count == 2 # The command is skipped and the latest message is not repeated
+    assert prompt.count("feeling tired") == 1
+    assert prompt.index("feeling tired") < prompt.index('"glucose": 110') # Latest first, then newest history
+
+    renders, reads = [], []
+    real_render, real_read = prompt_builder.render_history_item, db.get_user_text_history_since
+    monkeypatch.setattr(prompt_builder, "render_history_item", lambda text: renders.append(text) or real_render(text))
+    monkeypatch.setattr(db, "get_user_text_history_since", lambda *args, **kwargs: reads.append(args) or real_read(*args, **kwargs))
+    history("slept badly")
+    prompt, count = builder.build(5)
+    assert count == 3 and "slept badly" in prompt
+    assert renders == ["slept badly"] # Only the new row is rendered
+    assert reads[0][1] > 0 # Read after the last seen id
+
+
+def test_history_is_trimmed_to_the_token_budget(history):
+    history(*[f"message {i} " + "x" * 400 for i in range(20)])
+    builder = prompt_builder.AnalysisPromptBuilder(token_budget=prompt_builder.estimate_tokens(
+        prompt_builder.s.GEMINI_PROMPT_TEXT_ANALYSIS) + 350, max_users=10)
+    prompt, count = builder.build(5)
+    assert count == 3 and "message 19 " in prompt and "message 16 " not in prompt
+    assert prompt_builder.estimate_tokens(prompt) <= builder.token_budget
+
+    builder.forget(5)
+    assert builder.build(5)[1] == 3 # Rebuilt from the database
+
+
+def test_repeated_text_keeps_its_history(history):
+    history("ok", "glucose 110", "ok")
+    builder = prompt_builder.AnalysisPromptBuilder(token_budget=10000, max_users=10)
+    prompt, count = builder.build(5, [(1000, 3, "ok")]) # Only message 3 is the latest one
+    assert count == 3 and prompt.count("ok") == 2
+
+
+def test_web_app_edits_invalidate_the_cached_context(history, monkeypatch):
+    import bot_modules.flask_app as flask_app
+    history("glucose 110")
+    builder = prompt_builder.AnalysisPromptBuilder(token_budget=10000, max_users=10) # As in another worker process
+    assert "glucose 110" in builder.build(5)[0]
+    monkeypatch.setattr(flask_app, "validate_init_data", lambda init_data, token: (5, None))
+    row_id = db.get_user_text_history_since(5)[0]["id"]
+    response = flask_app.app.test_client().post('/webapp/save_messages', json=[{'id': row_id, 'text': "glucose 95"}],
+                                                headers={'X-Telegram-Init-Data': 'signed'})
+    assert response.status_code == 200
+    prompt = builder.build(5)[0]
+    assert "glucose 95" in prompt and "glucose 110" not in prompt
+
+
+def test_a_deleted_users_history_is_not_served_from_the_cache(history):
+    history("glucose 110")
+    builder = prompt_builder.AnalysisPromptBuilder(token_budget=10000, max_users=10)
+    assert "glucose 110" in builder.build(5)[0]
+    assert db.delete_user_data(5)[0] # Deleted elsewhere: this builder is never told
+    db.save_user(make_user(5), chat_id=1000)
+    db.save_message(make_message(5, 50, "hello again"))
+    db.flush_pending_writes()
+    prompt, count = builder.build(5)
+    assert count == 1 and "hello again" in prompt and "glucose 110" not in prompt
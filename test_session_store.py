@@ -0,0 +1,111 @@
+"""
+test_session_store.py
+
+Tests for the user session stores in bot_modules/session_store.py: the in-memory
+LRU/TTL store and the SQLite store (against a fresh database file).
+
+To run:
+    pytest test_session_store.py -q
+"""
+
+import os
+import pytest
+
+# config.py refuses to load without a bot token; a dummy one is enough here.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import bot_modules.database as db
+import bot_modules.session_store as session_store
+from test_database import fresh_db # noqa: F401 (fixture)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(session_store.time, "monotonic", clock)
+    monkeypatch.setattr(session_store.time, "time", clock)
+    return clock
+
+
+def test_memory_store_evicts_least_recently_used_and_expires_idle(clock):
+    store = session_store.MemorySessionStore(ttl_seconds=60, max_sessions=2)
+    for user_id in (1, 2):
+        store.create(user_id, preferences={'language': 'en'})
+    assert store.get(1).state == session_store.s.USER_STATE_MAIN_MENU # 1 is now the most recent
+    store.create(3)
+    assert store.get(2) is None # Least recently used, evicted
+    assert [user_id for user_id, _ in store.states()] == [3, 1]
+
+    clock.now += 30
+    store.get(3)
+    clock.now += 45
+    assert store.count() == 1 and store.get(1) is None # Idle for 75s
+    session, created = store.get_or_create(1)
+    assert created
+
+
+def test_memory_store_loads_preferences_lazily(clock, monkeypatch):
+    loads = []
+    monkeypatch.setattr(session_store.db, "get_user_preferences", lambda user_id: loads.append(user_id) or {'theme': 'light'})
+    store = session_store.MemorySessionStore(ttl_seconds=60, max_sessions=10)
+    session = store.create(4)
+    store.preference_changed(4, 'theme', 'dark') # Not loaded yet: nothing to update
+    assert loads == []
+    assert session.preferences == {'theme': 'light'} and loads == [4]
+    store.preference_changed(4, 'theme', 'dark')
+    assert store.get(4).preferences == {'theme': 'dark'} and loads == [4]
+
+
+def test_sqlite_store_shares_state_and_expires_idle(fresh_db, clock):
+    store = session_store.SQLiteSessionStore(ttl_seconds=60, purge_interval_seconds=100)
+    session = store.create(7)
+    session.state = session_store.s.USER_STATE_MENU2
+    session.data['selected_item'] = "menu2_sub1"
+    store.save(session)
+
+    other_worker = session_store.SQLiteSessionStore(ttl_seconds=60, purge_interval_seconds=100)
+    loaded = other_worker.get(7)
+    assert (loaded.state, loaded.data) == (session_store.s.USER_STATE_MENU2, {'selected_item': "menu2_sub1"})
+    assert loaded.preferences['theme'] == session_store.s.DB_DEFAULT_THEME # Lazily read from user_preferences
+    assert other_worker.count() == 1 and other_worker.states() == [(7, session_store.s.USER_STATE_MENU2)]
+
+    clock.now += 90
+    assert store.get(7) is None and store.count() == 0 # Expired rows are ignored...
+    clock.now += 20
+    store.create(8) # ...and deleted once the purge interval has passed
+    assert db.get_connection().execute("SELECT user_id FROM user_sessions").fetchall()[0][0] == 8
+    store.delete(8)
+    assert store.get(8) is None
+
+
+def test_unknown_backend_falls_back_to_memory():
+    assert isinstance(session_store.create_session_store("redis"), session_store.MemorySessionStore)
+    assert isinstance(session_store.create_session_store("sqlite"), session_store.SQLiteSessionStore)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_reading_a_session_keeps_it_alive_on_every_backend(fresh_db, clock, backend):
+    if backend == "memory":
+        store = session_store.MemorySessionStore(ttl_seconds=60, max_sessions=10)
+    else:
+        store = session_store.SQLiteSessionStore(ttl_seconds=60, purge_interval_seconds=1000)
+    store.create(3)
+    for _ in range(3): # Only read, 45s apart: never idle for a full TTL
+        clock.now += 45
+        assert store.get(3) is not None
+    clock.now += 61
+    assert store.get(3) is None
+
+
+def test_incomplete_backend_fails_when_instantiated():
+    class NoCount(session_store.SessionStore): # count() missing
+        get = save = delete = states = lambda *args: None
+    with pytest.raises(TypeError):
+        NoCount(ttl_seconds=60)
@@ -0,0 +1,37 @@
+# wsgi.py - production entry point: runs the Flask app under gunicorn
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# gunicorn.conf.py enables preload_app, so this module is imported once in the
+# gunicorn master: the database is migrated and the webhook registered a single
+# time before the workers are forked. Each worker then starts its own background
+# services (post_fork) and drains them on graceful shutdown (worker_exit).
+import logging
+import os
+
+from bot_modules import config
+from bot_modules import lifecycle
+from bot_modules.flask_app import app # The WSGI application
+from bot_modules import strings_en
+from bot_modules import strings_es
+
+# Set language based on environment
+BOT_LANGUAGE = os.getenv('BOT_LANGUAGE', 'english').lower()
+s = strings_es if BOT_LANGUAGE == 'spanish' else strings_en
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+try:
+    lifecycle.init_database()
+except Exception as db_init_e:
+    logger.error(s.FATAL_DB_INIT_FAILED.format(error=db_init_e), exc_info=True)
+    raise SystemExit(1)
+
+if config.WSGI_SET_WEBHOOK and not lifecycle.configure_webhook():
+    raise SystemExit(1)
+
+__all__ = ['app']